@@ -14,9 +14,20 @@ import queue
 import threading
 import warnings
 
+from autothread.affinity import _Placement, _strategies, _supported
+from autothread.autoscale import _Autoscaler
 from autothread.blocking import _Autothread
-from autothread.non_blocking import _Placeholder
-from typing import Callable, Union
+from autothread.budget import limit
+from autothread.cache import Cache
+from autothread.checkpoint import _Checkpoint
+from autothread.common import cancelled
+from autothread.initializer import _Initializer, context
+from autothread.memory import _MemoryGate
+from autothread.non_blocking import _Executor, _Placeholder, _stats_of
+from autothread.retry import TaskFailure, _RetryPolicy
+from autothread.shared_memory import _check_available, shared_array
+from autothread.stats import CallStats, TaskStats
+from typing import Any, Callable, Optional, Tuple, Type, Union
 
 
 class multithreaded:
@@ -44,7 +55,6 @@ class multithreaded:
 
     Process = threading.Thread
     Queue = queue.Queue
-    Semaphore = threading.Semaphore
 
     def __init__(
         self,
@@ -53,6 +63,29 @@ class multithreaded:
         workers_per_core: int = None,
         progress_bar: bool = False,
         ignore_errors: bool = False,
+        chunksize: Union[int, str] = 1,
+        type_check: str = "full",
+        shared_memory: bool = False,
+        stats: Union[bool, Callable[[CallStats], None]] = False,
+        autoscale: bool = False,
+        min_workers: int = 1,
+        max_workers: int = None,
+        mem_estimate: Callable[..., float] = None,
+        cache: Union[bool, Cache] = False,
+        schedule: Union[None, str, Callable[..., float]] = None,
+        timeout: float = None,
+        call_timeout: float = None,
+        retries: int = 0,
+        retry_on: Union[Type[Exception], Tuple[Type[Exception], ...]] = Exception,
+        backoff: Union[float, Callable[[int], float]] = 0.0,
+        return_failures: bool = False,
+        checkpoint: str = None,
+        affinity: str = None,
+        threads_per_process: int = 1,
+        initializer: Callable[..., Any] = None,
+        initargs: Tuple = (),
+        teardown: Callable[[Any], None] = None,
+        batch_size: int = None,
     ):
         """Initialize the autothread decorator
 
@@ -62,6 +95,66 @@ class multithreaded:
         :param workers_per_core: Number of workers to run per core.
         :param progress_bar: Visualize how many of the tasks are completed
         :param ignore_errors: Return `None` when an error is encountered
+        :param chunksize: Number of tasks to send to a worker at once, or "auto" to
+        send large chunks first and smaller chunks towards the end of the list.
+        :param type_check: Which items of a list are checked against the type hint to
+        determine if it must be parallelized: "full" (all), "sampled" (a sample spread
+        over the list), "first" (only the first item) or "off" (none).
+        :param shared_memory: Pass numpy arrays to the processes through shared memory
+        instead of pickling them. Has no effect for threads. Requires numpy.
+        :param stats: Record statistics of every call and store them in the
+        `last_stats` attribute of the function. Can also be a function that receives the
+        statistics of every call.
+        :param autoscale: Add workers while the machine has idle cores and available
+        memory, remove workers when it is overloaded. `n_workers`, `mb_mem` or
+        `workers_per_core` determine the number of workers to start with.
+        :param min_workers: Lowest number of workers when autoscaling.
+        :param max_workers: Highest number of workers when autoscaling, (default) None
+        for twice the amount of cores.
+        :param mem_estimate: Function that receives the arguments of a task and returns
+        the megabytes of memory it needs. Like with `mb_mem`, a task only starts when
+        that much memory is available.
+        :param cache: Look up the output of every task in a cache before running it.
+        True for an in-memory cache of the last 1024 outputs, or an `autothread.Cache`.
+        :param schedule: Submit the most expensive tasks first. Either a function that
+        receives the arguments of a task and returns its cost, or "history" to use the
+        run times of the same items in earlier calls. The outputs stay in order.
+        :param timeout: Seconds a single task may run. A task that takes longer is
+        stopped and raises a TimeoutError (or returns `None` with `ignore_errors`).
+        :param call_timeout: Seconds a whole call may take before it is stopped and
+        raises a TimeoutError.
+        :param retries: Number of times a task that raised an error is run again.
+        :param retry_on: Exception type(s) that are retried, other errors are not.
+        :param backoff: Seconds to wait before the first retry, doubled for every next
+        retry. Or a function that receives the number of the failed attempt (starting
+        at 1) and returns the seconds to wait.
+        :param return_failures: Return a tuple of the outputs and a list of
+        `autothread.TaskFailure` instead of raising the first error. The outputs of the
+        failed tasks are `None`. `imap` and `imap_unordered` yield the failures in place
+        of the outputs.
+        :param checkpoint: Path of a SQLite file to store the outputs in as they
+        finish. When the function is called again with the same inputs, for example
+        after the script died, the tasks that finished before are not run again. The
+        outputs are deleted when a call finishes.
+        :param affinity: Pin every worker process to a core: "round_robin" (in the order
+        of the core numbers), "compact" (fill the cores of one NUMA node before the
+        next) or "spread" (take turns between the NUMA nodes). (default) None lets the
+        operating system schedule the processes. Has no effect for threads.
+        :param threads_per_process: Number of threads every worker process runs, all of
+        them pull tasks from the same queue. Useful for tasks that mix computations
+        with waiting for I/O. `n_workers` is the number of processes. Can not be
+        combined with `timeout`. Has no effect for threads.
+        :param initializer: Function that runs once in every worker before its first
+        task, e.g. to load a model or open a connection. Its return value is the
+        context of the worker, which the function reads with `autothread.context()`.
+        :param initargs: Arguments of the initializer.
+        :param teardown: Function that receives the context of a worker when the worker
+        stops.
+        :param batch_size: Call the function once for every `batch_size` items with
+        slices of the loop parameters (lists, or numpy arrays with `_loop_params`) instead
+        of once per item. The function must return a list with an output for every item
+        of the slices, the lists are concatenated in order. The type hints still
+        describe a single item. Can not be combined with `schedule="history"`.
         """
         if callable(n_workers):
             raise SyntaxError(
@@ -71,29 +164,113 @@ class multithreaded:
             )
 
         self.n_workers = self._get_workers(n_workers, mb_mem, workers_per_core)
+        self.mb_mem = mb_mem
         self.process_bar = progress_bar
         self.ignore_errors = ignore_errors
+        self.chunksize = self._get_chunksize(chunksize)
+        if type_check not in ("full", "sampled", "first", "off"):
+            raise ValueError(
+                "'type_check' must be one of 'full', 'sampled', 'first' or 'off', "
+                f"not {type_check!r}"
+            )
+        self.type_check = type_check
+        if shared_memory:
+            _check_available()
+        self.shared_memory = shared_memory
+        if not (isinstance(stats, bool) or callable(stats)):
+            raise ValueError(f"'stats' must be a bool or a function, not {stats!r}")
+        self.stats = stats
+        self.autoscale = autoscale
+        self.min_workers, self.max_workers = self._get_bounds(min_workers, max_workers)
+        self.mem_estimate = mem_estimate
+        if not isinstance(cache, (bool, Cache)):
+            raise ValueError(
+                f"'cache' must be a bool or an autothread.Cache, not {cache!r}"
+            )
+        self.cache = cache
+        if not (schedule in (None, "history") or callable(schedule)):
+            raise ValueError(
+                f"'schedule' must be None, 'history' or a function, not {schedule!r}"
+            )
+        self.schedule = schedule
+        self.timeout = self._get_timeout("timeout", timeout)
+        self.call_timeout = self._get_timeout("call_timeout", call_timeout)
+        self.retry = self._get_retry(retries, retry_on, backoff)
+        self.return_failures = return_failures
+        self.checkpoint = checkpoint
+        self.affinity = self._get_affinity(affinity)
+        self.threads_per_process = self._get_threads(threads_per_process)
+        self.initializer = self._get_initializer(initializer, initargs, teardown)
+        if not (batch_size is None or (isinstance(batch_size, int) and batch_size > 0)):
+            raise ValueError(
+                f"'batch_size' must be a positive integer or None, not {batch_size!r}"
+            )
+        if batch_size is not None and schedule == "history":
+            # The slices of a batch can not be looked up in the history
+            raise ValueError("'batch_size' can not be combined with schedule='history'")
+        self.batch_size = batch_size
 
     def __call__(self, function: Callable):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            return decorator(*args, **kwargs)
+
+        wrapper.cache = self._get_cache()
+
         decorator = _Autothread(
             function=function,
             Process=self.Process,
             Queue=self.Queue,
-            Semaphore=self.Semaphore,
             n_workers=self.n_workers,
             progress_bar=self.process_bar,
             ignore_errors=self.ignore_errors,
+            chunksize=self.chunksize,
+            type_check=self.type_check,
+            shared_memory=self.shared_memory,
+            stats=self._stats_callback(wrapper),
+            autoscaler=self._get_autoscaler(),
+            memory_gate=self._get_memory_gate(),
+            cache=wrapper.cache,
+            schedule=self.schedule,
+            timeout=self.timeout,
+            call_timeout=self.call_timeout,
+            retry=self.retry,
+            return_failures=self.return_failures,
+            checkpoint=self._get_checkpoint(function),
+            placement=self._get_placement(),
+            threads_per_process=self.threads_per_process,
+            initializer=self.initializer,
+            batch_size=self.batch_size,
         )
 
-        @functools.wraps(function)
-        def wrapper(*args, **kwargs):
-            return decorator(*args, **kwargs)
-
         wrapper.__doc__ = decorator.__doc__
         wrapper.__signature__ = decorator.__signature__
+        wrapper.imap = decorator.imap
+        wrapper.imap_unordered = decorator.imap_unordered
+        wrapper.shutdown = decorator.shutdown
+        wrapper.cancel = decorator.cancel
+        wrapper.last_stats = None
 
         return wrapper
 
+    def _stats_callback(self, wrapper: Callable) -> Optional[Callable]:
+        """Function that receives the statistics of every call of a decorated function
+
+        The statistics are stored in the `last_stats` attribute of the function and
+        forwarded to the callback of the user.
+
+        :param wrapper: Decorated function
+        """
+        if not self.stats:
+            return None
+
+        def callback(stats: CallStats):
+            wrapper.last_stats = stats
+            if callable(self.stats):
+                self.stats(stats)
+
+        return callback
+
     def _get_workers(self, *args):
         """Determined the number of workers to use based on the users inputs
 
@@ -116,6 +293,170 @@ class multithreaded:
         else:
             return n_workers
 
+    def _get_bounds(self, min_workers: int, max_workers: Optional[int]) -> Tuple:
+        """Validate the bounds of the number of workers when autoscaling
+
+        :param min_workers: Lowest number of workers
+        :param max_workers: Highest number of workers, None for twice the amount of cores
+        """
+        if max_workers is None:
+            max_workers = max(min_workers, 2 * mp.cpu_count())
+        if not 1 <= min_workers <= max_workers:
+            raise ValueError(
+                "'min_workers' must be at least 1 and at most 'max_workers', not "
+                f"{min_workers!r} (max_workers={max_workers!r})"
+            )
+        return min_workers, max_workers
+
+    def _get_autoscaler(self) -> Optional[_Autoscaler]:
+        """Create the autoscaler of a decorated function, None if it is disabled"""
+        if not self.autoscale:
+            return None
+        return _Autoscaler(
+            n_workers=self.n_workers if self.n_workers > 0 else self.max_workers,
+            min_workers=self.min_workers,
+            max_workers=self.max_workers,
+            mb_mem=self.mb_mem,
+        )
+
+    def _get_memory_gate(self) -> Optional[_MemoryGate]:
+        """Create the memory gate of a decorated function, None if it is not needed"""
+        if not (self.mb_mem or self.mem_estimate):
+            return None
+        return _MemoryGate(mb_mem=self.mb_mem, estimate=self.mem_estimate)
+
+    def _get_cache(self) -> Optional[Cache]:
+        """Get the cache of a decorated function, None if caching is disabled"""
+        if self.cache is True:
+            return Cache()
+        return self.cache if isinstance(self.cache, Cache) else None
+
+    def _get_checkpoint(self, function: Callable) -> Optional[_Checkpoint]:
+        """Create the checkpoint of a decorated function, None if it is disabled
+
+        :param function: Function whose outputs are stored
+        """
+        if self.checkpoint is None:
+            return None
+        return _Checkpoint(self.checkpoint, function)
+
+    def _get_affinity(self, affinity: Optional[str]) -> Optional[str]:
+        """Validate the affinity provided by the user
+
+        :param affinity: How to pin the worker processes to cores, None to not pin them
+        """
+        if affinity is not None and affinity not in _strategies:
+            raise ValueError(
+                "'affinity' must be None, 'round_robin', 'compact' or 'spread', not "
+                f"{affinity!r}"
+            )
+        if affinity is not None and not _supported():
+            warnings.warn(
+                "Pinning processes to cores is not supported on this platform, the "
+                "workers are not pinned"
+            )
+            return None
+        return affinity
+
+    def _get_placement(self) -> Optional[_Placement]:
+        """Create the placement of the worker processes, None if they are not pinned"""
+        if self.affinity is None or self.Process == threading.Thread:
+            return None
+        return _Placement(self.affinity)
+
+    def _get_threads(self, threads_per_process: int) -> int:
+        """Validate the number of threads per process provided by the user
+
+        :param threads_per_process: Number of threads every worker process runs
+        """
+        if not isinstance(threads_per_process, int) or threads_per_process < 1:
+            raise ValueError(
+                "'threads_per_process' must be a positive integer, not "
+                f"{threads_per_process!r}"
+            )
+        if threads_per_process > 1 and self.timeout is not None:
+            raise ValueError(
+                "'timeout' can not be combined with 'threads_per_process', a task that "
+                "takes too long is stopped by killing its process"
+            )
+        return threads_per_process
+
+    def _get_initializer(
+        self,
+        initializer: Optional[Callable[..., Any]],
+        initargs: Tuple,
+        teardown: Optional[Callable[[Any], None]],
+    ) -> Optional[_Initializer]:
+        """Validate the initializer options provided by the user
+
+        :param initializer: Function that returns the context of a worker
+        :param initargs: Arguments of the initializer
+        :param teardown: Function that receives the context when a worker stops
+        :return: The initializer, None if the workers have no context
+        """
+        for name, value in (("initializer", initializer), ("teardown", teardown)):
+            if not (value is None or callable(value)):
+                raise ValueError(f"'{name}' must be a function or None, not {value!r}")
+        if not isinstance(initargs, (tuple, list)):
+            raise ValueError(f"'initargs' must be a tuple, not {initargs!r}")
+        if initializer is None and teardown is None:
+            return None
+        return _Initializer(initializer, tuple(initargs), teardown)
+
+    def _get_timeout(self, name: str, timeout: Optional[float]) -> Optional[float]:
+        """Validate a timeout provided by the user
+
+        :param name: Name of the parameter, for the error message
+        :param timeout: Number of seconds or None for no limit
+        """
+        if timeout is None or (isinstance(timeout, (int, float)) and timeout > 0):
+            return timeout
+        raise ValueError(f"'{name}' must be a positive number or None, not {timeout!r}")
+
+    def _get_retry(
+        self,
+        retries: int,
+        retry_on: Union[Type[Exception], Tuple[Type[Exception], ...]],
+        backoff: Union[float, Callable[[int], float]],
+    ) -> Optional[_RetryPolicy]:
+        """Validate the retry options provided by the user
+
+        :param retries: Number of times a failed task is run again
+        :param retry_on: Exception type(s) that are retried
+        :param backoff: Seconds to wait before the first retry, or a function
+        :return: The retry policy, None if failed tasks are not retried
+        """
+        if not isinstance(retries, int) or retries < 0:
+            raise ValueError(
+                f"'retries' must be a non-negative integer, not {retries!r}"
+            )
+        types = retry_on if isinstance(retry_on, tuple) else (retry_on,)
+        if not all(isinstance(t, type) and issubclass(t, Exception) for t in types):
+            raise ValueError(
+                f"'retry_on' must be an exception type or a tuple of them, not "
+                f"{retry_on!r}"
+            )
+        if not (
+            callable(backoff) or (isinstance(backoff, (int, float)) and backoff >= 0)
+        ):
+            raise ValueError(
+                f"'backoff' must be a non-negative number or a function, not {backoff!r}"
+            )
+        if not retries:
+            return None
+        return _RetryPolicy(retries, retry_on, backoff)
+
+    def _get_chunksize(self, chunksize: Union[int, str]) -> Union[int, str]:
+        """Validate the chunksize provided by the user
+
+        :param chunksize: Number of tasks to send to a worker at once or "auto"
+        """
+        if chunksize == "auto" or (isinstance(chunksize, int) and chunksize > 0):
+            return chunksize
+        raise ValueError(
+            f"'chunksize' must be a positive integer or 'auto', not {chunksize!r}"
+        )
+
 
 class multiprocessed(multithreaded):
     """Decorator to make any function multiprocessed
@@ -142,7 +483,6 @@ class multiprocessed(multithreaded):
 
     Process = mp.Process
     Queue = mp.Queue
-    Semaphore = mp.Semaphore
 
 
 class async_threaded(multithreaded):
@@ -173,7 +513,6 @@ class async_threaded(multithreaded):
 
     Process = threading.Thread
     Queue = queue.Queue
-    Semaphore = threading.Semaphore
 
     def __init__(
         self,
@@ -181,6 +520,20 @@ class async_threaded(multithreaded):
         mb_mem: int = None,
         workers_per_core: int = None,
         ignore_errors: int = False,
+        stats: Union[bool, Callable[[CallStats], None]] = False,
+        autoscale: bool = False,
+        min_workers: int = 1,
+        max_workers: int = None,
+        mem_estimate: Callable[..., float] = None,
+        cache: Union[bool, Cache] = False,
+        timeout: float = None,
+        retries: int = 0,
+        retry_on: Union[Type[Exception], Tuple[Type[Exception], ...]] = Exception,
+        backoff: Union[float, Callable[[int], float]] = 0.0,
+        affinity: str = None,
+        initializer: Callable[..., Any] = None,
+        initargs: Tuple = (),
+        teardown: Callable[[Any], None] = None,
     ):
         """Initialize the autothread decorator
 
@@ -189,11 +542,57 @@ class async_threaded(multithreaded):
         :param mb_mem: Minimum megabytes of memory for each worker.
         :param workers_per_core: Number of workers to run per core.
         :param ignore_errors: Return `None` when an error is encountered
+        :param stats: Record statistics of every call and store them in the
+        `last_stats` attribute of the function. `stats_of(placeholder)` of the function
+        returns the statistics of a single call. Can also be a function that receives
+        the statistics of every call.
+        :param autoscale: Add workers while the machine has idle cores and available
+        memory, remove workers when it is overloaded.
+        :param min_workers: Lowest number of workers when autoscaling.
+        :param max_workers: Highest number of workers when autoscaling, (default) None
+        for twice the amount of cores.
+        :param mem_estimate: Function that receives the arguments of a task and returns
+        the megabytes of memory it needs. Like with `mb_mem`, a task only starts when
+        that much memory is available.
+        :param cache: Look up the output of every task in a cache before running it.
+        True for an in-memory cache of the last 1024 outputs, or an `autothread.Cache`.
+        :param timeout: Seconds a single call may run. A call that takes longer is
+        stopped and raises a TimeoutError (or returns `None` with `ignore_errors`).
+        :param retries: Number of times a call that raised an error is run again.
+        :param retry_on: Exception type(s) that are retried, other errors are not.
+        :param backoff: Seconds to wait before the first retry, doubled for every next
+        retry. Or a function that receives the number of the failed attempt (starting
+        at 1) and returns the seconds to wait.
+        :param affinity: Pin every worker process to a core: "round_robin" (in the order
+        of the core numbers), "compact" (fill the cores of one NUMA node before the
+        next) or "spread" (take turns between the NUMA nodes). (default) None lets the
+        operating system schedule the processes. Has no effect for threads.
+        :param initializer: Function that runs once in every worker before its first
+        task, e.g. to load a model or open a connection. Its return value is the
+        context of the worker, which the function reads with `autothread.context()`.
+        :param initargs: Arguments of the initializer.
+        :param teardown: Function that receives the context of a worker when the worker
+        stops.
         """
 
-        super().__init__(n_workers, mb_mem, workers_per_core)
-        self.semaphore = self.Semaphore(
-            self.n_workers if self.n_workers > 0 else int(1e9)
+        super().__init__(
+            n_workers,
+            mb_mem,
+            workers_per_core,
+            stats=stats,
+            autoscale=autoscale,
+            min_workers=min_workers,
+            max_workers=max_workers,
+            mem_estimate=mem_estimate,
+            cache=cache,
+            timeout=timeout,
+            retries=retries,
+            retry_on=retry_on,
+            backoff=backoff,
+            affinity=affinity,
+            initializer=initializer,
+            initargs=initargs,
+            teardown=teardown,
         )
         self.ignore_errors = ignore_errors
 
@@ -207,10 +606,27 @@ class async_threaded(multithreaded):
             )
             return_type = None
 
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            return Placeholder(*args, **kwargs)
+
+        wrapper.cache = self._get_cache()
+
         class Placeholder(_Placeholder):
-            ___semaphore___ = self.semaphore
-            ___Queue___ = self.Queue
-            ___Process___ = self.Process
+            ___executor___ = _Executor(
+                function=function,
+                Process=self.Process,
+                Queue=self.Queue,
+                n_workers=self.n_workers,
+                stats=self._stats_callback(wrapper),
+                autoscaler=self._get_autoscaler(),
+                memory_gate=self._get_memory_gate(),
+                cache=wrapper.cache,
+                timeout=self.timeout,
+                retry=self.retry,
+                placement=self._get_placement(),
+                initializer=self.initializer,
+            )
             ___ignore_errors___ = self.ignore_errors
             if not return_type is None:
                 __type__ = return_type
@@ -221,6 +637,7 @@ class async_threaded(multithreaded):
                 __qualname__ = return_type.__qualname__
 
         no_override = (
+            "__await__",
             "__class__",
             "__del__",
             "__dict__",
@@ -241,9 +658,10 @@ class async_threaded(multithreaded):
                 ):
                     setattr(Placeholder, attr, Placeholder.___forwarder___(attr))
 
-        @functools.wraps(function)
-        def wrapper(*args, **kwargs):
-            return Placeholder(function, *args, **kwargs)
+        wrapper.shutdown = Placeholder.___executor___.shutdown
+        wrapper.cancel = Placeholder.___executor___.cancel_all
+        wrapper.stats_of = _stats_of
+        wrapper.last_stats = None
 
         return wrapper
 
@@ -276,4 +694,3 @@ class async_processed(async_threaded):
 
     Process = mp.Process
     Queue = mp.Queue
-    Semaphore = mp.Semaphore
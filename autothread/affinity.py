@@ -0,0 +1,119 @@
+import glob
+import os
+import psutil
+import re
+
+from typing import List, Optional
+
+# How the workers are placed on the cores, see `_Placement`
+_strategies = ("round_robin", "compact", "spread")
+
+
+def _supported() -> bool:
+    """Whether the workers can be pinned to cores on this platform"""
+    return hasattr(os, "sched_setaffinity") or hasattr(psutil.Process, "cpu_affinity")
+
+
+def _allowed_cpus() -> List[int]:
+    """Cores this process may run on, e.g. limited by taskset or a container"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return sorted(psutil.Process().cpu_affinity())
+
+
+def _parse_cpulist(cpulist: str) -> List[int]:
+    """Parse a list of cores in the format of the kernel, e.g. "0-3,8,10-11"
+
+    :param cpulist: Comma separated cores and ranges of cores
+    """
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def _numa_nodes() -> List[List[int]]:
+    """Cores of every NUMA node that this process may run on
+
+    The nodes are read from `/sys/devices/system/node`. Without that directory (other
+    platforms than Linux), all the cores are a single node.
+    """
+    allowed = _allowed_cpus()
+    nodes = []
+    paths = glob.glob("/sys/devices/system/node/node*/cpulist")
+    for path in sorted(paths, key=lambda p: int(re.findall(r"node(\d+)", p)[-1])):
+        try:
+            with open(path) as f:
+                cpus = _parse_cpulist(f.read())
+        except (OSError, ValueError):
+            continue
+        cpus = [cpu for cpu in cpus if cpu in allowed]
+        if cpus:
+            nodes.append(cpus)
+    covered = {cpu for node in nodes for cpu in node}
+    if not nodes or covered != set(allowed):
+        return [allowed]
+    return nodes
+
+
+def _pin(cpus: List[int]):
+    """Pin the current process to cores
+
+    :param cpus: Cores the process may run on
+    """
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    else:
+        psutil.Process().cpu_affinity(cpus)
+
+
+class _Placement:
+    """Decides on which core every worker process runs
+
+    The workers are numbered in the order they are started, a worker that replaces a
+    stopped worker takes over its number. Every worker is pinned to a single core, such
+    that the data it works on stays in the cache of that core:
+    - "round_robin": the cores in the order of their numbers
+    - "compact": fill the cores of the first NUMA node before using the next node, such
+      that the workers share the memory and the caches of as few nodes as possible
+    - "spread": take turns between the NUMA nodes, such that the workers spread the
+      memory bandwidth of all the nodes
+    When there are more workers than cores, the next workers start again at the first
+    core.
+    """
+
+    def __init__(self, strategy: str):
+        """Initialize the placement
+
+        :param strategy: One of "round_robin", "compact" or "spread"
+        """
+        self.strategy = strategy
+        self._order: Optional[List[int]] = None
+
+    def cpus(self, number: int) -> List[int]:
+        """Cores a worker is pinned to
+
+        :param number: Number of the worker, starting at 0
+        """
+        if self._order is None:
+            # Read the topology once, on the first worker that is started
+            self._order = self._layout(_numa_nodes())
+        return [self._order[number % len(self._order)]]
+
+    def _layout(self, nodes: List[List[int]]) -> List[int]:
+        """Order in which the workers take the cores
+
+        :param nodes: Cores of every NUMA node
+        """
+        if self.strategy == "round_robin":
+            return sorted(cpu for node in nodes for cpu in node)
+        if self.strategy == "compact":
+            return [cpu for node in nodes for cpu in node]
+        order = []
+        for i in range(max(len(node) for node in nodes)):
+            order.extend(node[i] for node in nodes if i < len(node))
+        return order
@@ -0,0 +1,72 @@
+import multiprocess as mp
+import psutil
+import threading
+import time
+
+from typing import Optional
+
+
+class _Autoscaler:
+    """Adjusts the number of workers to what the machine is doing
+
+    The machine is sampled at most once every `interval` seconds. A worker is added
+    while there are idle cores and enough available memory, a worker is removed when
+    the machine is oversubscribed (more runnable tasks than cores) or runs out of
+    memory. The number of workers always stays between `min_workers` and `max_workers`.
+    """
+
+    # Fraction of the total memory that must stay available
+    _min_available = 0.05
+
+    def __init__(
+        self,
+        n_workers: int,
+        min_workers: int,
+        max_workers: int,
+        mb_mem: Optional[int] = None,
+        interval: float = 0.5,
+    ):
+        """Initialize the autoscaler
+
+        :param n_workers: Number of workers to start with
+        :param min_workers: Lowest number of workers
+        :param max_workers: Highest number of workers
+        :param mb_mem: Megabytes of memory a worker needs, None to only prevent running
+        out of memory
+        :param interval: Minimum number of seconds between two samples
+        """
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.n_workers = max(min_workers, min(max_workers, n_workers))
+        self._mb_mem = mb_mem
+        self._interval = interval
+        self._n_cores = mp.cpu_count()
+        self._sampled = time.monotonic()
+        self._lock = threading.Lock()
+        psutil.cpu_percent()  # the next reading is the usage since this call
+
+    def target(self) -> int:
+        """Number of workers that should be running right now"""
+        with self._lock:
+            now = time.monotonic()
+            if now - self._sampled >= self._interval:
+                self._sampled = now
+                self.n_workers = max(
+                    self.min_workers,
+                    min(self.max_workers, self.n_workers + self._step()),
+                )
+            return self.n_workers
+
+    def _step(self) -> int:
+        """Number of workers to add (positive) or remove (negative)"""
+        memory = psutil.virtual_memory()
+        if memory.available < self._min_available * memory.total:
+            return -1
+        load = psutil.getloadavg()[0] / self._n_cores
+        idle_cores = int((100 - psutil.cpu_percent()) / 100 * self._n_cores)
+        if load > 1.25 and idle_cores < 1:
+            return -1
+        step = idle_cores if load < 1 else 0
+        if self._mb_mem:
+            step = min(step, int(memory.available / 1024**2 // self._mb_mem))
+        return step
@@ -1,51 +1,154 @@
-import ctypes
+import collections
+import collections.abc
+import copy
 import inspect
+import itertools
 import multiprocess as mp
 import os
 import queue
-import signal
 import threading
+import time
 import typeguard
 import warnings
 
-from autothread.common import _queuer
+from autothread.affinity import _Placement
+from autothread.autoscale import _Autoscaler
+from autothread.budget import _current, _in_worker
+from autothread.cache import _MISS, Cache
+from autothread.checkpoint import _Checkpoint
+from autothread.common import _attempt
+from autothread.initializer import _Initializer
+from autothread.memory import _MemoryGate
+from autothread.pool import _Channel, _CoroutinePool, _PoolSet, _WorkerPool
+from autothread.retry import TaskFailure, _RetryPolicy
+from autothread.shared_memory import _attach, _discard, _share
+from autothread.stats import CallStats
+from concurrent.futures import CancelledError
 from tqdm import tqdm
-from typing import List, Union, Optional, Tuple, Dict, Callable, Type
+from typing import Any, List, Union, Optional, Tuple, Dict, Callable, Type
 
 
 class _Autothread:
     """Decorator class that transforms a function into a multi processed
-    function simply by adding a single decorator."""
+    function simply by adding a single decorator.
+
+    Every call runs on its own shallow copy of the decorator (see `_invocation`), so
+    the function can be called from several threads at the same time. The concurrent
+    calls share the workers: together they never run more than `n_workers` chunks.
+    """
+
+    _n_type_samples = 32
+    _history_size = 2**16
+    _poll_interval = 0.05
+    _length_error = (
+        "Input for parallelization is ambiguous. {loop_params} are "
+        "all lists but are of different lengths. It is possible that the type "
+        "hints of this function are incorrect. If they are not, use the "
+        "`_loop_params` keyword argument to specify the parameters to "
+        "parallelize for."
+    )
 
     def __init__(
         self,
         function: Callable,
         Process: Union[Type[threading.Thread], Type[mp.Process]],
         Queue: Union[Type[queue.Queue], Type[mp.Queue]],
-        Semaphore: Union[Type[threading.Semaphore], Type[mp.Semaphore]],
         n_workers: int,
         progress_bar: bool,
         ignore_errors: bool,
+        chunksize: Union[int, str] = 1,
+        type_check: str = "full",
+        shared_memory: bool = False,
+        stats: Optional[Callable[[CallStats], None]] = None,
+        autoscaler: Optional[_Autoscaler] = None,
+        memory_gate: Optional[_MemoryGate] = None,
+        cache: Optional[Cache] = None,
+        schedule: Union[None, str, Callable[..., float]] = None,
+        timeout: Optional[float] = None,
+        call_timeout: Optional[float] = None,
+        retry: Optional[_RetryPolicy] = None,
+        return_failures: bool = False,
+        checkpoint: Optional[_Checkpoint] = None,
+        placement: Optional[_Placement] = None,
+        threads_per_process: int = 1,
+        initializer: Optional[_Initializer] = None,
+        batch_size: Optional[int] = None,
     ):
         """Initialize the decorator
 
         :param function: function to decorate
         :param Process: Process/thread class
         :param Queue: Queue class
-        :param Semaphore: Semaphore class
         :param n_workers: Total number of workers to use
         :param progress_bar: Whether to show a progress bar
         :param ignore_errors: Return `None` when an error is encountered
+        :param chunksize: Number of tasks to send to a worker at once, or "auto" to
+        send large chunks first and smaller chunks towards the end
+        :param type_check: Which items of a list to check against the type hint, one of
+        "full", "sampled", "first" or "off"
+        :param shared_memory: Pass numpy arrays to the processes through shared memory
+        :param stats: Function that receives the CallStats after every call, None to
+        not record any statistics
+        :param autoscaler: Adjusts the number of workers during a call, None for a fixed
+        number of workers
+        :param memory_gate: Delays the start of tasks until there is enough memory
+        available, None to start them right away
+        :param cache: Cache to look up the outputs of the tasks in, None to always run
+        the tasks
+        :param schedule: Function that returns the cost of a task given its arguments,
+        or "history" to use the run times of earlier calls with the same items. The
+        most expensive tasks are submitted first. None to submit them in order.
+        :param timeout: Seconds a single task may run, after which its worker is stopped
+        and its output becomes a TimeoutError. None for no limit.
+        :param call_timeout: Seconds a call may take, after which all its tasks are
+        stopped and the call raises a TimeoutError. None for no limit.
+        :param retry: Policy to run failed tasks again, None to not retry them
+        :param return_failures: Return the outputs together with a list of the tasks
+        that failed instead of raising the first error
+        :param checkpoint: Store of the outputs of earlier calls that did not finish,
+        None to always run all the tasks
+        :param placement: Cores to pin the worker processes to, None to let the
+        operating system schedule them
+        :param threads_per_process: Number of threads every worker process runs, every
+        thread counts as a worker. Ignored for threads.
+        :param initializer: Sets up the context of every worker, None for no context
+        :param batch_size: Number of items of the loop parameters to pass to the
+        function at once, as slices of the input. The function returns a list of
+        outputs for every batch. None to pass the items one by one.
         """
         self._Process = Process
         self._Queue = Queue
-        self._Semaphore = Semaphore
         self._function = function
         self.n_workers = n_workers
         self._params = inspect.signature(self._function).parameters
         self._progress_bar = progress_bar
         self._is_listy = lambda x: isinstance(x, list) or isinstance(x, tuple)
+        self._is_iterator = lambda x: isinstance(x, collections.abc.Iterator)
         self._ignore_errors = ignore_errors
+        self._chunksize = chunksize
+        self._type_check = type_check
+        self._type_cache = {}
+        self._shared_memory = shared_memory and Process != threading.Thread
+        self._shared_inputs = []
+        self._stats = stats
+        self._autoscaler = autoscaler
+        self._memory_gate = memory_gate
+        self._cache = cache
+        self._schedule = schedule
+        self._timeout = timeout
+        self._call_timeout = call_timeout
+        self._retry = retry
+        self._return_failures = return_failures
+        self._checkpoint = checkpoint
+        self._placement = placement
+        self._threads = threads_per_process if Process != threading.Thread else 1
+        self._initializer = initializer
+        self._batch_size = batch_size
+        self._cancel = threading.Event()
+        self._history = collections.OrderedDict()
+        self._history_lock = threading.Lock()
+        self._pools = _PoolSet()
+        self._pool = None
 
     @property
     def __signature__(self):
@@ -93,6 +196,14 @@ class _Autothread:
     def __call__(self, *args, **kwargs):
         """Call the function
 
+        :param args: Arguments to forward to the function
+        :param kwargs: Keyword argumented to forward
+        """
+        return self._invocation()._call(args, kwargs)
+
+    def _call(self, args: Tuple, kwargs: Dict):
+        """Call the function within an invocation
+
         :param args: Arguments to forward to the function
         :param kwargs: Keyword argumented to forward
         """
@@ -102,21 +213,365 @@ class _Autothread:
             return self._function(*args, **kwargs)
 
         results = {}
-        for i, args, kwargs in self._contruct_args():
-            self._sema.acquire()
-            p = self._Process(target=_queuer, args=args, kwargs=self._extra_kwargs)
-            p.start()
-            self._processes.append(p)
-            if i >= self.n_workers and self.n_workers >= 0:
-                results.update(self._collect_result())
+        for outputs in self._iter_results(ordered=False):
+            results.update(outputs)
+        results = [results[i] for i in range(len(results))]
+        if not self._return_failures:
+            return results
+        # The items of a batch share the failure of the batch
+        failures = {id(r): r for r in results if isinstance(r, TaskFailure)}
+        results = [None if isinstance(r, TaskFailure) else r for r in results]
+        return results, list(failures.values())
+
+    def imap(self, *args, **kwargs):
+        """Call the function and yield the outputs in order as soon as they are ready
+
+        Outputs that are ready before the outputs in front of them are kept in a reorder
+        buffer. This buffer is bounded, no new tasks are started while it is full.
+        Stopping the iteration early interrupts the tasks that are still running.
+
+        :param args: Arguments to forward to the function
+        :param kwargs: Keyword argumented to forward
+        """
+        yield from self._invocation()._imap(args, kwargs, ordered=True)
+
+    def imap_unordered(self, *args, **kwargs):
+        """Call the function and yield the outputs in the order they are ready
+
+        Stopping the iteration early interrupts the tasks that are still running.
+
+        :param args: Arguments to forward to the function
+        :param kwargs: Keyword argumented to forward
+        """
+        yield from self._invocation()._imap(args, kwargs, ordered=False)
+
+    def _invocation(self) -> "_Autothread":
+        """Create the context of a single call
+
+        The state of a call (its arguments, loop parameters, progress bar, pool, ...)
+        is stored on a shallow copy of the decorator, such that calls from different
+        threads do not overwrite each other's state. The configuration, the pools, the
+        cache and the history stay shared with the decorator.
+        """
+        invocation = copy.copy(self)
+        invocation._cancel = threading.Event()
+        invocation._pool = None
+        return invocation
+
+    def _imap(self, args: Tuple, kwargs: Dict, ordered: bool):
+        """Call the function and yield the outputs one by one
 
-        while self._processes:
-            results.update(self._collect_result())
+        :param args: Arguments to forward to the function
+        :param kwargs: Keyword argumented to forward
+        :param ordered: Whether to yield the outputs in the order of the input
+        """
+        self._setup(args, kwargs)
+
+        if not self._loop_params:  # just run the function as normal
+            yield self._function(*args, **kwargs)
+            return
 
+        for outputs in self._iter_results(ordered):
+            for _, content in outputs:
+                yield content
+
+    def _iter_results(self, ordered: bool):
+        """Submit the tasks and yield the [(index, output)] of each chunk once it is done
+
+        The chunks are only read from the input when they can be submitted. In ordered
+        mode, chunks that finish early are kept in a buffer until all the chunks in
+        front of them are yielded. The buffer holds at most as many chunks as can be
+        pending, so the memory usage stays bounded when a chunk is slow (unless the
+        chunks are scheduled by cost). A chunk that
+        does not fit in the available memory waits until a running chunk is done.
+        Outputs that are found in the cache are yielded without submitting them.
+
+        :param ordered: Whether to yield the chunks in the order of the input
+        """
+        self._budget, self._slots = _current(), 0
+        self._no_slot = self._no_room = False
+        pool = self._get_pool()
+        chunks = self._contruct_args()
+        self._task_stats, spawn_time = [], pool.spawn_time
+        buffered, next_index, exhausted = {}, 0, False
+        waiting, reserved, memory_wait, cache_hits = None, {}, 0.0, 0
+        self._cache_keys, self._history_keys, self._items = {}, {}, {}
+        self._checkpoint_keys, self._batch_lengths = {}, {}
+        # [(index, key)] of all the tasks in the checkpoint, to delete them at the end
+        self._checkpointed = []
+        self._expired, self._terminate = [], False
+        self._deadline = None
+        if self._call_timeout is not None:
+            self._deadline = time.perf_counter() + self._call_timeout
+        self._pools.invocations.add(self)
+        try:
+            while True:
+                outputs = None
+                max_pending = self._max_pending()
+                # Scheduled chunks are not submitted in order, so they are not buffered
+                # in order either and the buffer can not be bounded
+                max_buffered = max_pending if self._schedule is None else float("inf")
+                if (
+                    not exhausted
+                    and pool.n_pending < max_pending
+                    and len(buffered) < max_buffered
+                ):
+                    if waiting is None:
+                        waiting = next(chunks, None)
+                        exhausted = waiting is None
+                    if waiting is not None and waiting[3]:
+                        outputs, waiting = waiting[0], None
+                        cache_hits += len(outputs)
+                        if self._progress_bar:
+                            self._tqdm.update(len(outputs))
+                    elif (
+                        waiting is not None
+                        and self._admit(waiting, reserved, pool)
+                        and self._submit(pool, waiting[0], max_pending)
+                    ):
+                        chunk, need, blocked, _ = waiting
+                        if blocked is not None:
+                            memory_wait += time.perf_counter() - blocked
+                        reserved[chunk[0][0]] = need
+                        waiting = None
+                        continue
+
+                if outputs is None:
+                    if not pool.n_pending and not self._expired:
+                        if waiting is None:
+                            break
+                        self._check_stopped()
+                        if (self._no_slot or self._no_room) and _in_worker():
+                            # The task that made this call lends its worker to it, the
+                            # other workers may all be waiting for calls like this one
+                            outputs = self._run_inline(waiting[0])
+                            waiting = None
+                        else:
+                            # No running chunk of this call can free memory or workers,
+                            # wait for other programs or other calls
+                            self._wait_for_room()
+                            continue
+                    else:
+                        outputs = self._next_outputs(pool)
+                        if outputs is None:
+                            continue
+                        self._release_slots(keep=pool.n_pending)
+                        self._pools.notify()
+                    outputs = self._collect_result(outputs)
+                    # A chunk whose task timed out returns in parts
+                    for index, _ in outputs:
+                        reserved.pop(index, None)
+
+                if self._batch_size is not None:
+                    outputs = self._unbatch(outputs)
+                if not ordered:
+                    yield outputs
+                    continue
+
+                for run in self._consecutive_runs(outputs):
+                    buffered[run[0][0]] = run
+                while next_index in buffered:
+                    outputs = buffered.pop(next_index)
+                    next_index += len(outputs)
+                    yield outputs
+        except BaseException:
+            # Stop the tasks that are still running, also when the call is interrupted
+            # or the caller stops iterating
+            try:
+                self._kill_all(hard=self._terminate)
+            except KeyboardInterrupt:
+                # The main thread can accidentally be killed on some platforms
+                pass
+            raise
+        finally:
+            self._shared_inputs = []
+            self._release_slots(keep=0)
+            self._pools.invocations.discard(self)
+            if self._pool is not None:
+                self._pools.release(self._pool)
+                self._pool = None
+            if self._checkpoint is not None:
+                self._checkpoint.flush()
+
+        if self._checkpoint is not None:
+            # Nothing is left to resume
+            self._checkpoint.clear(self._checkpointed)
         if self._progress_bar:
             self._tqdm.close()
+        if self._stats is not None:
+            self._stats(
+                CallStats(
+                    tasks=sorted(self._task_stats, key=lambda task: task.index),
+                    wall_time=time.perf_counter() - self._started,
+                    type_check_time=self._type_check_time,
+                    spawn_time=pool.spawn_time - spawn_time,
+                    memory_wait=memory_wait,
+                    cache_hits=cache_hits,
+                )
+            )
 
-        return [v[1] for v in sorted(results.items())]
+    @staticmethod
+    def _consecutive_runs(outputs: List[Tuple[int, Any]]):
+        """Split the [(index, output)] of a chunk into runs of consecutive indices
+
+        :param outputs: Outputs of a chunk
+        """
+        start = 0
+        for i in range(1, len(outputs) + 1):
+            if i == len(outputs) or outputs[i][0] != outputs[i - 1][0] + 1:
+                yield outputs[start:i]
+                start = i
+
+    def shutdown(self):
+        """Stop the workers of this function
+
+        The workers are kept alive in between calls, so they do not have to be started
+        again for every call. They are started again when the function is called after
+        shutting down.
+        """
+        self._pools.shutdown()
+
+    def _admit(self, waiting: List, reserved: Dict[int, float], pool) -> bool:
+        """Check if a chunk can be submitted without running out of memory
+
+        The time the chunk was first refused is stored in `waiting`.
+
+        :param waiting: [chunk, megabytes it needs, time it was first refused or None,
+        whether the chunk holds cached outputs]
+        :param reserved: {index of the first task: megabytes} of the pending chunks
+        :param pool: Pool the chunk is submitted to
+        """
+        if self._memory_gate is None:
+            return True
+        if self._memory_gate.admit(waiting[1], sum(reserved.values()), pool.pids):
+            return True
+        waiting[2] = waiting[2] or time.perf_counter()
+        return False
+
+    def _max_pending(self) -> Union[int, float]:
+        """Maximum number of chunks that are submitted before waiting for a result
+
+        Loop parameters are read lazily, so only the chunks that can be picked up by a
+        worker are read ahead. Without a limit on the workers, all the chunks are
+        submitted right away, unless the length of the input is unknown. When
+        autoscaling, the limit follows the autoscaler and the pool may start workers up
+        to that limit. Surplus workers stay idle until the limit is raised again. Every
+        thread of a worker process picks up its own chunk.
+        """
+        if self._autoscaler is not None:
+            self._pool.n_workers = self._autoscaler.target()
+            return self._pool.n_workers * self._threads
+        if self.n_workers > 0:
+            return self.n_workers * self._threads
+        elif self._n_tasks is None:
+            return mp.cpu_count() * self._threads
+        return float("inf")
+
+    def _get_pool(self) -> _Channel:
+        """Open a channel of the pool for this call, it is closed when the call is done
+
+        Worker processes are started with the budget of `autothread.limit`, so a call
+        with another budget needs other processes.
+        """
+        key = None if self._Process == threading.Thread else self._budget
+        self._pool = self._pools.acquire(self._new_pool, key)
+        return self._pool
+
+    def _submit(self, pool: _Channel, chunk: List, limit):
+        """Submit a chunk if the other calls and `autothread.limit` leave room for it
+
+        Every submitted chunk takes a slot of the budget of `autothread.limit`, the
+        slots are handed back as the outputs arrive.
+
+        :param pool: Channel of this call
+        :param chunk: Chunk to submit
+        :param limit: Maximum number of chunks pending over all the calls
+        :return: Whether the chunk was submitted
+        """
+        self._no_slot = self._budget is not None and not self._budget.acquire()
+        self._no_room = False
+        if self._no_slot:
+            return False
+        self._no_room = not self._pools.submit(pool, chunk, limit)
+        if self._no_room:
+            if self._budget is not None:
+                self._budget.release()
+            return False
+        self._slots += self._budget is not None
+        return True
+
+    def _release_slots(self, keep: int):
+        """Hand back the slots of the chunks that are done
+
+        :param keep: Number of slots to keep, one for every pending chunk
+        """
+        if self._slots > keep:
+            self._budget.release(self._slots - keep)
+            self._slots = keep
+
+    def _wait_for_room(self):
+        """Wait until a slot, memory or room for another chunk may be available"""
+        interval = self._poll_interval
+        if self._memory_gate is not None:
+            interval = self._memory_gate.interval
+        if self._no_slot:
+            if self._budget.acquire(timeout=interval):
+                self._budget.release()  # taken again when the chunk is submitted
+        else:
+            self._pools.wait(interval)
+
+    def _run_inline(self, chunk: List) -> List:
+        """Run the tasks of a chunk in the calling thread
+
+        The calling thread is not a worker of this function, the context of the
+        initializer is set up for the chunk and torn down afterwards.
+
+        :param chunk: List of (index, args, kwargs) tasks
+        :return: [(index, output, None)] of the tasks
+        """
+        outputs = []
+        with (self._initializer or _Initializer()).run() as failed:
+            for index, args, kwargs in chunk:
+                try:
+                    if failed is not None:
+                        raise failed
+                    if self._shared_memory:
+                        args = [_attach(arg) for arg in args]
+                        kwargs = {k: _attach(v) for k, v in kwargs.items()}
+                    output = _attempt(self._function, args, kwargs, self._retry, None)
+                except Exception as e:
+                    e.autothread_intercepted = True
+                    output = e
+                outputs.append((index, output, None))
+        return outputs
+
+    def _new_pool(self) -> Union[_WorkerPool, _CoroutinePool]:
+        """Create a pool, coroutine functions run on an event loop instead of workers"""
+        if self._Process == threading.Thread and inspect.iscoroutinefunction(
+            self._function
+        ):
+            return _CoroutinePool(
+                self._function,
+                self.n_workers,
+                stats=self._stats is not None or self._schedule == "history",
+                timeout=self._timeout,
+                retry=self._retry,
+                initializer=self._initializer,
+            )
+        return _WorkerPool(
+            function=self._function,
+            Process=self._Process,
+            Queue=self._Queue,
+            n_workers=self.n_workers,
+            shared_memory=self._shared_memory,
+            stats=self._stats is not None or self._schedule == "history",
+            timeout=self._timeout,
+            retry=self._retry,
+            budget=self._budget,
+            placement=self._placement,
+            threads=self._threads,
+            initializer=self._initializer,
+        )
 
     def _setup(self, args: Tuple, kwargs: Dict):
         """Setup the multiprocessing variables and arguments
@@ -124,13 +579,23 @@ class _Autothread:
         :param args: Arguments to forward to the function
         :param kwargs: Keyword argumented to forward
         """
-        self._queue = self._Queue()
-        self._processes = []
-        self._sema = self._Semaphore(self.n_workers if self.n_workers > 0 else int(1e9))
+        self._started = time.perf_counter()
         self._loop_params = kwargs.pop("_loop_params", [])
+        self._unchecked = {}
         self._merge_args(args, kwargs)
         self._loop_params = self._get_loop_params(self._loop_params)
         self._verify_loop_params(self._loop_params)
+        self._type_check_time = time.perf_counter() - self._started
+        self._n_tasks = next(
+            (
+                self._arg_lengths[param]
+                for param in self._loop_params
+                if self._arg_lengths[param] is not None
+            ),
+            None,
+        )
+        if self._batch_size is not None:
+            self._n_tasks = self._n_batches()
 
     def _merge_args(self, args: Tuple, kwargs: Dict):
         """Merge args into kwargs
@@ -168,7 +633,11 @@ class _Autothread:
         If '_loop_params' is not defined, we will determine which parameters should be
         split into the threads by checking the values against their type hints. If a
         list is provided whose contents match the original type hint, we will assume
-        that this parameter needs to be split into the separate threads.
+        that this parameter needs to be split into the separate threads. Iterators
+        (e.g. generators) are not read in advance: an iterator that does not match the
+        type hint itself is split, its first item is checked once it is read (see
+        `_check_first`). Iterators of parameters without a type hint, like a file
+        handle, are passed to every task as they are.
 
         :param loop_params: Override list of loop_parameters provided by user
         """
@@ -189,12 +658,17 @@ class _Autothread:
                 warnings.warn(_type_warning.format(k=k), stacklevel=5)
                 continue
             type_hint = self._params[k].annotation
+            iterator = type_hint != inspect._empty and self._is_iterator(v["value"])
             if self._checks_type(v["value"], type_hint):
                 pass
-            elif self._is_listy(v["value"]) and all(
-                self._checks_type(_v, type_hint) for _v in v["value"]
+            elif self._is_listy(v["value"]) and self._items_check_type(
+                k, v["value"], type_hint
             ):
                 loop_params.append(k)
+            elif iterator:
+                loop_params.append(k)
+                if self._type_check != "off":
+                    self._unchecked[k] = type_hint
             elif self._is_listy(v["value"]):
                 warnings.warn(_type_warning.format(k=k), stacklevel=5)
             elif (
@@ -222,7 +696,7 @@ class _Autothread:
 
         The loop parameters are valid if:
         1) They are all provided by the user
-        2) They are all of the same length
+        2) They are all of the same length (iterators are verified while reading them)
 
         :param loop_params: List of loop_parameters provided by _get_loop_params
         """
@@ -233,41 +707,358 @@ class _Autothread:
                     "exist for this function or is not provided. Choose one "
                     f"of {list(self._kwargs)}"
                 )
-        if any(
-            self._arg_lengths[param] != self._arg_lengths[loop_params[0]]
-            for param in loop_params
-        ):
-            raise IndexError(
-                f"Input for parallelization is ambiguous. {loop_params} are "
-                "all lists but are of different lengths. It is possible that the type "
-                "hints of this function are incorrect. If they are not, use the "
-                "`_loop_params` keyword argument to specify the parameters to "
-                "parallelize for."
-            )
+        lengths = [self._arg_lengths[param] for param in loop_params]
+        if len(set(length for length in lengths if length is not None)) > 1:
+            raise IndexError(self._length_error.format(loop_params=loop_params))
         return loop_params
 
     def _contruct_args(self):
         """Contruct arguments and keyword arguments for each thread/process
 
         For each argument, extract an item if it is in the loop_params or just select
-        the value and put them in tuples and dicts to forward to the function.
-        """
-        n_threads = self._arg_lengths[self._loop_params[0]]
+        the value and put them in tuples and dicts to forward to the function. The
+        tasks are yielded in chunks, each chunk is processed by a worker in one go.
+        The loop parameters are only read when the chunk is constructed.
 
+        Tasks whose output is in the cache are split off into chunks of their own, that
+        hold the [(index, output)] of the tasks instead. With a schedule, all the items
+        are read first and the most expensive tasks are put in the first chunks.
+        """
         if self._progress_bar:
-            self._tqdm = tqdm(total=n_threads)
-
-        for i in range(n_threads):
-            args = [self._queue, self._function, self._sema, i, True]
-            for k, v in self._kwargs.items():
-                value = v["value"][i] if k in self._loop_params else v["value"]
-                if v["is_kwarg"]:
-                    self._extra_kwargs[k] = value
+            self._tqdm = tqdm(total=self._n_tasks)
+        if self._shared_memory:
+            self._share_constants()
+
+        if self._batch_size is None:
+            items = enumerate(self._loop_items())
+        else:
+            items = enumerate(self._loop_batches())
+        if self._schedule is not None:
+            items = iter(self._by_cost(list(items)))
+        for size in self._chunk_sizes(self._n_tasks):
+            self._chunk_need, chunk, cached = 0, [], False
+            for i, item in itertools.islice(items, size):
+                args, kwargs = self._task_args(item)
+                output = self._cached_output(i, args, kwargs)
+                if self._return_failures and output is _MISS:
+                    self._items[i] = item
+                if chunk and cached != (output is not _MISS):
+                    yield self._finish_chunk(chunk, cached)
+                    chunk = []
+                cached = output is not _MISS
+                if cached:
+                    chunk.append((i, output))
                 else:
-                    args.append(value)
-            args.extend(self._extra_args)
+                    chunk.append(self._contruct_task(i, args, kwargs))
+            if not chunk:
+                return
+            yield self._finish_chunk(chunk, cached)
 
-            yield i, args, self._extra_kwargs
+    def _by_cost(self, items: List[Tuple[int, Dict]]) -> List[Tuple[int, Dict]]:
+        """Sort the (index, item) of the tasks by their cost, most expensive first
+
+        Scheduling the longest tasks first keeps a slow task at the end of the list
+        from running on its own while the other workers are idle. With "history", the
+        cost of an item is its last run time, items that did not run before get the
+        average cost of the items that did.
+
+        :param items: (index, {param: item}) of every task
+        """
+        if self._schedule == "history":
+            keys = [self._history_key(item) for _, item in items]
+            self._history_keys = dict(zip((i for i, _ in items), keys))
+            known = [self._history[key] for key in keys if key in self._history]
+            default = sum(known) / len(known) if known else 0
+            costs = [self._history.get(key, default) for key in keys]
+        else:
+            costs = []
+            for _, item in items:
+                args, kwargs = self._task_args(item)
+                costs.append(self._schedule(*args, **kwargs))
+        order = sorted(range(len(items)), key=lambda i: -costs[i])
+        return [items[i] for i in order]
+
+    def _history_key(self, item: Dict) -> Any:
+        """Key to look up the run time of an item in the history, None if unhashable
+
+        :param item: {param: item} dict of the items of the loop parameters
+        """
+        key = tuple(item.values())
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _remember_run_time(self, index: int, run_time: float):
+        """Store the run time of a task in the history
+
+        The history holds at most `_history_size` items, the least recently used items
+        are forgotten first.
+
+        :param index: Index of the task
+        :param run_time: Seconds it took to run the task
+        """
+        key = self._history_keys.pop(index, None)
+        if key is None:
+            return
+        with self._history_lock:
+            self._history[key] = run_time
+            self._history.move_to_end(key)
+            while len(self._history) > self._history_size:
+                self._history.popitem(last=False)
+
+    def _finish_chunk(self, chunk: List, cached: bool) -> List:
+        """Return the [chunk, megabytes it needs, None, cached] to submit a chunk
+
+        :param chunk: Tasks of the chunk, or [(index, output)] of cached tasks
+        :param cached: Whether the chunk holds cached outputs
+        """
+        # The tasks of a chunk run one after the other
+        need, self._chunk_need = self._chunk_need, 0
+        return [chunk, need, None, cached]
+
+    def _cached_output(self, i: int, args: List, kwargs: Dict) -> Any:
+        """Look up the output of a task in the checkpoint and the cache
+
+        The keys of a task that is not found are kept to store its output later.
+
+        :param i: Index of the task
+        :param args: Arguments of the task
+        :param kwargs: Keyword arguments of the task
+        :return: The output, `_MISS` if the task must run
+        """
+        if self._checkpoint is not None:
+            key = self._checkpoint.key(args, kwargs)
+            if key is not None:
+                self._checkpointed.append((i, key))
+                output = self._checkpoint.get(i, key)
+                if output is not _MISS:
+                    return output
+                self._checkpoint_keys[i] = key
+        if self._cache is None:
+            return _MISS
+        key = self._cache._key(self._function, args, kwargs)
+        if key is None:
+            return _MISS
+        output = self._cache._get(key)
+        if output is _MISS:
+            self._cache_keys[i] = key
+        return output
+
+    def _loop_items(self):
+        """Yield a {param: item} dict with the next item of every loop parameter"""
+        iterators = [iter(self._kwargs[param]["value"]) for param in self._loop_params]
+        exhausted, first = object(), True
+        while True:
+            items = [next(iterator, exhausted) for iterator in iterators]
+            if all(item is exhausted for item in items):
+                return
+            if any(item is exhausted for item in items):
+                raise IndexError(
+                    self._length_error.format(loop_params=self._loop_params)
+                )
+            item = dict(zip(self._loop_params, items))
+            if first:
+                self._check_first(item)
+                first = False
+            yield item
+
+    def _check_first(self, item: Dict):
+        """Check the first item of the iterators of the loop parameters
+
+        Reading an item takes it from the iterator of the caller, so the iterator can
+        not be passed on as a constant anymore when the item does not match. The call
+        fails before any task runs instead.
+
+        :param item: {param: item} dict of the first items of the loop parameters
+        """
+        for k, type_hint in self._unchecked.items():
+            if not self._checks_type(item[k], type_hint):
+                raise TypeError(
+                    f"The first item of {k} does not match its type hint {type_hint}. "
+                    f"Use the `_loop_params` keyword argument to parallelize for {k} "
+                    "anyway, or a type hint that the iterator itself matches (e.g. "
+                    "`Iterator`) to pass it to every task."
+                )
+
+    def _n_batches(self) -> Optional[int]:
+        """Number of batches, None if the length of the input is unknown
+
+        Loop parameters that are not lists or tuples, like numpy arrays, count as well
+        when they have a length.
+        """
+        for param in self._loop_params:
+            value = self._kwargs[param]["value"]
+            if not self._is_iterator(value) and hasattr(value, "__len__"):
+                return -(-len(value) // self._batch_size)
+        return None
+
+    def _loop_batches(self):
+        """Yield a {param: slice} dict with the next `batch_size` items of every loop
+        parameter
+
+        Lists, tuples and numpy arrays are sliced, so a batch of a numpy array is a view
+        instead of a copy. The items of iterators are collected in lists. The batches
+        are numbered like the tasks, `_batch_lengths` keeps their number of items.
+        """
+        values = [self._kwargs[param]["value"] for param in self._loop_params]
+        if any(self._is_iterator(value) for value in values):
+            items = self._loop_items()
+            for number in itertools.count():
+                batch = list(itertools.islice(items, self._batch_size))
+                if not batch:
+                    return
+                self._batch_lengths[number] = len(batch)
+                yield {k: [item[k] for item in batch] for k in self._loop_params}
+        if len(set(len(value) for value in values)) > 1:
+            raise IndexError(self._length_error.format(loop_params=self._loop_params))
+        starts = range(0, len(values[0]), self._batch_size)
+        for number, start in enumerate(starts):
+            stop = min(start + self._batch_size, len(values[0]))
+            self._batch_lengths[number] = stop - start
+            yield dict(zip(self._loop_params, (v[start:stop] for v in values)))
+
+    def _unbatch(self, outputs: List[Tuple[int, Any]]) -> List[Tuple[int, Any]]:
+        """Split the [(index, output)] of batches into the outputs of their items
+
+        A batch that failed (or returned None) gives its failure (or None) to each of
+        its items.
+
+        :param outputs: [(index of the batch, list of outputs)] of a chunk
+        :return: [(index of the item, output)]
+        """
+        results = []
+        for index, content in outputs:
+            length = self._batch_lengths.pop(index)
+            if content is None or isinstance(content, TaskFailure):
+                content = [content] * length
+            elif not hasattr(content, "__len__") or len(content) != length:
+                got = len(content) if hasattr(content, "__len__") else type(content)
+                raise ValueError(
+                    f"{self._function.__name__} must return a list with an output for "
+                    f"every item of a batch, expected {length} outputs but got {got}"
+                )
+            start = index * self._batch_size
+            results.extend(zip(range(start, start + length), content))
+        return results
+
+    def _task_args(self, item: Dict) -> Tuple[List, Dict]:
+        """Contruct the args and kwargs of a single task
+
+        :param item: {param: item} dict of the items of the loop parameters
+        """
+        args = []
+        for k, v in self._kwargs.items():
+            value = item[k] if k in item else v["value"]
+            if v["is_kwarg"]:
+                self._extra_kwargs[k] = value
+            else:
+                args.append(value)
+        args.extend(self._extra_args)
+        return args, dict(self._extra_kwargs)
+
+    def _contruct_task(
+        self, i: int, args: List, kwargs: Dict
+    ) -> Tuple[int, List, Dict]:
+        """Contruct the (index, args, kwargs) of a single task that is submitted
+
+        :param i: Index of the task
+        :param args: Arguments of the task
+        :param kwargs: Keyword arguments of the task
+        """
+        if self._memory_gate is not None:
+            need = self._memory_gate.need(args, kwargs)
+            self._chunk_need = max(self._chunk_need, need)
+        if self._shared_memory:
+            share = lambda value: _share(value, self._shared_inputs)
+            args = [share(value) for value in args]
+            kwargs = {k: share(v) for k, v in kwargs.items()}
+
+        return i, args, kwargs
+
+    def _share_constants(self):
+        """Replace the numpy arrays that are passed to every task by shared memory
+
+        The arrays are put in shared memory once per call, the tasks only receive a
+        small descriptor of the array. Copies that are made for this call are kept
+        alive until all its tasks are done.
+        """
+        self._shared_inputs = []
+        share = lambda value: _share(value, self._shared_inputs)
+        for k, v in self._kwargs.items():
+            if k not in self._loop_params:
+                v["value"] = share(v["value"])
+        self._extra_args = [share(value) for value in self._extra_args]
+        self._extra_kwargs = {k: share(v) for k, v in self._extra_kwargs.items()}
+
+    def _chunk_sizes(self, n_tasks: Optional[int]):
+        """Yield the number of tasks to put in each chunk
+
+        With chunksize="auto", every chunk gets a share of the remaining tasks. The
+        chunks start large to keep the number of round-trips low and shrink towards the
+        end of the list, such that all the workers stay busy until the last task. When
+        the number of tasks is unknown, "auto" sends the tasks one by one.
+
+        :param n_tasks: Total number of tasks, None if unknown
+        """
+        if n_tasks is None:
+            yield from itertools.repeat(
+                1 if self._chunksize == "auto" else self._chunksize
+            )
+            return
+
+        remaining = n_tasks
+        while remaining:
+            if self._chunksize == "auto":
+                n_workers = self.n_workers * self._threads
+                n_workers = n_workers if n_workers > 0 else remaining
+                size = max(1, remaining // (2 * n_workers))
+            else:
+                size = min(self._chunksize, remaining)
+            yield size
+            remaining -= size
+
+    def _items_check_type(self, k: str, values: Union[List, Tuple], type_hint) -> bool:
+        """Check if the items of a list or tuple correspond to a type hint
+
+        Depending on `type_check`, all the items, an evenly spaced sample of the items,
+        the first item or none of the items are checked. If the type hint is a class (or
+        a Union of classes), the outcome only depends on the type of the item. In that
+        case only one item per type is checked and the outcome is cached for the next
+        calls.
+
+        :param k: Name of the parameter
+        :param values: List or tuple with the items to check
+        :param type_hint: Type hint to validate
+        """
+        if self._type_check == "off" or not values:
+            return True
+        elif self._type_check == "first":
+            values = values[:1]
+        elif self._type_check == "sampled":
+            values = values[:: max(1, len(values) // self._n_type_samples)]
+
+        if not self._is_class_hint(type_hint):
+            return all(self._checks_type(_v, type_hint) for _v in values)
+
+        for item_type, item in dict(zip(map(type, values), values)).items():
+            key = (k, type(values), item_type)
+            if key not in self._type_cache:
+                self._type_cache[key] = self._checks_type(item, type_hint)
+            if not self._type_cache[key]:
+                return False
+        return True
+
+    def _is_class_hint(self, type_hint) -> bool:
+        """Check if a type hint is a class or a Union of classes
+
+        :param type_hint: Type hint to inspect
+        """
+        origin = getattr(type_hint, "__origin__", None)
+        if origin is Union:
+            return all(self._is_class_hint(arg) for arg in type_hint.__args__)
+        return origin is None and isinstance(type_hint, type)
 
     def _checks_type(self, value, type_hint):
         """Check if a value corresponds to a type hint
@@ -281,55 +1072,113 @@ class _Autothread:
         except typeguard.TypeCheckError:
             return False
 
-    def _collect_result(self):
-        """Collect the results from the queue and raise possible errors
+    def _next_outputs(self, pool: _Channel) -> Optional[List]:
+        """Wait for the [(index, output, stats)] of the next chunk
+
+        With a timeout, the pool is checked for tasks that take too long in between
+        waiting for the outputs. Those tasks are stopped and their TimeoutError is
+        returned as output.
+
+        :param pool: Channel to collect the outputs from
+        :return: None if nothing arrived yet, the caller should check again
+        """
+        self._check_stopped()
+        if pool.timeout is not None:
+            self._expired.extend(pool.expire())
+        if self._expired:
+            return self._expired.pop(0)
+        if pool.timeout is None and self._deadline is None:
+            return pool.get()
+        return pool.get(self._poll_interval)
+
+    def _check_stopped(self):
+        """Raise an error if the call was cancelled or took too long"""
+        if self._cancel.is_set():
+            self._terminate = True
+            raise CancelledError("The call was cancelled")
+        if self._deadline is not None and time.perf_counter() > self._deadline:
+            self._terminate = True
+            raise TimeoutError(
+                f"The call did not finish within {self._call_timeout} seconds"
+            )
+
+    def cancel(self):
+        """Stop the calls that are running, they raise a `CancelledError`
+
+        This can be called from another thread. The processes are killed and the
+        threads are abandoned, they can see that they are cancelled with
+        `autothread.cancelled()`. New workers are started on the next call.
+        """
+        for invocation in list(self._pools.invocations):
+            invocation._cancel.set()
+            pool = invocation._pool
+            if pool is not None:
+                pool.wake()
+
+    def _collect_result(self, outputs: List):
+        """Process the outputs of a chunk and raise possible errors
 
         The queue does not return items in order if the processing times are different
-        for different parameters. The queue will return (N, output) where N is its
-        original place in the queue that must be sorted.
+        for different parameters. The queue will return the [(N, output, stats)] of a
+        chunk where N is its original place in the queue, which is used to place the
+        output in the results. The stats of the tasks are kept for the CallStats and the
+        outputs are stored in the cache.
+
+        :param outputs: [(index, output, stats)] of a chunk
         """
-        while self._processes:
-            for process in self._processes:
-                if process.is_alive():
-                    continue
 
-                process.join()
-                self._processes.remove(process)
+        if self._progress_bar:
+            self._tqdm.update(len(outputs))
+
+        results = []
+        for position, (index, content, task_stats) in enumerate(outputs):
+            if task_stats is not None:
+                self._task_stats.append(task_stats)
+                if self._schedule == "history":
+                    self._remember_run_time(index, task_stats.run_time)
+            key = self._cache_keys.pop(index, None)
+            checkpoint_key = self._checkpoint_keys.pop(index, None)
+            item = self._items.pop(index, None)
+            if isinstance(content, Exception) and getattr(
+                content, "autothread_intercepted", False
+            ):
+                if self._return_failures:
+                    attempts = getattr(content, "autothread_attempts", 1)
+                    first = index
+                    if self._batch_size is not None:
+                        first = index * self._batch_size
+                    content = TaskFailure(first, item, content, attempts)
+                elif not self._ignore_errors:
+                    if self._shared_memory:
+                        # The outputs after the error are never attached
+                        for _, rest, _ in outputs[position + 1 :]:
+                            _discard(rest)
+                    raise content
+                else:
+                    content = None
+            else:
+                if self._shared_memory:
+                    content = _attach(content)
+                if key is not None:
+                    self._cache._put(key, content)
+                if checkpoint_key is not None:
+                    self._checkpoint.put(index, checkpoint_key, content)
+            results.append((index, content))
+        return results
 
-                if self._progress_bar:
-                    self._tqdm.update(1)
+    def _kill_all(self, hard: bool = False):
+        """Stop the running tasks of this call, see `_WorkerPool.stop`
 
-                res = self._queue.get()
-                content = list(res.values())[0]
-                if isinstance(content, Exception) and getattr(
-                    content, "autothread_intercepted", False
-                ):
-                    try:
-                        self._kill_all()
-                    except KeyboardInterrupt:
-                        # The main thread can accidentally be killed on some platforms
-                        pass
-                    if self._ignore_errors:
-                        return {list(res)[0]: None}
-                    else:
-                        raise content
-                return res
-
-    def _kill_all(self):
-        """Terminates all running processes by sending them a keyboard interrupt"""
-        if self._Process == threading.Thread:
-            p_names = [p.name for p in self._processes]
-            for id, thread in threading._active.copy().items():
-                if thread.name in p_names:
-                    ctypes.pythonapi.PyThreadState_SetAsyncExc(
-                        ctypes.c_long(id),
-                        ctypes.py_object(KeyboardInterrupt),
-                    )
-        else:
-            for process in self._processes:
-                try:
-                    os.kill(process.pid, getattr(signal, "CTRL_C_EVENT", signal.SIGINT))
-                except ProcessLookupError:
-                    pass
-        for process in self._processes:
-            process.join()
+        The tasks of other calls that run at the same time keep running. Workers that
+        are stopped are replaced when they are needed.
+
+        :param hard: Kill the processes right away instead, for tasks that may not
+        respond to an interrupt
+        """
+        pool, self._pool = self._pool, None
+        if pool is None:
+            return
+        try:
+            pool.stop(hard)
+        finally:
+            self._pools.release(pool)
@@ -0,0 +1,102 @@
+import multiprocess as mp
+import threading
+
+from typing import Optional
+
+# The budget of the `limit` block that is active in this process, None for no limit
+_budget: Optional["_Budget"] = None
+# Whether the current thread is a worker that runs a task, its slot is already taken
+_local = threading.local()
+
+
+class _Budget:
+    """Slots for the tasks that run at the same time, shared by all the functions
+
+    The slots are a semaphore of the multiprocess module, such that worker processes
+    that were started while the budget was active share the slots with this process.
+    """
+
+    def __init__(self, n_workers: int):
+        """Initialize the budget
+
+        :param n_workers: Maximum number of tasks that run at the same time
+        """
+        self.n_workers = n_workers
+        self._slots = mp.BoundedSemaphore(n_workers)
+
+    def acquire(self, timeout: float = 0) -> bool:
+        """Take a slot, return whether one was free
+
+        :param timeout: Seconds to wait for a free slot
+        """
+        return self._slots.acquire(timeout=timeout)
+
+    def release(self, n: int = 1):
+        """Hand back slots
+
+        :param n: Number of slots
+        """
+        for _ in range(n):
+            self._slots.release()
+
+
+class limit:
+    """Limit the number of tasks that all the decorated functions run at the same time
+
+    Every function sizes its workers on its own, so a multiprocessed function that calls
+    a multithreaded function would otherwise run cores² workers. Inside the block, the
+    tasks of all blocking calls in this process, and in the worker processes that are
+    started inside the block, share `n_workers` slots. A task that calls a decorated
+    function passes its own slot on to that call: the nested call runs its tasks inline
+    in the calling thread when no other slot is free, and uses extra workers when there
+    are. Calls that are not nested wait for a free slot instead.
+
+    Example:
+    ```
+    with autothread.limit(os.cpu_count()):
+        results = outer(items)  # outer calls another decorated function
+    ```
+    """
+
+    def __init__(self, n_workers: int):
+        """Initialize the limit
+
+        :param n_workers: Maximum number of tasks that run at the same time
+        """
+        if not isinstance(n_workers, int) or n_workers < 1:
+            raise ValueError(
+                f"'n_workers' must be a positive integer, not {n_workers!r}"
+            )
+        self._budget = _Budget(n_workers)
+        self._previous = None
+
+    def __enter__(self) -> "limit":
+        global _budget
+        self._previous, _budget = _budget, self._budget
+        return self
+
+    def __exit__(self, *args):
+        global _budget
+        _budget = self._previous
+
+
+def _current() -> Optional[_Budget]:
+    """The budget that is active in this process, None for no limit"""
+    return _budget
+
+
+def _in_worker() -> bool:
+    """Whether the current thread is a worker that runs a task"""
+    return getattr(_local, "worker", False)
+
+
+def _enter_worker(budget: Optional[_Budget]):
+    """Mark the current thread as a worker
+
+    :param budget: Budget of the pool of the worker, it becomes the budget of a worker
+    process. Threads use the budget of their process.
+    """
+    global _budget
+    _local.worker = True
+    if budget is not None:
+        _budget = budget
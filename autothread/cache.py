@@ -0,0 +1,208 @@
+import collections
+import hashlib
+import inspect
+import os
+import pickle
+import threading
+
+from multiprocess.reduction import ForkingPickler
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Returned by `_get` when a key is not cached, None is a valid output
+_MISS = object()
+
+
+def _task_key(
+    function: Callable,
+    args: List,
+    kwargs: Dict,
+    signatures: Dict[Callable, inspect.Signature],
+) -> Optional[str]:
+    """Hash of the function and the arguments of a task, None if they can't be pickled
+
+    The arguments are bound to the parameters of the function first, such that
+    `f(1)`, `f(x=1)` and `f(1, y=<default of y>)` share the same key.
+
+    :param function: Function the task belongs to
+    :param args: Arguments of the task
+    :param kwargs: Keyword arguments of the task
+    :param signatures: Signatures of the functions that were seen before
+    """
+    name = f"{function.__module__}.{function.__qualname__}"
+    if function not in signatures:
+        signatures[function] = inspect.signature(function)
+    try:
+        bound = signatures[function].bind(*args, **kwargs)
+    except TypeError:
+        pass  # the call itself raises the error
+    else:
+        bound.apply_defaults()
+        args, kwargs = bound.args, bound.kwargs
+    try:
+        data = _dumps((name, args, sorted(kwargs.items())))
+    except Exception:
+        return None
+    return hashlib.sha256(data).hexdigest()
+
+
+def _dumps(value: Any) -> bytes:
+    """Pickle a value, with dill only when the standard pickle (much faster) can't
+
+    Both are read back with `ForkingPickler.loads`.
+
+    :param value: Value to pickle
+    """
+    try:
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return ForkingPickler.dumps(value)
+
+
+class Cache:
+    """Cache for the outputs of a decorated function
+
+    Pass an instance as `cache` to any of the decorators. Every task (a single item of
+    the loop parameters, or a single call of a non-blocking function) is looked up by
+    its arguments before it is sent to a worker. A hit skips the worker altogether.
+    Errors are not cached.
+
+    The outputs are kept in memory, the least recently used outputs are dropped when
+    there are more than `maxsize` of them or when their pickled size exceeds
+    `maxbytes`. With `directory`, all the outputs are also written to disk, such that
+    they survive a restart of the script. The disk cache is not bounded, use `clear`
+    to empty it.
+
+    Example:
+    ```
+    @autothread.multiprocessed(cache=autothread.Cache(maxsize=10000, directory="cache"))
+    def score(id: int) -> float:
+        ...
+    ```
+    """
+
+    def __init__(
+        self,
+        maxsize: Optional[int] = 1024,
+        maxbytes: Optional[int] = None,
+        directory: Optional[str] = None,
+    ):
+        """Initialize the cache
+
+        :param maxsize: Maximum number of outputs to keep in memory, None for unlimited
+        :param maxbytes: Maximum total pickled size of the outputs in memory, None for
+        unlimited
+        :param directory: Directory to store the outputs on disk, None to only keep
+        them in memory
+        """
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._entries: Dict[str, Tuple[Any, int]] = collections.OrderedDict()
+        self._nbytes = 0
+        self._signatures: Dict[Callable, inspect.Signature] = {}
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self) -> int:
+        """Number of outputs in memory"""
+        return len(self._entries)
+
+    def clear(self):
+        """Remove all the outputs from memory and from disk"""
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+            if self.directory is not None:
+                for name in os.listdir(self.directory):
+                    if name.endswith(".pkl"):
+                        os.remove(os.path.join(self.directory, name))
+
+    def _key(self, function: Callable, args: List, kwargs: Dict) -> Optional[str]:
+        """Key of a task, None if the arguments can not be pickled
+
+        :param function: Function the task belongs to
+        :param args: Arguments of the task
+        :param kwargs: Keyword arguments of the task
+        """
+        return _task_key(function, args, kwargs, self._signatures)
+
+    def _get(self, key: str) -> Any:
+        """Return the output of a task, `_MISS` if it is not cached
+
+        :param key: Key of the task
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+        if self.directory is not None:
+            try:
+                with open(self._path(key), "rb") as f:
+                    data = f.read()
+                value = ForkingPickler.loads(data)
+            except Exception:
+                pass  # not on disk, or written by an incompatible version
+            else:
+                self._remember(key, value, len(data))
+                with self._lock:
+                    self.hits += 1
+                return value
+        with self._lock:
+            self.misses += 1
+        return _MISS
+
+    def _put(self, key: str, value: Any):
+        """Store the output of a task
+
+        Outputs that can not be pickled are only cached in memory when their size does
+        not matter (no `maxbytes` and no `directory`).
+
+        :param key: Key of the task
+        :param value: Output of the task
+        """
+        data = None
+        if self.maxbytes is not None or self.directory is not None:
+            try:
+                data = _dumps(value)
+            except Exception:
+                return
+        if self.directory is not None:
+            # Write to a temporary file first, readers never see a partial file
+            path = self._path(key)
+            temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(temporary, "wb") as f:
+                    f.write(data)
+                os.replace(temporary, path)
+            except OSError:
+                pass  # the memory cache still works
+        self._remember(key, value, 0 if data is None else len(data))
+
+    def _remember(self, key: str, value: Any, nbytes: int):
+        """Put an output in memory and drop the least recently used outputs
+
+        :param key: Key of the task
+        :param value: Output of the task
+        :param nbytes: Pickled size of the output
+        """
+        with self._lock:
+            if key in self._entries:
+                self._nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, nbytes)
+            self._nbytes += nbytes
+            while self._entries and (
+                (self.maxsize is not None and len(self._entries) > self.maxsize)
+                or (self.maxbytes is not None and self._nbytes > self.maxbytes)
+            ):
+                self._nbytes -= self._entries.popitem(last=False)[1][1]
+
+    def _path(self, key: str) -> str:
+        """Path of the file with the output of a task on disk
+
+        :param key: Key of the task
+        """
+        return os.path.join(self.directory, f"{key}.pkl")
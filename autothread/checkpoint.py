@@ -0,0 +1,130 @@
+import inspect
+import os
+import sqlite3
+import threading
+import time
+
+from autothread.cache import _MISS, _dumps, _task_key
+from multiprocess.reduction import ForkingPickler
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+class _Checkpoint:
+    """Stores the outputs of the tasks of a function in a SQLite file as they finish
+
+    Every output is stored under the index of its task and a hash of the arguments of
+    the task. When the function is called again after the script died, the tasks with
+    the same index and the same arguments are not run again. Calls with other inputs,
+    also ones that run at the same time, do not touch each other's outputs. When a call
+    ends without being interrupted, its outputs are deleted: the checkpoint resumes
+    calls that did not finish, it is not a cache.
+
+    The outputs are written in batches, at most every `_flush_interval` seconds and
+    when the call ends. Errors and outputs that can not be pickled are not stored.
+    """
+
+    _flush_interval = 1.0
+
+    def __init__(self, path: str, function: Callable):
+        """Initialize the checkpoint
+
+        :param path: Path of the SQLite file, it is created when it does not exist
+        :param function: Function whose outputs are stored, several functions can use
+        the same file
+        """
+        self.path = path
+        self._function = function
+        self._name = f"{function.__module__}.{function.__qualname__}"
+        self._signatures: Dict[Callable, inspect.Signature] = {}
+        self._pending: List[Tuple[str, int, str, bytes]] = []
+        self._flushed = time.monotonic()
+        self._connection = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def key(self, args: List, kwargs: Dict) -> Optional[str]:
+        """Hash of the arguments of a task, None if they can not be pickled
+
+        :param args: Arguments of the task
+        :param kwargs: Keyword arguments of the task
+        """
+        return _task_key(self._function, args, kwargs, self._signatures)
+
+    def get(self, index: int, key: str) -> Any:
+        """Return the stored output of a task, `_MISS` if it did not finish before
+
+        :param index: Index of the task
+        :param key: Hash of the arguments of the task
+        """
+        with self._lock:
+            row = (
+                self._connect()
+                .execute(
+                    "SELECT output FROM outputs WHERE function = ? AND idx = ? "
+                    "AND key = ?",
+                    (self._name, index, key),
+                )
+                .fetchone()
+            )
+        if row is None:
+            return _MISS
+        try:
+            return ForkingPickler.loads(row[0])
+        except Exception:
+            return _MISS  # written by an incompatible version
+
+    def put(self, index: int, key: str, output: Any):
+        """Store the output of a task
+
+        :param index: Index of the task
+        :param key: Hash of the arguments of the task
+        :param output: Output of the task
+        """
+        try:
+            data = _dumps(output)
+        except Exception:
+            return
+        with self._lock:
+            self._pending.append((self._name, index, key, data))
+        if time.monotonic() - self._flushed >= self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Write the outputs that are not stored yet to the file"""
+        with self._lock:
+            self._flushed = time.monotonic()
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, []
+            with self._connect() as connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?)", pending
+                )
+
+    def clear(self, tasks: List[Tuple[int, str]]):
+        """Delete the outputs of the tasks of a call that is done
+
+        :param tasks: [(index, key)] of the tasks of the call
+        """
+        rows = {(self._name, index, key) for index, key in tasks}
+        with self._lock:
+            self._pending = [row for row in self._pending if row[:3] not in rows]
+            with self._connect() as connection:
+                connection.executemany(
+                    "DELETE FROM outputs WHERE function = ? AND idx = ? AND key = ?",
+                    rows,
+                )
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open the file, once for every process. Must be called with the lock held."""
+        if self._connection is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            # Write ahead logging keeps the file intact when the script is killed
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS outputs (function TEXT, idx INTEGER, "
+                "key TEXT, output BLOB, PRIMARY KEY (function, idx, key))"
+            )
+        return self._connection
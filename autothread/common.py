@@ -1,37 +1,261 @@
+import asyncio
+import inspect
 import multiprocess as mp
 import queue
+import signal
 import threading
+import time
 
-from typing import Callable, Union
+from autothread.affinity import _pin
+from autothread.budget import _Budget, _enter_worker
+from autothread.initializer import _Initializer
+from autothread.retry import _RetryPolicy
+from autothread.shared_memory import _attach, _hand_over, _share_result
+from autothread.stats import TaskStats, _Pickled, _peak_rss
+from typing import Any, Callable, Dict, List, Optional, Union
 
+# The cancellation token of the task that is running in the current thread
+_local = threading.local()
 
-def _queuer(
-    queue: Union[queue.Queue, mp.Queue],
+
+def cancelled() -> bool:
+    """Check if the task that runs in this thread was cancelled or timed out
+
+    Threads can not be stopped from the outside. A long running function can call this
+    function once in a while and return early when it returns True, the output of a
+    cancelled task is not used. This is also how the other tasks of a call learn that
+    a task failed. Processes receive a keyboard interrupt or are killed instead, so this
+    function always returns False in a process.
+    """
+    token = getattr(_local, "token", None)
+    return token is not None and token.is_set()
+
+
+def _worker(
+    tasks: Union[queue.Queue, mp.Queue],
+    results: Union[queue.Queue, mp.SimpleQueue],
     function: Callable,
-    semaphore: Union[threading.Semaphore, mp.Semaphore],
-    index: int,
-    sem_pre_acquired: bool,
+    shared_memory: bool = False,
+    stats: bool = False,
+    serialized: bool = False,
+    state: Optional[mp.Array] = None,
+    token: Optional[threading.Event] = None,
+    track: bool = False,
+    retry: Optional[_RetryPolicy] = None,
+    budget: Optional[_Budget] = None,
+    cpus: Optional[List[int]] = None,
+    initializer: Optional[_Initializer] = None,
+):
+    """Worker loop that keeps running tasks until it receives a stop signal
+
+    The worker is kept outside of the _WorkerPool class such that multiprocess doesn't
+    have to pickle/dill the entire class. The function is only sent to the worker once,
+    after that only the arguments of the tasks pass through the queue.
+    :param tasks: Queue to receive (submit time, channel, chunk) tuples from, `None` to
+    stop. Each chunk is a list of (index, args, kwargs) tasks.
+    :param results: Queue to return the (channel, [(index, output, stats)]) of each
+    chunk to
+    :param function: function to forward the args and kwargs of each task to
+    :param shared_memory: Whether numpy arrays are passed through shared memory
+    :param stats: Whether to record the TaskStats of every task, otherwise the stats
+    are None
+    :param serialized: Whether the tasks and outputs are pickled (for processes), which
+    adds their sizes and the memory usage of the worker to the stats. With stats, the
+    pool pickles the arguments of every task in advance and the worker the outputs, such
+    that their sizes are known without pickling them twice.
+    :param state: [start time, channel, index of the task, index of the first task] of
+    the chunk that is running, the start time is 0 while the worker is idle. The pool
+    uses this to stop the chunks of a call and the tasks that take too long. None to
+    not keep track of the chunks.
+    :param token: Event that is set when the task of this thread is cancelled, after
+    which the worker stops without returning the outputs of its chunk
+    :param track: Whether to keep track of every task in `state` instead of only the
+    chunks, such that single tasks can be stopped
+    :param retry: Policy to run failed tasks again, None to not retry them
+    :param budget: Budget of `autothread.limit` of the process that started this
+    worker process, None for threads and when there is no limit
+    :param cpus: Cores to pin this worker process to, None to not pin it
+    :param initializer: Sets up the context of this worker before the first task and
+    tears it down when the worker stops. When it fails, every task returns its error.
+    """
+    _local.token = token
+    _enter_worker(budget)
+    if cpus is not None:
+        _pin(cpus)
+    initializer = initializer or _Initializer()
+    with initializer.run() as failed:
+        while True:
+            _block_interrupts(True)
+            item = tasks.get()
+            if item is None:
+                return
+            submitted, channel, chunk = item
+            if state is not None:
+                with state.get_lock():
+                    state[0], state[1] = time.time(), channel
+                    state[2] = state[3] = chunk[0][0]
+            outputs = []
+            try:
+                _block_interrupts(False)
+                for index, args, kwargs in chunk:
+                    if token is not None and token.is_set():
+                        return  # the pool stopped this worker
+                    if stats:
+                        started = time.time()
+                        arg_bytes = None
+                    if isinstance(args, _Pickled):
+                        arg_bytes = len(args.data)
+                        args, kwargs = args.load()
+                    if track:
+                        with state.get_lock():
+                            state[0], state[2] = time.time(), index
+                    try:
+                        if failed is not None:
+                            raise failed
+                        if shared_memory:
+                            args = [_attach(arg) for arg in args]
+                            kwargs = {k: _attach(v) for k, v in kwargs.items()}
+                        output = _attempt(function, args, kwargs, retry, token)
+                        if shared_memory:
+                            output = _share_result(output)
+                    except Exception as e:
+                        e.autothread_intercepted = True
+                        output = e
+                    if track and token is not None:
+                        # The pool only stops a worker while its task is running
+                        with state.get_lock():
+                            if token.is_set():
+                                return
+                    task_stats = None
+                    if stats:
+                        task_stats = TaskStats(
+                            index=index,
+                            worker=(
+                                mp.current_process().name
+                                if serialized
+                                else threading.current_thread().name
+                            ),
+                            queue_wait=started - submitted,
+                            run_time=time.time() - started,
+                            arg_bytes=arg_bytes,
+                            peak_rss=_peak_rss() if serialized else None,
+                        )
+                    outputs.append((index, output, task_stats))
+                if state is not None:
+                    with state.get_lock():
+                        state[0] = 0
+                        if token is not None and token.is_set():
+                            return
+            except KeyboardInterrupt:
+                # The call of the chunk stopped, the process moves on to the next chunk
+                if state is not None:
+                    with state.get_lock():
+                        state[0] = 0
+                for index, _, _ in chunk[len(outputs) :]:
+                    error = RuntimeError(f"Task {index} was interrupted")
+                    error.autothread_intercepted = True
+                    outputs.append((index, error, None))
+            _block_interrupts(True)
+            if shared_memory:
+                for _, output, _ in outputs:
+                    _hand_over(output)
+            if stats and serialized:
+                for i, (index, output, task_stats) in enumerate(outputs):
+                    output = _Pickled(output)
+                    if task_stats is not None:
+                        task_stats.result_bytes = len(output.data)
+                    outputs[i] = (index, output, task_stats)
+            results.put((channel, outputs))
+
+
+def _hybrid_worker(
+    threads: int,
     *args,
+    cpus: Optional[List[int]] = None,
+    states: Optional[List[mp.Array]] = None,
     **kwargs,
 ):
-    """Function wrapper to put the outputs in the queue
-
-    The queuer is kept outside of the _Autothread class such that multiprocess doesn't
-    have to pickle/dill the entire class.
-    :param queue: Queue object to return values to
-    :param function: function to forward *args and **kwrags to
-    :param semaphore: Semaphore object (to limit the number of concurrent workers)
-    :param index: Index to track when this thread was started
-    :param sem_pre_acquired: True if semaphore already is acquired for this process
+    """Worker process that runs several worker threads
+
+    All the threads pull their chunks from the same task queue, so a thread that waits
+    for I/O does not keep the other tasks from running. Every thread stops when it
+    receives its own stop signal, the process exits when all its threads are done.
+
+    :param threads: Number of threads to run in this process
+    :param args: Arguments of `_worker`
+    :param cpus: Cores to pin this process to before the threads start, which they
+    inherit. None to not pin it.
+    :param states: The `state` of every thread, see `_worker`
+    :param kwargs: Keyword arguments of `_worker`
     """
-    if not sem_pre_acquired:
-        semaphore.acquire()
+    if cpus is not None:
+        _pin(cpus)
+    states = states or [None] * threads
+    workers = [
+        threading.Thread(
+            target=_worker, args=args, kwargs=dict(kwargs, state=state), daemon=True
+        )
+        for state in states
+    ]
+    for worker in workers:
+        worker.start()
     try:
-        output = function(*args, **kwargs)
+        for worker in workers:
+            worker.join()
     except KeyboardInterrupt:
+        # The process is being killed, its threads die with it
         return
-    except Exception as e:
-        e.autothread_intercepted = True
-        output = e
-    semaphore.release()
-    queue.put({index: output})
+
+
+def _attempt(
+    function: Callable,
+    args: List,
+    kwargs: Dict,
+    retry: Optional[_RetryPolicy],
+    token: Optional[threading.Event],
+) -> Any:
+    """Run a task, running it again after a failure as long as the policy allows it
+
+    The error of the last attempt is raised with the number of attempts attached to it
+    as `autothread_attempts`.
+
+    :param function: function to run
+    :param args: Arguments of the task
+    :param kwargs: Keyword arguments of the task
+    :param retry: Policy to run failed tasks again, None to not retry them
+    :param token: Event that is set when the task is cancelled, which ends the backoff
+    """
+    attempt = 1
+    while True:
+        try:
+            output = function(*args, **kwargs)
+            if inspect.iscoroutine(output):
+                output = asyncio.run(output)
+            return output
+        except Exception as e:
+            if retry is None or not retry.retry(e, attempt):
+                e.autothread_attempts = attempt
+                raise
+        if token is None:
+            time.sleep(retry.delay(attempt))
+        elif token.wait(retry.delay(attempt)):
+            return None  # the output of a cancelled task is not used
+        attempt += 1
+
+
+def _block_interrupts(block: bool):
+    """Block or unblock keyboard interrupts of a worker process
+
+    An interrupt that arrives while a worker reads from or writes to a queue could leave
+    a partial message in the pipe, which breaks the queue for the other workers. The
+    interrupts are only let through while the worker runs its tasks. Threads and
+    platforms without signal masks are interrupted in a different way.
+
+    :param block: Whether to block or unblock the interrupts
+    """
+    if hasattr(signal, "pthread_sigmask") and threading.current_thread() is (
+        threading.main_thread()
+    ):
+        signal.pthread_sigmask(
+            signal.SIG_BLOCK if block else signal.SIG_UNBLOCK, {signal.SIGINT}
+        )
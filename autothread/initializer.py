@@ -0,0 +1,79 @@
+import contextlib
+import threading
+
+from typing import Any, Callable, Iterator, Optional, Tuple
+
+# The context of the worker that runs in the current thread
+_local = threading.local()
+
+
+def context() -> Any:
+    """Return the context of the worker that runs the current task
+
+    The context is the return value of the `initializer` of the decorated function,
+    which runs once in every worker before its first task. Expensive objects, like a
+    model or a database connection, are created once per worker this way instead of
+    once per task. Returns None outside of a worker or without an initializer.
+
+    Example:
+    ```
+    @autothread.multiprocessed(initializer=load_model, initargs=("model.bin",))
+    def predict(x: int):
+        return autothread.context().predict(x)
+    ```
+    """
+    return getattr(_local, "context", None)
+
+
+class _Initializer:
+    """Sets up and tears down the context of every worker of a function
+
+    Like the retry policy, the initializer is sent to the workers, which run it
+    themselves when they start.
+    """
+
+    def __init__(
+        self,
+        initializer: Optional[Callable[..., Any]] = None,
+        initargs: Tuple = (),
+        teardown: Optional[Callable[[Any], None]] = None,
+    ):
+        """Initialize the initializer
+
+        :param initializer: Function that receives `initargs` and returns the context
+        of a worker, None for no context
+        :param initargs: Arguments of the initializer
+        :param teardown: Function that receives the context when the worker stops,
+        None to not clean up
+        """
+        self.initializer = initializer
+        self.initargs = initargs
+        self.teardown = teardown
+
+    @contextlib.contextmanager
+    def run(self) -> Iterator[Optional[Exception]]:
+        """Make the context available to the current thread while the worker runs
+
+        The context of an outer worker (e.g. of a nested call that runs inline) is
+        restored afterwards.
+
+        :return: The error the initializer raised, which becomes the output of every
+        task of the worker. None if it succeeded.
+        """
+        previous = context()
+        try:
+            _local.context = None
+            if self.initializer is not None:
+                _local.context = self.initializer(*self.initargs)
+        except Exception as e:
+            _local.context = previous
+            yield e
+            return
+        try:
+            yield None
+        finally:
+            try:
+                if self.teardown is not None:
+                    self.teardown(_local.context)
+            finally:
+                _local.context = previous
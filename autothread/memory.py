@@ -0,0 +1,80 @@
+import psutil
+import threading
+
+from typing import Callable, Dict, List, Optional
+
+_MB = 1024**2
+
+
+class _MemoryGate:
+    """Delays the start of tasks until there is enough memory available for them
+
+    Every task needs `mb_mem` megabytes, or the number of megabytes returned by the
+    estimate function for its arguments. A task is only started when the available
+    memory of the machine covers it, on top of the memory that is reserved for the
+    tasks that are running. Running tasks may not have allocated their memory yet, so
+    their full need is reserved. The memory the workers did allocate since the gate
+    was last idle is already missing from the available memory, so that part of the
+    reservation is released again.
+    """
+
+    # Seconds to wait before checking again when no running task can free memory
+    interval = 0.1
+
+    def __init__(
+        self,
+        mb_mem: Optional[float] = None,
+        estimate: Optional[Callable[..., float]] = None,
+    ):
+        """Initialize the gate
+
+        :param mb_mem: Megabytes of memory every task needs
+        :param estimate: Function that receives the arguments of a task and returns the
+        megabytes of memory it needs. Overrides `mb_mem`.
+        """
+        self._mb_mem = mb_mem or 0
+        self._estimate = estimate
+        self._baseline: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def need(self, args: List, kwargs: Dict) -> float:
+        """Megabytes of memory a task needs
+
+        :param args: Arguments of the task
+        :param kwargs: Keyword arguments of the task
+        """
+        if self._estimate is None:
+            return self._mb_mem
+        return self._estimate(*args, **kwargs)
+
+    def admit(self, need: float, reserved: float, pids: List[int]) -> bool:
+        """Check if a task can start without running out of memory
+
+        A task that needs more memory than the machine has in total is always admitted
+        once nothing else is running, it would otherwise never start.
+
+        :param need: Megabytes of memory the task needs
+        :param reserved: Megabytes of memory needed by the tasks that are running
+        :param pids: Process ids of the workers (the own pid for threads)
+        """
+        memory = psutil.virtual_memory()
+        with self._lock:
+            if not reserved:
+                self._baseline = {}
+            allocated = sum(self._growth(pid) for pid in pids)
+        available = memory.available - max(0, reserved * _MB - allocated)
+        if available >= need * _MB:
+            return True
+        return not reserved and need * _MB > memory.total
+
+    def _growth(self, pid: int) -> int:
+        """Bytes the resident memory of a process grew since it was first seen
+
+        :param pid: Process id
+        """
+        try:
+            rss = psutil.Process(pid).memory_info().rss
+        except psutil.Error:
+            return 0  # the worker exited in the meantime
+        baseline = self._baseline.setdefault(pid, rss)
+        return max(0, rss - baseline)
@@ -1,18 +1,435 @@
+import asyncio
+import collections
+import itertools
 import threading
 import queue
 import multiprocess as mp
+import os
+import time
+import traceback
 
-from autothread.common import _queuer
-from typing import Union, Type, Callable, Any
+from autothread.affinity import _Placement
+from autothread.autoscale import _Autoscaler
+from autothread.cache import _MISS, Cache
+from autothread.initializer import _Initializer
+from autothread.memory import _MemoryGate
+from autothread.pool import _WorkerPool
+from autothread.retry import _RetryPolicy
+from autothread.stats import CallStats, TaskStats
+from concurrent.futures import CancelledError
+from multiprocess import util
+from typing import Union, Type, Callable, Any, Dict, List, Optional, Tuple
+
+
+class _Failure:
+    """Output of a call that was cancelled or lost because its worker died"""
+
+    def __init__(self, error: Exception):
+        """Initialize the failure
+
+        :param error: Error to raise when the output of the call is requested
+        """
+        self.error = error
+
+
+class _Executor:
+    """Runs the calls of a non-blocking function on a bounded pool of workers
+
+    Every call is queued as a small (id, args, kwargs) task, only `n_workers` workers
+    exist no matter how many calls are waiting. All the workers put their outputs on
+    one result queue. A dispatcher thread collects the outputs and stores them by id
+    until the placeholder of the call asks for it. The dispatcher only runs while there
+    are calls pending.
+    """
+
+    # Seconds between checks for calls that ran out of time
+    _poll_interval = 0.05
+
+    def __init__(
+        self,
+        function: Callable,
+        Process: Union[Type[threading.Thread], Type[mp.Process]],
+        Queue: Union[Type[queue.Queue], Type[mp.Queue]],
+        n_workers: int,
+        stats: Optional[Callable[[CallStats], None]] = None,
+        autoscaler: Optional[_Autoscaler] = None,
+        memory_gate: Optional[_MemoryGate] = None,
+        cache: Optional[Cache] = None,
+        timeout: Optional[float] = None,
+        retry: Optional[_RetryPolicy] = None,
+        placement: Optional[_Placement] = None,
+        initializer: Optional[_Initializer] = None,
+    ):
+        """Initialize the executor
+
+        :param function: function to run in the workers
+        :param Process: Process/thread class
+        :param Queue: Queue class
+        :param n_workers: Maximum number of workers (<= 0 for unlimited)
+        :param stats: Function that receives the CallStats of every call when it is
+        done, None to not record any statistics
+        :param autoscaler: Adjusts the number of workers while calls are pending, None
+        for a fixed number of workers
+        :param memory_gate: Delays the start of calls until there is enough memory
+        available, None to start them right away
+        :param cache: Cache to look up the outputs of the calls in, None to always run
+        the calls
+        :param timeout: Seconds a call may run before it raises a TimeoutError, None for
+        no limit
+        :param retry: Policy to run failed calls again, None to not retry them
+        :param placement: Cores to pin the worker processes to, None to let the
+        operating system schedule them
+        :param initializer: Sets up the context of every worker, None for no context
+        """
+        self._function = function
+        self._Process = Process
+        self._Queue = Queue
+        self.n_workers = n_workers
+        self._stats = stats
+        self._autoscaler = autoscaler
+        self._memory_gate = memory_gate
+        self._cache = cache
+        self.timeout = timeout
+        self._retry = retry
+        self._placement = placement
+        self._initializer = initializer
+        self._reset()
+
+    def submit(self, args: Tuple, kwargs: Dict) -> int:
+        """Queue a call of the function and return its id
+
+        :param args: Arguments to forward to the function
+        :param kwargs: Keyword arguments to forward to the function
+        """
+        if self._pid != os.getpid():
+            # The executor was copied into a forked process, its workers are not ours
+            self._reset()
+        key, output = None, _MISS
+        if self._cache is not None:
+            key = self._cache._key(self._function, args, kwargs)
+            output = _MISS if key is None else self._cache._get(key)
+        with self._lock:
+            call_id = next(self._ids)
+            self._done[call_id] = threading.Event()
+            if self._stats is not None:
+                self._submitted[call_id] = time.perf_counter()
+            if output is _MISS:
+                self._queue(call_id, args, kwargs, key)
+        if output is not _MISS:
+            # Cache hits are done right away, they never reach the workers
+            self._finish(call_id, output, cache_hit=True)
+        return call_id
+
+    def _queue(self, call_id: int, args: Tuple, kwargs: Dict, key: Optional[str]):
+        """Put a call in the backlog and start the workers and the dispatcher
+
+        Must be called with the lock held.
+
+        :param call_id: id of the call
+        :param args: Arguments to forward to the function
+        :param kwargs: Keyword arguments to forward to the function
+        :param key: Key to store the output in the cache with, None to not cache it
+        """
+        if self._pool is None:
+            self._pool = _WorkerPool(
+                function=self._function,
+                Process=self._Process,
+                Queue=self._Queue,
+                n_workers=self.n_workers,
+                stats=self._stats is not None,
+                timeout=self.timeout,
+                track=True,
+                retry=self._retry,
+                placement=self._placement,
+                initializer=self._initializer,
+            )
+        if key is not None:
+            self._cache_keys[call_id] = key
+        need = 0
+        if self._memory_gate is not None:
+            need = self._memory_gate.need(args, kwargs)
+        self._backlog.append((call_id, args, kwargs, need))
+        self._fill()
+        if self._dispatcher is None:
+            self._dispatcher = threading.Thread(
+                target=self._dispatch, args=(self._pool,), daemon=True
+            )
+            self._dispatcher.start()
+
+    def result(self, call_id: int) -> Tuple[Any, Optional[CallStats]]:
+        """Wait for a call to finish and return its output and statistics
+
+        :param call_id: id of the call, as returned by `submit`
+        """
+        self._done[call_id].wait()
+        with self._lock:
+            del self._done[call_id]
+            return self._outputs.pop(call_id), self._call_stats.pop(call_id, None)
+
+    def add_done_callback(self, call_id: int, callback: Callable[[], Any]):
+        """Call a function from the dispatcher thread once a call is done
+
+        The callback is called right away if the call is already done.
+
+        :param call_id: id of the call, as returned by `submit`
+        :param callback: function without arguments to call
+        """
+        with self._lock:
+            if not self._done[call_id].is_set():
+                self._callbacks.setdefault(call_id, []).append(callback)
+                return
+        callback()
+
+    def cancel(self, call_id: int) -> bool:
+        """Cancel a call that is not done yet, it raises a CancelledError
+
+        A call in the backlog is dropped, a running call is stopped: processes are
+        killed, threads are abandoned (see `autothread.cancelled`).
+
+        :param call_id: id of the call, as returned by `submit`
+        :return: Whether the call was cancelled, False if it was already done
+        """
+        with self._lock:
+            if not self._claim(call_id):
+                return False
+            queued = [task for task in self._backlog if task[0] == call_id]
+            for task in queued:
+                self._backlog.remove(task)
+            self._blocked.pop(call_id, None)
+            pool = self._pool
+            if not queued:
+                self._ignored.add(call_id)
+        if not queued and pool is not None:
+            if pool.cancel(call_id):
+                # The output will never arrive, don't wait for it
+                with self._lock:
+                    self._ignored.discard(call_id)
+                pool.wake()
+        self._finish(call_id, _Failure(CancelledError()))
+        return True
+
+    def cancel_all(self):
+        """Cancel all the calls that are not done yet"""
+        with self._lock:
+            pending = [i for i, done in self._done.items() if not done.is_set()]
+        for call_id in pending:
+            self.cancel(call_id)
+
+    def shutdown(self):
+        """Wait for the pending calls to finish and stop the workers
+
+        The workers are started again when the function is called after shutting down.
+        """
+        _Executor._wait_all(self._done)
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+    def _reset(self):
+        """Forget the workers and the pending calls"""
+        self._pid = os.getpid()
+        self._pool = None
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._dispatcher = None
+        self._done: Dict[int, threading.Event] = {}
+        self._outputs: Dict[int, Any] = {}
+        self._callbacks: Dict[int, List[Callable[[], Any]]] = {}
+        self._submitted: Dict[int, float] = {}
+        self._call_stats: Dict[int, CallStats] = {}
+        self._backlog = collections.deque()
+        self._reserved: Dict[int, float] = {}
+        self._blocked: Dict[int, float] = {}
+        self._memory_wait: Dict[int, float] = {}
+        self._cache_keys: Dict[int, str] = {}
+        # Cancelled calls whose output may still arrive, it is thrown away
+        self._ignored = set()
+        self._claimed = set()
+        # Calls that are still pending at exit are finished before the workers stop
+        util.Finalize(self, _Executor._wait_all, args=(self._done,), exitpriority=20)
+
+    def _dispatch(self, pool: _WorkerPool):
+        """Hand the outputs of the workers to the calls until no calls are pending
+
+        If a worker dies, the outputs of the pending calls are lost. Those calls raise
+        the error of the pool and the pool is replaced on the next call.
+
+        :param pool: Pool to collect the outputs from
+        """
+        while True:
+            with self._lock:
+                if self._pool is pool:
+                    self._fill()
+                blocked = self._pool is pool and bool(self._backlog)
+                if not pool.n_pending and not blocked:
+                    self._dispatcher = None
+                    return
+            if not pool.n_pending:
+                # No running call can free memory, wait for other programs
+                time.sleep(self._memory_gate.interval)
+                continue
+            try:
+                if pool.timeout is None:
+                    outputs = pool.get()
+                else:
+                    outputs = pool.get(min(pool.timeout, self._poll_interval))
+                    for expired in pool.expire():
+                        self._finish_outputs(expired)
+            except Exception as e:
+                with self._lock:
+                    self._pool, self._dispatcher = None, None
+                    self._backlog.clear()
+                    self._reserved.clear()
+                    self._blocked.clear()
+                    self._ignored.clear()
+                    pending = [i for i in list(self._done) if self._claim(i)]
+                pool.kill()
+                for call_id in pending:
+                    self._finish(call_id, _Failure(e))
+                return
+            if outputs is not None:
+                self._finish_outputs(outputs)
+
+    def _finish_outputs(self, outputs: List[Tuple[int, Any, Optional[TaskStats]]]):
+        """Finish the calls of a chunk that is done, skipping the cancelled calls
+
+        :param outputs: [(call_id, output, stats)] of the chunk
+        """
+        for call_id, output, task_stats in outputs:
+            with self._lock:
+                if call_id in self._ignored:
+                    self._ignored.discard(call_id)
+                    continue
+                if not self._claim(call_id):
+                    continue
+            self._finish(call_id, output, task_stats)
+
+    def _claim(self, call_id: int) -> bool:
+        """Make sure only one thread finishes a call, the dispatcher or `cancel`
+
+        Must be called with the lock held.
+
+        :param call_id: id of the call
+        :return: Whether the caller must finish the call
+        """
+        if call_id not in self._done or self._done[call_id].is_set():
+            return False
+        if call_id in self._claimed:
+            return False
+        self._claimed.add(call_id)
+        return True
+
+    def _fill(self):
+        """Hand calls from the backlog to the pool while there is room for them
+
+        Without an autoscaler or memory gate, all the calls are handed over right away.
+        Otherwise only as many calls as the autoscaler allows workers and as fit in the
+        available memory are pending in the pool, the dispatcher hands over the next
+        call when one is done. Must be called with the lock held.
+        """
+        limit = float("inf")
+        if self._autoscaler is not None:
+            limit = self._pool.n_workers = self._autoscaler.target()
+        while self._backlog and self._pool.n_pending < limit:
+            call_id, args, kwargs, need = self._backlog[0]
+            if self._memory_gate is not None:
+                reserved = sum(self._reserved.values())
+                if not self._memory_gate.admit(need, reserved, self._pool.pids):
+                    self._blocked.setdefault(call_id, time.perf_counter())
+                    return
+                self._reserved[call_id] = need
+                if call_id in self._blocked:
+                    blocked = self._blocked.pop(call_id)
+                    self._memory_wait[call_id] = time.perf_counter() - blocked
+            self._backlog.popleft()
+            self._pool.submit([(call_id, args, kwargs)])
+
+    def _finish(
+        self,
+        call_id: int,
+        output: Any,
+        task_stats: Optional[TaskStats] = None,
+        cache_hit: bool = False,
+    ):
+        """Store the output of a call and notify the ones that are waiting for it
+
+        :param call_id: id of the call
+        :param output: Output of the call
+        :param task_stats: Statistics of the call, recorded by the worker
+        :param cache_hit: Whether the output was found in the cache
+        """
+        memory_wait = self._memory_wait.pop(call_id, 0.0)
+        key = self._cache_keys.pop(call_id, None)
+        if key is not None and not (
+            isinstance(output, _Failure)
+            or getattr(output, "autothread_intercepted", False)
+        ):
+            self._cache._put(key, output)
+        call_stats = None
+        if self._stats is not None:
+            submitted = self._submitted.pop(call_id)
+            call_stats = CallStats(
+                tasks=[] if task_stats is None else [task_stats],
+                wall_time=time.perf_counter() - submitted,
+                memory_wait=memory_wait,
+                cache_hits=int(cache_hit),
+            )
+        with self._lock:
+            self._reserved.pop(call_id, None)
+            self._outputs[call_id] = output
+            if call_stats is not None:
+                self._call_stats[call_id] = call_stats
+            self._done[call_id].set()
+            self._claimed.discard(call_id)
+            callbacks = self._callbacks.pop(call_id, [])
+        if call_stats is not None:
+            try:
+                self._stats(call_stats)
+            except Exception:
+                # The dispatcher must keep running for the other calls
+                traceback.print_exc()
+        for callback in callbacks:
+            callback()
+
+    @staticmethod
+    def _wait_all(done: Dict[int, threading.Event]):
+        """Wait for all the pending calls to finish
+
+        :param done: Dict with the event of every call that was not collected yet
+        """
+        for event in list(done.values()):
+            event.wait()
+
+
+def _call_soon(loop: asyncio.AbstractEventLoop, callback: Callable[[], Any]):
+    """Run a function in an event loop from another thread
+
+    :param loop: Event loop to run the function in
+    :param callback: function without arguments to call
+    """
+    try:
+        loop.call_soon_threadsafe(callback)
+    except RuntimeError:
+        pass  # the event loop is closed, nobody is waiting anymore
+
+
+def _stats_of(placeholder: "_Placeholder") -> Optional[CallStats]:
+    """Wait for the call of a placeholder and return its statistics
+
+    :param placeholder: Placeholder returned by a call of the function
+    :return: The statistics, None if the function does not record statistics
+    """
+    placeholder.___wait___()
+    return placeholder.___stats___
 
 
 class _Placeholder:
     """Base class for a non-blocking decorator that makes any function threaded"""
 
-    ___semaphore___: Union[threading.Semaphore, mp.Semaphore] = None
-    ___Queue___: Union[Type[queue.Queue], Type[mp.Queue]] = None
-    ___Process___: Union[Type[threading.Thread], Type[mp.Process]] = None
+    ___executor___: _Executor = None
     ___ignore_errors___: bool = False
+    ___stats___: Optional[CallStats] = None
 
     @classmethod
     def ___forwarder___(cls, attr: str) -> Callable:
@@ -27,28 +444,29 @@ class _Placeholder:
 
         return forwarder
 
-    def __init__(self, function: Callable, *args, **kwargs) -> None:
-        """Initialize the placeholder
+    def __init__(self, *args, **kwargs) -> None:
+        """Initialize the placeholder and queue the call of the function
 
-        :param function: Function to call in thread/process
         :param args: Arguments to forward to function
         :param kwargs: Keyword arguments to forward to function
         """
         self.___response_collected___ = False
-        self.___queue___ = self.___Queue___()
-        self.___process___ = self.___Process___(
-            target=_queuer,
-            args=(self.___queue___, function, self.___semaphore___, 0, False, *args),
-            kwargs=kwargs,
-        )
-        self.___process___.start()
+        self.___response_checked___ = False
+        self.___id___ = self.___executor___.submit(args, kwargs)
 
-    def ___get_response___(self) -> Any:
-        """Waits untill the thread is ready and collects its response"""
+    def ___wait___(self):
+        """Waits untill the call is done and collects its response and statistics"""
         if not self.___response_collected___:
-            self.___process___.join()
-            self.___response___ = list(self.___queue___.get().values())[0]
+            self.___response___, self.___stats___ = self.___executor___.result(
+                self.___id___
+            )
             self.___response_collected___ = True
+
+    def ___get_response___(self) -> Any:
+        """Waits untill the call is done and collects its response"""
+        if not self.___response_checked___:
+            self.___wait___()
+            self.___response_checked___ = True
             if isinstance(self.___response___, Exception) and getattr(
                 self.___response___, "autothread_intercepted", False
             ):
@@ -56,15 +474,63 @@ class _Placeholder:
                     self.___response___ = None
                 else:
                     raise self.___response___
+        if isinstance(self.___response___, _Failure):
+            raise self.___response___.error
         return self.___response___
 
+    def ___cancel___(self) -> bool:
+        """Cancel the call, collecting the response raises a CancelledError
+
+        :return: Whether the call was cancelled, False if it was already done
+        """
+        return self.___executor___.cancel(self.___id___)
+
+    def ___future___(self) -> asyncio.Future:
+        """Return an asyncio future of the running event loop with the response
+
+        The dispatcher thread of the executor wakes the event loop when the call is
+        done, the event loop never waits for it. asyncio functions like `gather` and
+        `wait_for` check the type of their arguments, which waits for the response of a
+        placeholder. They accept this future instead.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve():
+            if future.done():
+                return  # cancelled, e.g. by `asyncio.wait_for`
+            try:
+                future.set_result(self.___get_response___())
+            except CancelledError:
+                future.cancel()
+            except Exception as e:
+                future.set_exception(e)
+
+        if self.___response_collected___:
+            resolve()
+        else:
+            self.___executor___.add_done_callback(
+                self.___id___, lambda: _call_soon(loop, resolve)
+            )
+        return future
+
+    def __await__(self):
+        """Wait for the call without blocking the event loop and return its response
+
+        This makes the placeholder awaitable, e.g. `result = await example(x)`.
+        """
+        return (yield from self.___future___().__await__())
+
     def __getattribute__(self, __name: str) -> Any:
         """Forwards attribute request to function response
 
         The placeholder itself uses thrunders ("___attr___") as internal attributed. If
         the attribute is not a thrunder, wait for the response and forward it there.
+        `__await__` is not forwarded, it waits for the call itself.
         """
-        if __name.startswith("___") and __name.endswith("___"):
+        if (__name.startswith("___") and __name.endswith("___")) or (
+            __name == "__await__"
+        ):
             return object.__getattribute__(self, __name)
 
         return object.__getattribute__(self, "___get_response___")().__getattribute__(
@@ -93,4 +559,7 @@ class _Placeholder:
         return getattr(self.___get_response___(), "__repr__", self.___get_response___)()
 
     def __del__(self) -> None:
-        getattr(self.___get_response___(), "__del__", self.___get_response___)()
+        self.___wait___()
+        if isinstance(self.___response___, _Failure):
+            return  # the call did not run, there is nothing to clean up
+        getattr(self.___response___, "__del__", lambda: None)()
@@ -0,0 +1,1137 @@
+import asyncio
+import itertools
+import multiprocess as mp
+import os
+import queue
+import signal
+import threading
+import time
+
+from autothread.affinity import _Placement
+from autothread.budget import _Budget
+from autothread.common import _hybrid_worker, _worker
+from autothread.initializer import _Initializer
+from autothread.retry import _RetryPolicy
+from autothread.shared_memory import _discard
+from multiprocess import connection, util
+from autothread.stats import TaskStats, _Pickled, _unpickled
+from typing import List, Optional, Union, Tuple, Dict, Callable, Type, Any
+
+# Put in the inbox of a waiting channel when the thread that reads the result queue
+# stops reading, such that the waiting thread takes over
+_HANDOFF = object()
+# Returned by `_WorkerPool._read` after it found a worker that died
+_LOST = object()
+
+
+class _Died:
+    """Inbox item of a channel whose chunks were lost because their worker died"""
+
+    def __init__(self, error: Exception, lost: int):
+        """Initialize the item
+
+        :param error: Error to raise in the call that reads the item
+        :param lost: Number of chunks of the channel that were lost
+        """
+        self.error = error
+        self.lost = lost
+
+
+class _ThreadState(list):
+    """State of a worker thread, like the mp.Array of a worker process
+
+    A thread shares the memory of the pool, so the state does not have to live in shared
+    memory and can be updated faster.
+    """
+
+    def __init__(self):
+        """Initialize the state of an idle worker, see `_worker`"""
+        super().__init__([0.0] * 4)
+        self._lock = threading.RLock()
+
+    def get_lock(self) -> threading.RLock:
+        """Lock to hold while reading or updating the state"""
+        return self._lock
+
+
+class _Channels:
+    """Bookkeeping of the channels of a pool that several calls use at the same time
+
+    Every call opens a channel of its own. The chunks it submits are tagged with the
+    channel and their outputs end up in the inbox of the channel, so the outputs of
+    concurrent calls never mix. Channel 0 is always open, for a pool with a single user.
+    The chunks of a channel that was closed still count as pending until they are done,
+    their outputs are thrown away.
+    """
+
+    def _open_channels(self):
+        """Initialize the bookkeeping with only channel 0"""
+        self.n_pending = 0
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, int] = {0: 0}
+        self._inboxes: Dict[int, queue.Queue] = {0: queue.Queue()}
+
+    def open(self) -> int:
+        """Open a channel for a call and return its id"""
+        with self._lock:
+            channel = next(self._ids)
+            self._pending[channel] = 0
+            self._inboxes[channel] = queue.Queue()
+        return channel
+
+    def close(self, channel: int):
+        """Close the channel of a call that is done, its remaining outputs are dropped
+
+        :param channel: id of the channel
+        """
+        with self._lock:
+            inbox = self._inboxes.pop(channel)
+        while True:
+            try:
+                item = inbox.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, _Died):
+                self._done(channel, item.lost)
+            elif isinstance(item, list):
+                self._done(channel)
+                self._drop(item)
+        with self._lock:
+            if not self._pending.get(channel):
+                self._pending.pop(channel, None)
+
+    def pending(self, channel: int = 0) -> int:
+        """Number of chunks of a channel that did not return yet
+
+        :param channel: id of the channel
+        """
+        return self._pending.get(channel, 0)
+
+    def _done(self, channel: int, n: int = 1):
+        """Count chunks of a channel as done
+
+        :param channel: id of the channel
+        :param n: Number of chunks
+        """
+        with self._lock:
+            if channel not in self._pending:
+                return
+            self.n_pending -= n
+            self._pending[channel] -= n
+            if channel not in self._inboxes and not self._pending[channel]:
+                del self._pending[channel]
+
+    def _route(self, channel: int, item: Any):
+        """Put an item in the inbox of a channel, or drop it if the channel is closed
+
+        :param channel: id of the channel
+        :param item: Outputs of a chunk, _Died, or None to wake the channel
+        """
+        with self._lock:
+            inbox = self._inboxes.get(channel)
+            if inbox is not None:
+                inbox.put(item)
+                return
+        if isinstance(item, _Died):
+            self._done(channel, item.lost)
+        elif item is not None:
+            self._done(channel)
+            self._drop(item)
+
+    @staticmethod
+    def _drop(outputs: List[Tuple[int, Any, Optional[TaskStats]]]):
+        """Throw away the outputs of a chunk that nobody collects
+
+        Arrays that were handed over in shared memory are removed.
+
+        :param outputs: [(index, output, stats)] of the chunk
+        """
+        for _, output, _ in outputs:
+            _discard(_unpickled(output))
+
+    def _received(
+        self, channel: int, item: Any
+    ) -> Optional[List[Tuple[int, Any, Optional[TaskStats]]]]:
+        """Process an item that a channel took from its inbox
+
+        :param channel: id of the channel
+        :param item: Outputs of a chunk, _Died, None or _HANDOFF
+        :return: The outputs of a chunk, None if there are none
+        """
+        if isinstance(item, _Died):
+            self._done(channel, item.lost)
+            raise item.error
+        if item is None or item is _HANDOFF:
+            return None
+        self._done(channel)
+        return item
+
+
+class _WorkerPool(_Channels):
+    """Long-lived workers that run the tasks of a single function
+
+    Workers are started lazily when tasks are submitted and keep running in between
+    calls, so the function only has to be sent to each worker once. The workers pull
+    chunks of tasks from a shared queue and put the outputs on a shared result queue.
+    Tasks can be submitted from one thread while another thread collects the outputs.
+    Calls that run at the same time share the workers, each through its own channel.
+    The thread that reads the result queue hands the outputs of the other channels to
+    their inboxes.
+    """
+
+    def __init__(
+        self,
+        function: Callable,
+        Process: Union[Type[threading.Thread], Type[mp.Process]],
+        Queue: Union[Type[queue.Queue], Type[mp.Queue]],
+        n_workers: int,
+        shared_memory: bool = False,
+        stats: bool = False,
+        timeout: Optional[float] = None,
+        track: bool = False,
+        retry: Optional[_RetryPolicy] = None,
+        budget: Optional[_Budget] = None,
+        placement: Optional[_Placement] = None,
+        threads: int = 1,
+        initializer: Optional[_Initializer] = None,
+    ):
+        """Initialize the pool
+
+        :param function: function to run in the workers
+        :param Process: Process/thread class
+        :param Queue: Queue class
+        :param n_workers: Maximum number of workers (<= 0 for unlimited)
+        :param shared_memory: Whether numpy arrays are passed through shared memory
+        :param stats: Whether the workers record statistics of every task
+        :param timeout: Seconds a task may run before `expire` stops it, None for no
+        limit
+        :param track: Keep track of the task every worker is running, such that single
+        tasks can be cancelled. Always on with a timeout.
+        :param retry: Policy to run failed tasks again, None to not retry them
+        :param budget: Budget of `autothread.limit` to hand to worker processes, such
+        that the functions they call share it
+        :param placement: Cores to pin the worker processes to, None to let the
+        operating system schedule them
+        :param threads: Number of threads every worker process runs, each of them pulls
+        its own chunks. Tasks can not be tracked with more than one thread.
+        :param initializer: Sets up the context of every worker, None for no context
+        """
+        self._function = function
+        self._Process = Process
+        self.n_workers = n_workers
+        self._shared_memory = shared_memory
+        self._stats = stats
+        self.timeout = timeout
+        self._track = track or timeout is not None
+        self._retry = retry
+        self.budget = budget
+        self._placement = placement
+        self._threads = threads
+        self._initializer = initializer
+        self.pid = os.getpid()
+        self.spawn_time = 0.0
+        self._open_channels()
+        self._expired: Dict[int, List] = {0: []}
+        # Only one thread reads the result queue at a time, the others wait for their
+        # inbox. The channels that are waiting take over when the reader is done.
+        self._reader = threading.Lock()
+        self._waiting = set()
+        self._tasks = Queue()
+        # A process writes its outputs itself instead of in a background thread, such
+        # that it can be killed while running a task without breaking the queue
+        self._results = mp.SimpleQueue() if Process != threading.Thread else Queue()
+        self._workers = []
+        # worker -> (states of its threads, token), see `_worker` for the states
+        self._states: Dict[Any, Tuple[List[mp.Array], Optional[threading.Event]]] = {}
+        # (channel, index of the first task) -> chunk, of the chunks that did not return
+        self._running: Dict[Tuple[int, int], List[Tuple[int, List, Dict]]] = {}
+        # worker -> number of the worker, that decides the core it is pinned to
+        self._numbers: Dict[Any, int] = {}
+        # The workers are stopped at exit before the queues close (exitpriority=10)
+        self._finalizer = util.Finalize(
+            self,
+            _WorkerPool._stop_workers,
+            args=(self._tasks, self._results, self._workers, threads),
+            exitpriority=15,
+        )
+
+    def open(self) -> int:
+        """Open a channel for a call and return its id"""
+        channel = super().open()
+        with self._lock:
+            self._expired[channel] = []
+        return channel
+
+    def close(self, channel: int):
+        """Close the channel of a call that is done, its remaining outputs are dropped
+
+        :param channel: id of the channel
+        """
+        with self._lock:
+            self._expired.pop(channel, None)
+        super().close(channel)
+
+    def submit(self, chunk: List[Tuple[int, List, Dict]], channel: int = 0):
+        """Submit a chunk of tasks to the workers, starting a new worker if all are busy
+
+        :param chunk: List of (index, args, kwargs) tasks that are run by one worker.
+        The index is returned together with the output of the task.
+        :param channel: Channel that receives the outputs
+        """
+        with self._lock:
+            self.n_pending += 1
+            self._pending[channel] += 1
+            self._running[(channel, chunk[0][0])] = chunk
+            self._replenish()
+        if self._stats and self._Process != threading.Thread:
+            # The worker measures the size of the arguments, see `_worker`
+            chunk = [
+                (index, _Pickled((args, kwargs)), None) for index, args, kwargs in chunk
+            ]
+        self._tasks.put((time.time(), channel, chunk))
+
+    def get(
+        self, timeout: Optional[float] = None, channel: int = 0
+    ) -> Optional[List[Tuple[int, Any, Optional[TaskStats]]]]:
+        """Wait for the next chunk to finish and return its [(index, output, stats)]
+
+        The caller sleeps until a result arrives. For processes, the worker sentinels
+        are waited on as well, so a worker that dies without returning its output raises
+        an error in the call it was working for instead of blocking forever.
+
+        :param timeout: Seconds to wait at most, None to wait until a chunk is done
+        :param channel: Channel to return the outputs of
+        :return: None if no chunk finished in time or if `wake` was called
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        inbox = self._inboxes[channel]
+        while True:
+            if self._reader.acquire(blocking=False):
+                try:
+                    return self._lead(channel, inbox, deadline)
+                finally:
+                    self._reader.release()
+                    if self._waiting:
+                        self._handoff()
+            with self._lock:
+                self._waiting.add(channel)
+            try:
+                if self._reader.acquire(blocking=False):
+                    # The reader stopped before this channel started waiting
+                    self._reader.release()
+                    continue
+                remaining = None
+                if deadline is not None:
+                    remaining = max(0, deadline - time.monotonic())
+                try:
+                    item = inbox.get(timeout=remaining)
+                except queue.Empty:
+                    return None
+            finally:
+                with self._lock:
+                    self._waiting.discard(channel)
+            if item is not _HANDOFF:
+                return self._received(channel, item)
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+
+    def _lead(
+        self, channel: int, inbox: queue.Queue, deadline: Optional[float]
+    ) -> Optional[List[Tuple[int, Any, Optional[TaskStats]]]]:
+        """Read the result queue until an item of the channel arrives
+
+        Must be called with the reader lock held. The items of other channels are put in
+        their inboxes.
+
+        :param channel: Channel to return the outputs of
+        :param inbox: Inbox of the channel
+        :param deadline: Time to give up at, None to wait until a chunk is done
+        """
+        while True:
+            if inbox.qsize():
+                # Routed before this thread became the reader, or lost with a worker
+                return self._received(channel, inbox.get_nowait())
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.monotonic())
+            item = self._read(remaining)
+            if item is None:
+                return None
+            if item is _LOST:
+                continue
+            owner, outputs = item
+            if owner == channel:
+                return self._received(channel, outputs)
+            self._route(owner, outputs)
+
+    def _handoff(self):
+        """Let the channels that wait for their inbox take over reading"""
+        with self._lock:
+            inboxes = [self._inboxes[c] for c in self._waiting if c in self._inboxes]
+        for inbox in inboxes:
+            inbox.put(_HANDOFF)
+
+    def wake(self, channel: int = 0):
+        """Make a `get` of a channel that is waiting in another thread return None
+
+        :param channel: Channel to wake
+        """
+        self._results.put((channel, None))
+
+    def expire(self, channel: int = 0) -> List[List[Tuple[int, Any, None]]]:
+        """Stop the workers whose task runs longer than the timeout
+
+        The outputs of the other tasks in the chunk of a stopped worker are lost, those
+        tasks are submitted again. New workers are started when they are needed. The
+        tasks of other channels that are stopped are kept for those channels.
+
+        :param channel: Channel to return the stopped tasks of
+        :return: The [(index, TimeoutError, None)] of every task that was stopped
+        """
+        now = time.time()
+        for worker, (states, _) in list(self._states.items()):
+            with states[0].get_lock():
+                started, owner, index = states[0][:3]
+            if started and now - started > self.timeout:
+                index = int(index)
+                error = TimeoutError(
+                    f"Task {index} did not finish within {self.timeout} seconds"
+                )
+                if self._stop_task(worker, int(owner), index, error):
+                    with self._lock:
+                        if int(owner) in self._expired:
+                            self._expired[int(owner)].append([(index, error, None)])
+        with self._lock:
+            outputs, self._expired[channel] = self._expired[channel], []
+        return outputs
+
+    def cancel(self, index: int, channel: int = 0) -> bool:
+        """Stop the worker that is running a task
+
+        :param index: Index of the task
+        :param channel: Channel the task was submitted to
+        :return: Whether the task was running and is stopped
+        """
+        for worker, (states, _) in list(self._states.items()):
+            with states[0].get_lock():
+                started, owner, running = states[0][:3]
+            if started and int(owner) == channel and int(running) == index:
+                return self._stop_task(worker, channel, index, None)
+        return False
+
+    def stop(self, channel: Optional[int] = 0, hard: bool = False):
+        """Stop the chunks of a channel that are running
+
+        Worker processes receive a keyboard interrupt to give them a chance to handle
+        the exit gracefully, the tasks that were interrupted return an error. This waits
+        until the processes are done with the chunk. Worker threads can not be
+        interrupted safely, they are abandoned and replaced right away, such that a
+        hanging task does not hold up the caller. They can see that they are cancelled
+        with `autothread.cancelled()`. Workers that did not pick up a chunk yet, e.g.
+        because they are still starting, are left alone. Worker processes with several
+        threads are killed, the chunks of other channels they were running are submitted
+        again.
+
+        :param channel: Channel to stop the chunks of, None for all the channels
+        :param hard: Kill the processes right away instead, for tasks that may not
+        respond to an interrupt
+        """
+        threaded = self._Process == threading.Thread
+        interrupted, abandoned = [], []
+        for worker, (states, _) in list(self._states.items()):
+            locks = [state.get_lock() for state in states]
+            for lock in locks:
+                lock.acquire()
+            try:
+                running = [
+                    (int(state[1]), int(state[3])) for state in states if state[0]
+                ]
+                if not any(channel in (None, owner) for owner, _ in running):
+                    continue
+                with self._lock:
+                    if worker not in self._workers:
+                        continue
+                    if not hard and not threaded and len(states) == 1:
+                        interrupted.append((worker, running[0]))
+                        self._interrupt(worker)
+                        continue
+                    self._workers.remove(worker)
+                self._abandon(worker)
+            finally:
+                for lock in locks:
+                    lock.release()
+            for owner, first in running:
+                if channel in (None, owner):
+                    with self._lock:
+                        self._running.pop((owner, first), None)
+                    self._done(owner)
+                elif (owner, first) in self._running:
+                    self._tasks.put((time.time(), owner, self._running[(owner, first)]))
+            with self._lock:
+                # The chunks that are still queued need a worker to replace this one
+                self._replenish()
+            if not threaded:
+                abandoned.append(worker)
+        for worker in abandoned:
+            worker.join()
+        for worker, chunk in interrupted:
+            # Wait until the worker handled the interrupt and returned the outputs, such
+            # that they are thrown away when the channel closes
+            while chunk in self._running and worker.is_alive():
+                self._pump(0.01)
+
+    def _pump(self, timeout: float):
+        """Hand the next item of the result queue to its channel, if nobody else reads
+
+        :param timeout: Seconds to wait at most
+        """
+        if not self._reader.acquire(blocking=False):
+            time.sleep(timeout)
+            return
+        try:
+            item = self._read(timeout)
+            if item is not None and item is not _LOST:
+                self._route(*item)
+        finally:
+            self._reader.release()
+            if self._waiting:
+                self._handoff()
+
+    def _stop_task(
+        self, worker, channel: int, index: int, error: Optional[Exception]
+    ) -> bool:
+        """Stop a worker if it is still running a task and resubmit the rest of its chunk
+
+        :param worker: Worker to stop
+        :param channel: Channel the task was submitted to
+        :param index: Index of the task the worker should be running
+        :param error: Error to mark as intercepted, it becomes the output of the task
+        :return: Whether the worker was stopped
+        """
+        states, _ = self._states.get(worker, (None, None))
+        if states is None:
+            return False
+        state = states[0]
+        with state.get_lock():
+            if not state[0] or int(state[1]) != channel or int(state[2]) != index:
+                return False  # the task finished in the meantime
+            first = int(state[3])
+            with self._lock:
+                if worker not in self._workers:
+                    return False
+                self._workers.remove(worker)
+            self._abandon(worker)
+        with self._lock:
+            chunk = self._running.pop((channel, first), [])
+            # The chunks that are still queued need a worker to replace this one
+            self._replenish()
+        self._done(channel)
+        if error is not None:
+            error.autothread_intercepted = True
+        rest = [task for task in chunk if task[0] != index]
+        if rest and channel in self._inboxes:
+            self.submit(rest, channel)
+        if self._Process != threading.Thread:
+            worker.join()
+        return True
+
+    def _interrupt(self, worker):
+        """Raise a keyboard interrupt in a worker process that is running a chunk
+
+        :param worker: Worker to interrupt
+        """
+        try:
+            os.kill(worker.pid, getattr(signal, "CTRL_C_EVENT", signal.SIGINT))
+        except ProcessLookupError:
+            pass
+
+    def _abandon(self, worker):
+        """Kill a worker process or tell a worker thread to stop
+
+        :param worker: Worker to stop
+        """
+        _, token = self._states.pop(worker, (None, None))
+        self._numbers.pop(worker, None)
+        if self._Process == threading.Thread:
+            token.set()
+        else:
+            worker.kill()
+
+    @property
+    def pids(self) -> List[int]:
+        """Process ids of the workers, the own process id for threads"""
+        if self._Process == threading.Thread:
+            return [self.pid]
+        return [worker.pid for worker in self._workers]
+
+    def kill(self):
+        """Stop all the running chunks and shut the pool down
+
+        The workers get a chance to handle the exit gracefully, see `stop`. A killed
+        pool can not be used anymore.
+        """
+        self.stop(None)
+        self.shutdown()
+
+    def shutdown(self):
+        """Stop all the workers once they are done with their current task"""
+        self._finalizer()
+
+    def _read(self, timeout: Optional[float] = None) -> Any:
+        """Read the next (channel, outputs) from the result queue
+
+        For processes, this also wakes up when a worker died. The error is put in the
+        inbox of the channels the worker was running chunks of. Workers that were
+        stopped on purpose are not waited on.
+
+        :param timeout: Seconds to wait at most, None to wait until a result arrives
+        :return: None if nothing arrived in time, _LOST if a worker died
+        """
+        if self._Process == threading.Thread:
+            try:
+                item = self._results.get(timeout=timeout)
+            except queue.Empty:
+                return None
+        else:
+            reader = self._results._reader
+            sentinels = {worker.sentinel: worker for worker in list(self._workers)}
+            ready = connection.wait([reader, *sentinels], timeout)
+            if not ready:
+                return None
+            if reader not in ready:
+                self._lost(sentinels[ready[0]])
+                return _LOST
+            item = self._results.get()
+            if self._stats and item[1] is not None:
+                item = (item[0], [(i, _unpickled(o), s) for i, o, s in item[1]])
+        channel, outputs = item
+        if outputs is not None:
+            with self._lock:
+                self._running.pop((channel, outputs[0][0]), None)
+        return item
+
+    def _lost(self, worker):
+        """Fail the chunks of a worker that died and replace it
+
+        :param worker: Worker that died
+        """
+        states, _ = self._states.get(worker, (None, None))
+        with self._lock:
+            if worker not in self._workers:
+                return
+            self._workers.remove(worker)
+        worker.join()
+        running = [(int(state[1]), int(state[3])) for state in states if state[0]]
+        self._states.pop(worker, None)
+        self._numbers.pop(worker, None)
+        with self._lock:
+            for key in running:
+                self._running.pop(key, None)
+            # Without a known chunk, every call may be waiting for the lost chunk
+            channels = {owner for owner, _ in running} or set(self._inboxes)
+            self._replenish()
+        for owner in channels:
+            error = RuntimeError(
+                f"Worker {worker.name} exited unexpectedly with exit code "
+                f"{worker.exitcode}"
+            )
+            lost = sum(owner == other for other, _ in running)
+            self._route(owner, _Died(error, lost))
+
+    def _replenish(self):
+        """Start a new worker if all are busy, must be called with the lock held"""
+        if len(self._workers) * self._threads < self.n_pending and (
+            self.n_workers <= 0 or len(self._workers) < self.n_workers
+        ):
+            self._start_worker()
+
+    def _start_worker(self):
+        """Start a new worker that pulls tasks from the task queue"""
+        start = time.perf_counter()
+        threaded = self._Process == threading.Thread
+        hybrid = self._threads > 1 and not threaded
+        if threaded:
+            states = [_ThreadState()]
+        else:
+            states = [mp.Array("d", 4) for _ in range(self._threads if hybrid else 1)]
+        token = threading.Event() if threaded else None
+        cpus = None
+        if self._placement is not None and not threaded:
+            # A new worker takes the number of a worker that was stopped
+            taken = {self._numbers.get(worker) for worker in self._workers}
+            number = min(set(range(len(self._workers) + 1)) - taken)
+            cpus = self._placement.cpus(number)
+        target, args = _worker, (self._tasks, self._results, self._function)
+        kwargs = dict(state=states[0])
+        if hybrid:
+            target, args = _hybrid_worker, (self._threads, *args)
+            kwargs = dict(states=states)
+        worker = self._Process(
+            target=target,
+            args=args,
+            kwargs=dict(
+                shared_memory=self._shared_memory,
+                stats=self._stats,
+                serialized=not threaded,
+                token=token,
+                track=self._track,
+                retry=self._retry,
+                budget=None if threaded else self.budget,
+                cpus=cpus,
+                initializer=self._initializer,
+                **kwargs,
+            ),
+            daemon=threaded,
+        )
+        worker.start()
+        if cpus is not None:
+            self._numbers[worker] = number
+        self._workers.append(worker)
+        self._states[worker] = (states, token)
+        self.spawn_time += time.perf_counter() - start
+
+    @staticmethod
+    def _stop_workers(
+        tasks: Union[queue.Queue, mp.Queue],
+        results: Union[queue.Queue, mp.SimpleQueue],
+        workers: list,
+        threads: int = 1,
+    ):
+        """Send a stop signal to all the workers and wait for them to exit
+
+        This is a staticmethod such that the finalizer does not keep the pool alive. The
+        result queue is drained while waiting, since a process can not exit before the
+        items it put on a queue are consumed.
+
+        :param tasks: Queue the workers receive their tasks from
+        :param results: Queue the workers put their outputs on
+        :param workers: List of workers to stop
+        :param threads: Number of threads of every worker, each needs its own signal
+        """
+        for _ in range(len(workers) * threads):
+            tasks.put(None)
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(0.1)
+                while not results.empty():
+                    item = results.get()
+                    if item is not None and item[1] is not None:
+                        _Channels._drop(item[1])
+        workers.clear()
+
+
+class _CoroutinePool(_Channels):
+    """Event loop that runs the tasks of a coroutine function
+
+    This pool has the same interface as the _WorkerPool, but instead of starting a
+    thread per worker, all the tasks run as coroutines on a single event loop in a
+    background thread. Every submitted chunk runs concurrently with the others, so the
+    number of concurrent coroutines is limited by the number of pending chunks.
+    """
+
+    def __init__(
+        self,
+        function: Callable,
+        n_workers: int,
+        stats: bool = False,
+        timeout: Optional[float] = None,
+        retry: Optional[_RetryPolicy] = None,
+        initializer: Optional[_Initializer] = None,
+    ):
+        """Initialize the pool
+
+        :param function: coroutine function to run
+        :param n_workers: Maximum number of concurrent coroutines (<= 0 for unlimited)
+        :param stats: Whether to record statistics of every task
+        :param timeout: Seconds a task may run before it is cancelled, None for no limit
+        :param retry: Policy to run failed tasks again, None to not retry them
+        :param initializer: Sets up the context of the thread of the event loop, which
+        all the coroutines share. None for no context.
+        """
+        self._function = function
+        self.n_workers = n_workers
+        self._stats = stats
+        self.timeout = timeout
+        self._retry = retry
+        self.pid = os.getpid()
+        self.spawn_time = 0.0
+        self._open_channels()
+        # channel -> futures of the chunks that are running
+        self._futures: Dict[int, set] = {}
+        self._initializer = initializer or _Initializer()
+        self._failed = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        # The loop is stopped at exit, such that the teardown of the context runs
+        self._finalizer = util.Finalize(
+            self,
+            _CoroutinePool._stop_loop,
+            args=(self._loop, self._thread),
+            exitpriority=15,
+        )
+
+    def submit(self, chunk: List[Tuple[int, List, Dict]], channel: int = 0):
+        """Submit a chunk of tasks to the event loop
+
+        :param chunk: List of (index, args, kwargs) tasks that are awaited one by one.
+        The index is returned together with the output of the task.
+        :param channel: Channel that receives the outputs
+        """
+        with self._lock:
+            self.n_pending += 1
+            self._pending[channel] += 1
+            futures = self._futures.setdefault(channel, set())
+        coroutine = self._run(time.time(), channel, chunk)
+        future = asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+        futures.add(future)
+        future.add_done_callback(lambda f: self._cancelled(f, channel))
+
+    def _cancelled(self, future: asyncio.Future, channel: int):
+        """Forget the future of a chunk, a cancelled chunk never returns its outputs
+
+        :param future: Future of the chunk
+        :param channel: Channel the chunk was submitted to
+        """
+        self._futures.get(channel, set()).discard(future)
+        if future.cancelled():
+            self._done(channel)
+
+    def get(
+        self, timeout: Optional[float] = None, channel: int = 0
+    ) -> Optional[List[Tuple[int, Any, Optional[TaskStats]]]]:
+        """Wait for the next chunk to finish and return its [(index, output, stats)]
+
+        :param timeout: Seconds to wait at most, None to wait until a chunk is done
+        :param channel: Channel to return the outputs of
+        :return: None if no chunk finished in time or if `wake` was called
+        """
+        try:
+            item = self._inboxes[channel].get(timeout=timeout)
+        except queue.Empty:
+            return None
+        return self._received(channel, item)
+
+    def wake(self, channel: int = 0):
+        """Make a `get` of a channel that is waiting in another thread return None
+
+        :param channel: Channel to wake
+        """
+        self._route(channel, None)
+
+    def expire(self, channel: int = 0) -> List:
+        """The coroutines time out by themselves, there is nothing to stop
+
+        :param channel: Channel to return the stopped tasks of
+        """
+        return []
+
+    def cancel(self, index: int, channel: int = 0) -> bool:
+        """Single coroutines can not be cancelled, the whole pool can
+
+        :param index: Index of the task
+        :param channel: Channel the task was submitted to
+        """
+        return False
+
+    def stop(self, channel: Optional[int] = 0, hard: bool = False):
+        """Cancel the running coroutines of a channel
+
+        The coroutines receive a `CancelledError` to give them a chance to handle the
+        exit gracefully.
+
+        :param channel: Channel to stop the chunks of, None for all the channels
+        :param hard: Has no effect, coroutines are always cancelled the same way
+        """
+        with self._lock:
+            channels = list(self._futures) if channel is None else [channel]
+            futures = [f for c in channels for f in self._futures.get(c, ())]
+        for future in futures:
+            future.cancel()
+
+    @property
+    def pids(self) -> List[int]:
+        """Process id of the event loop"""
+        return [self.pid]
+
+    def kill(self):
+        """Cancel all the running coroutines and shut the pool down
+
+        A killed pool can not be used anymore.
+        """
+        self.stop(None)
+        self.shutdown()
+
+    def shutdown(self):
+        """Stop the event loop"""
+        self._finalizer()
+
+    @staticmethod
+    def _stop_loop(loop: asyncio.AbstractEventLoop, thread: threading.Thread):
+        """Stop an event loop and wait until its thread ran the teardown of the context
+
+        :param loop: Event loop to stop
+        :param thread: Thread that runs the event loop
+        """
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+    def _serve(self):
+        """Run the event loop until the pool shuts down, within the context"""
+        with self._initializer.run() as failed:
+            self._failed = failed
+            self._loop.run_forever()
+
+    async def _attempt(self, args: List, kwargs: Dict) -> Any:
+        """Await a task, awaiting it again after a failure as the policy allows
+
+        :param args: Arguments of the task
+        :param kwargs: Keyword arguments of the task
+        """
+        attempt = 1
+        while True:
+            try:
+                return await self._function(*args, **kwargs)
+            except Exception as e:
+                if self._retry is None or not self._retry.retry(e, attempt):
+                    e.autothread_attempts = attempt
+                    raise
+            await asyncio.sleep(self._retry.delay(attempt))
+            attempt += 1
+
+    async def _run(
+        self, submitted: float, channel: int, chunk: List[Tuple[int, List, Dict]]
+    ):
+        """Await the tasks of a chunk and put their outputs in the inbox of the channel
+
+        :param submitted: Time the chunk was submitted
+        :param channel: Channel that receives the outputs
+        :param chunk: List of (index, args, kwargs) tasks
+        """
+        outputs = []
+        for index, args, kwargs in chunk:
+            started = time.time()
+            try:
+                if self._failed is not None:
+                    raise self._failed
+                coroutine = self._attempt(args, kwargs)
+                if self.timeout is None:
+                    output = await coroutine
+                else:
+                    try:
+                        output = await asyncio.wait_for(coroutine, self.timeout)
+                    except asyncio.TimeoutError:
+                        raise TimeoutError(
+                            f"Task {index} did not finish within {self.timeout} seconds"
+                        ) from None
+            except Exception as e:
+                e.autothread_intercepted = True
+                output = e
+            task_stats = None
+            if self._stats:
+                task_stats = TaskStats(
+                    index=index,
+                    worker=threading.current_thread().name,
+                    queue_wait=started - submitted,
+                    run_time=time.time() - started,
+                )
+            outputs.append((index, output, task_stats))
+        self._route(channel, outputs)
+
+
+class _Channel:
+    """The share of a call in the pool of its function
+
+    It has the interface of a pool, but only the outputs of the chunks that were
+    submitted through it are returned.
+    """
+
+    def __init__(self, pool: Union[_WorkerPool, _CoroutinePool], key: Any = None):
+        """Open a channel of a pool
+
+        :param pool: Pool that runs the chunks
+        :param key: Key of the pool in its _PoolSet
+        """
+        self.pool = pool
+        self.key = key
+        self.id = pool.open()
+
+    @property
+    def n_pending(self) -> int:
+        """Number of chunks of this call that did not return yet"""
+        return self.pool.pending(self.id)
+
+    @property
+    def n_workers(self) -> int:
+        """Maximum number of workers of the pool"""
+        return self.pool.n_workers
+
+    @n_workers.setter
+    def n_workers(self, n_workers: int):
+        self.pool.n_workers = n_workers
+
+    @property
+    def timeout(self) -> Optional[float]:
+        """Seconds a task may run, None for no limit"""
+        return self.pool.timeout
+
+    @property
+    def spawn_time(self) -> float:
+        """Seconds the pool spent on starting workers"""
+        return self.pool.spawn_time
+
+    @property
+    def pids(self) -> List[int]:
+        """Process ids of the workers"""
+        return self.pool.pids
+
+    def submit(self, chunk: List[Tuple[int, List, Dict]]):
+        """Submit a chunk of tasks, see `_WorkerPool.submit`"""
+        self.pool.submit(chunk, self.id)
+
+    def get(
+        self, timeout: Optional[float] = None
+    ) -> Optional[List[Tuple[int, Any, Optional[TaskStats]]]]:
+        """Wait for the outputs of the next chunk, see `_WorkerPool.get`"""
+        return self.pool.get(timeout, self.id)
+
+    def wake(self):
+        """Make a `get` that is waiting in another thread return None"""
+        self.pool.wake(self.id)
+
+    def expire(self) -> List[List[Tuple[int, Any, None]]]:
+        """Stop the tasks that take too long, see `_WorkerPool.expire`"""
+        return self.pool.expire(self.id)
+
+    def stop(self, hard: bool = False):
+        """Stop the running chunks of this call, see `_WorkerPool.stop`"""
+        self.pool.stop(self.id, hard)
+
+    def close(self):
+        """Close the channel, the outputs that still arrive are dropped"""
+        self.pool.close(self.id)
+
+
+class _PoolSet:
+    """The pool of a decorated function, shared by the calls that run at the same time
+
+    All the calls run their chunks on the same workers, each through a channel of its
+    own, so the outputs of concurrent calls never mix. The pool stays alive when the
+    calls are done, such that the workers do not have to be started again. The calls
+    share the capacity: together they never have more chunks pending than the limit of
+    a single call. Worker processes only know the budget of `autothread.limit` they
+    were started with, calls with another budget get a pool of their own.
+    """
+
+    def __init__(self):
+        """Initialize the set without any pools"""
+        self._reset()
+
+    def _reset(self):
+        """Forget all the pools and calls, e.g. the ones of the parent process"""
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._pools: Dict[Any, Union[_WorkerPool, _CoroutinePool]] = {}
+        # key -> number of channels that are open
+        self._users: Dict[Any, int] = {}
+        self._submitting = 0
+        self.invocations = set()
+
+    def acquire(
+        self,
+        create: Callable[[], Union[_WorkerPool, _CoroutinePool]],
+        key: Any = None,
+    ) -> _Channel:
+        """Open a channel of the pool, creating the pool if there is none yet
+
+        Pools with another key that are not in use are shut down.
+
+        :param create: function that creates a new pool
+        :param key: The budget of `autothread.limit` for worker processes, None for
+        pools that do not depend on it
+        """
+        if self._pid != os.getpid():
+            # The set was copied into a forked process, its pools are not ours
+            self._reset()
+        with self._lock:
+            outdated = [
+                other
+                for other in self._pools
+                if other is not key and not self._users[other]
+            ]
+            for other in outdated:
+                del self._users[other]
+            outdated = [self._pools.pop(other) for other in outdated]
+            if key not in self._pools:
+                self._pools[key] = create()
+                self._users[key] = 0
+            self._users[key] += 1
+            channel = _Channel(self._pools[key], key)
+        for pool in outdated:
+            pool.shutdown()
+        return channel
+
+    def release(self, channel: _Channel):
+        """Close the channel of a call that is done
+
+        :param channel: Channel that was opened by `acquire`
+        """
+        channel.close()
+        with self._lock:
+            if self._pools.get(channel.key) is channel.pool:
+                self._users[channel.key] -= 1
+            self._changed.notify_all()
+
+    def submit(
+        self, channel: _Channel, chunk: List[Tuple[int, List, Dict]], limit: float
+    ) -> bool:
+        """Submit a chunk if the calls together have less than `limit` chunks pending
+
+        The pool is not submitted to with the lock held, starting a worker process
+        while another thread holds a lock would copy the held lock into the worker.
+
+        :param channel: Channel of the call
+        :param chunk: Chunk to submit
+        :param limit: Maximum number of chunks pending over all the calls
+        :return: Whether the chunk was submitted
+        """
+        with self._lock:
+            if len(self.invocations) > 1:
+                pending = sum(pool.n_pending for pool in self._pools.values())
+                if pending + self._submitting >= limit:
+                    return False
+            self._submitting += 1
+        try:
+            channel.submit(chunk)
+        finally:
+            with self._lock:
+                self._submitting -= 1
+        return True
+
+    def wait(self, timeout: float):
+        """Wait until another call received an output or is done
+
+        :param timeout: Seconds to wait at most
+        """
+        with self._changed:
+            self._changed.wait(timeout)
+
+    def notify(self):
+        """Wake the calls that wait for capacity, after receiving an output"""
+        if len(self.invocations) > 1:
+            with self._changed:
+                self._changed.notify_all()
+
+    def shutdown(self):
+        """Stop the workers of the pools that are not in use"""
+        with self._lock:
+            idle = [key for key in self._pools if not self._users[key]]
+            for key in idle:
+                del self._users[key]
+            idle = [self._pools.pop(key) for key in idle]
+        for pool in idle:
+            pool.shutdown()
@@ -0,0 +1,73 @@
+from typing import Any, Callable, Dict, Tuple, Type, Union
+
+
+class TaskFailure:
+    """A task that still failed after all its attempts
+
+    Returned in the failure list of a call with `return_failures=True`.
+    """
+
+    __slots__ = ("index", "item", "error", "attempts")
+
+    def __init__(
+        self, index: int, item: Dict[str, Any], error: Exception, attempts: int
+    ):
+        """Initialize the failure
+
+        :param index: Index of the task in the input. With `batch_size`, the index of
+        the first item of the batch
+        :param item: {parameter: item} of the loop parameters of the task
+        :param error: Error of the last attempt
+        :param attempts: Number of times the task was run
+        """
+        self.index = index
+        self.item = item
+        self.error = error
+        self.attempts = attempts
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{k}={getattr(self, k)!r}" for k in self.__slots__)
+        return f"TaskFailure({fields})"
+
+
+class _RetryPolicy:
+    """Decides if a failed task runs again and how long to wait before it does
+
+    The policy is sent to the workers, which retry the task themselves, such that a
+    retry does not have to wait for the rest of the chunk or go through the queues.
+    """
+
+    def __init__(
+        self,
+        retries: int,
+        retry_on: Union[Type[Exception], Tuple[Type[Exception], ...]] = Exception,
+        backoff: Union[float, Callable[[int], float]] = 0.0,
+    ):
+        """Initialize the policy
+
+        :param retries: Number of times a task is run again after it failed
+        :param retry_on: Exception type(s) that are retried, other errors are not
+        :param backoff: Seconds to wait before the first retry, doubled for every next
+        retry. Or a function that receives the number of the attempt that failed
+        (starting at 1) and returns the seconds to wait.
+        """
+        self.retries = retries
+        self.retry_on = retry_on
+        self.backoff = backoff
+
+    def retry(self, error: Exception, attempt: int) -> bool:
+        """Check if a task must run again
+
+        :param error: Error the task raised
+        :param attempt: Number of the attempt that failed, starting at 1
+        """
+        return attempt <= self.retries and isinstance(error, self.retry_on)
+
+    def delay(self, attempt: int) -> float:
+        """Seconds to wait before running a task again
+
+        :param attempt: Number of the attempt that failed, starting at 1
+        """
+        if callable(self.backoff):
+            return self.backoff(attempt)
+        return self.backoff * 2 ** (attempt - 1)
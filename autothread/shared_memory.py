@@ -0,0 +1,242 @@
+import mmap
+import os
+import weakref
+
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from multiprocess import resource_tracker, shared_memory
+except ImportError:  # Python < 3.8
+    resource_tracker, shared_memory = None, None
+
+# Arrays smaller than this are cheaper to pickle than to copy into shared memory
+_MIN_SHARED_BYTES = 2**16
+
+# id(memory) -> (name, address) and name -> memory of the blocks mapped in this process
+_addresses: Dict[int, Tuple[str, int]] = {}
+_memories: Dict[str, weakref.ref] = {}
+
+
+class _SharedArray:
+    """Descriptor of a numpy array in a shared memory block
+
+    Only the descriptor is sent to the other process, which creates an array that uses
+    the same memory.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        offset: int,
+        shape: Tuple,
+        strides: Tuple,
+        dtype,
+        handover: bool = False,
+    ):
+        """Initialize the descriptor
+
+        :param name: Name of the shared memory block
+        :param offset: Offset of the first item of the array in the block
+        :param shape: Shape of the array
+        :param strides: Strides of the array
+        :param dtype: Data type of the array
+        :param handover: Whether the receiving process becomes the owner of the block
+        """
+        self.name = name
+        self.offset = offset
+        self.shape = shape
+        self.strides = strides
+        self.dtype = dtype
+        self.handover = handover
+
+
+def shared_array(shape, dtype=float) -> "np.ndarray":
+    """Create a numpy array filled with zeros in shared memory
+
+    When this array (or a view of it) is passed to a function that is decorated with
+    `multiprocessed(shared_memory=True)`, the processes write directly into it instead
+    of into a copy. The memory is released when the array and all its views are deleted.
+
+    :param shape: Shape of the array
+    :param dtype: Data type of the array
+    """
+    _check_available()
+    dtype = np.dtype(dtype)
+    size = max(1, int(np.prod(shape)) * dtype.itemsize)
+    block = shared_memory.SharedMemory(create=True, size=size)
+    return np.ndarray(shape, dtype, buffer=_map(block, owned=True))
+
+
+def _check_available():
+    """Raise an error if numpy arrays can not be shared between processes"""
+    if np is None:
+        raise ImportError("Sharing arrays between processes requires numpy")
+    if shared_memory is None:
+        raise ImportError("Sharing arrays between processes requires Python >= 3.8")
+
+
+def _map(block: "shared_memory.SharedMemory", owned: bool) -> mmap.mmap:
+    """Take the memory out of a shared memory block and register it
+
+    The block is closed, the memory stays mapped until the last array that uses it is
+    deleted.
+
+    :param block: Shared memory block to take the memory from
+    :param owned: Whether to unlink the block once the memory is released
+    """
+    memory = block.buf.obj
+    block._buf.release()
+    block._buf, block._mmap = None, None
+    block.close()
+
+    address = np.frombuffer(memory, np.uint8).__array_interface__["data"][0]
+    _addresses[id(memory)] = (block.name, address)
+    _memories[block.name] = weakref.ref(memory)
+    weakref.finalize(memory, _release, block, id(memory), owned and os.getpid())
+    return memory
+
+
+def _release(block: "shared_memory.SharedMemory", key: int, owner: Optional[int]):
+    """Forget a shared memory block once its memory is released
+
+    :param block: Shared memory block to forget
+    :param key: id of the memory of the block
+    :param owner: pid of the process that unlinks the block, None to keep it
+    """
+    _addresses.pop(key, None)
+    _memories.pop(block.name, None)
+    if owner == os.getpid():
+        try:
+            block.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _describe(array: "np.ndarray") -> Optional[_SharedArray]:
+    """Return the descriptor of an array in shared memory, None if it is not shared
+
+    :param array: Array (or a view of an array) to describe
+    """
+    base = array
+    while isinstance(base, np.ndarray):
+        base = base.base
+    if id(base) not in _addresses:
+        return None
+    name, address = _addresses[id(base)]
+    offset = array.__array_interface__["data"][0] - address
+    return _SharedArray(name, offset, array.shape, array.strides, array.dtype)
+
+
+def _is_array(value: Any) -> bool:
+    """Check if a value is a numpy array that can be put in shared memory"""
+    return (
+        np is not None and isinstance(value, np.ndarray) and not value.dtype.hasobject
+    )
+
+
+def _share(value: Any, inputs: List) -> Any:
+    """Replace a numpy array input by the descriptor of an array in shared memory
+
+    Arrays that are already in shared memory are always shared, such that processes
+    can write into them. Other large arrays are copied into a new block, which is kept
+    alive by adding it to `inputs`.
+
+    :param value: Value to share
+    :param inputs: List to keep the copies alive until the tasks are done
+    """
+    if not _is_array(value):
+        return value
+    descriptor = _describe(value)
+    if descriptor is None and value.nbytes >= _MIN_SHARED_BYTES:
+        copy = shared_array(value.shape, value.dtype)
+        copy[...] = value
+        inputs.append(copy)
+        descriptor = _describe(copy)
+    return value if descriptor is None else descriptor
+
+
+def _share_result(value: Any) -> Any:
+    """Replace a numpy array output by the descriptor of an array in shared memory
+
+    Large arrays that are not in shared memory yet are copied into a new block, which
+    is handed over to the process that receives the descriptor. On Windows, a block is
+    removed as soon as no process has it open, so those arrays are pickled instead. The
+    block stays tracked until `_hand_over`, such that the resource tracker removes it
+    when the worker is killed before it returned the output.
+
+    :param value: Output of the function
+    """
+    if not _is_array(value):
+        return value
+    descriptor = _describe(value)
+    if descriptor is None and value.nbytes >= _MIN_SHARED_BYTES and os.name != "nt":
+        block = shared_memory.SharedMemory(create=True, size=value.nbytes)
+        copy = np.ndarray(value.shape, value.dtype, buffer=block.buf)
+        copy[...] = value
+        descriptor = _SharedArray(
+            block.name, 0, copy.shape, copy.strides, copy.dtype, handover=True
+        )
+        del copy
+        block.close()
+    return value if descriptor is None else descriptor
+
+
+def _attach(value: Any) -> Any:
+    """Replace a shared memory descriptor by a numpy array that uses the shared memory
+
+    :param value: Value to attach
+    """
+    if not isinstance(value, _SharedArray):
+        return value
+    memory = _memories[value.name]() if value.name in _memories else None
+    if memory is None:
+        block = shared_memory.SharedMemory(value.name)
+        memory = _map(block, owned=False)
+        if value.handover:
+            # The memory stays available until the array is deleted
+            resource_tracker.register(block._name, "shared_memory")
+            block.unlink()
+    return np.ndarray(
+        value.shape,
+        value.dtype,
+        buffer=memory,
+        offset=value.offset,
+        strides=value.strides,
+    )
+
+
+def _hand_over(value: Any):
+    """Stop tracking the block of an output right before it is returned
+
+    The receiving process unlinks the block, either when it attaches the output or when
+    it throws the output away (see `_discard`). Other values are ignored.
+
+    :param value: Output that is about to be returned
+    """
+    if isinstance(value, _SharedArray) and value.handover:
+        name = value.name
+        if shared_memory.SharedMemory._prepend_leading_slash:
+            name = "/" + name
+        resource_tracker.unregister(name, "shared_memory")
+
+
+def _discard(value: Any):
+    """Remove the block of an output that was handed over but is never attached
+
+    E.g. the outputs of a call that failed or was stopped. Other values are ignored.
+
+    :param value: Output that is thrown away
+    """
+    if not isinstance(value, _SharedArray) or not value.handover:
+        return
+    try:
+        block = shared_memory.SharedMemory(value.name)
+    except FileNotFoundError:
+        return
+    block.close()
+    block.unlink()
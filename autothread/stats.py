@@ -0,0 +1,186 @@
+import sys
+
+from multiprocess.reduction import ForkingPickler
+from typing import Any, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+    import psutil
+
+
+class TaskStats:
+    """Statistics of a single task (a single item of the loop parameters)"""
+
+    __slots__ = (
+        "index",
+        "worker",
+        "queue_wait",
+        "run_time",
+        "arg_bytes",
+        "result_bytes",
+        "peak_rss",
+    )
+
+    def __init__(
+        self,
+        index: int,
+        worker: str,
+        queue_wait: float,
+        run_time: float,
+        arg_bytes: Optional[int] = None,
+        result_bytes: Optional[int] = None,
+        peak_rss: Optional[int] = None,
+    ):
+        """Initialize the statistics
+
+        :param index: Index of the task in the input
+        :param worker: Name of the thread/process that ran the task
+        :param queue_wait: Seconds between submitting the task and starting it
+        :param run_time: Seconds it took to run the function
+        :param arg_bytes: Size of the pickled arguments, None for threads
+        :param result_bytes: Size of the pickled output, None for threads
+        :param peak_rss: Peak resident memory of the worker process in bytes, None for
+        threads
+        """
+        self.index = index
+        self.worker = worker
+        self.queue_wait = queue_wait
+        self.run_time = run_time
+        self.arg_bytes = arg_bytes
+        self.result_bytes = result_bytes
+        self.peak_rss = peak_rss
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{k}={getattr(self, k)!r}" for k in self.__slots__)
+        return f"TaskStats({fields})"
+
+
+class CallStats:
+    """Statistics of a call of a decorated function
+
+    The totals are summed over all the tasks of the call, e.g. `run_time` is the time
+    spent in the function by all the workers together, not the wall time.
+    """
+
+    def __init__(
+        self,
+        tasks: List[TaskStats],
+        wall_time: float,
+        type_check_time: float = 0.0,
+        spawn_time: float = 0.0,
+        memory_wait: float = 0.0,
+        cache_hits: int = 0,
+    ):
+        """Initialize the statistics
+
+        :param tasks: Statistics of every task that ran, in the order of the input
+        :param wall_time: Seconds between calling the function and receiving the last
+        output
+        :param type_check_time: Seconds spent determining the loop parameters
+        :param spawn_time: Seconds spent starting workers
+        :param memory_wait: Seconds the tasks could not start because there was not
+        enough memory available
+        :param cache_hits: Number of tasks whose output was found in the cache or in
+        the checkpoint
+        """
+        self.tasks = tasks
+        self.wall_time = wall_time
+        self.type_check_time = type_check_time
+        self.spawn_time = spawn_time
+        self.memory_wait = memory_wait
+        self.cache_hits = cache_hits
+
+    @property
+    def n_tasks(self) -> int:
+        """Number of tasks that finished"""
+        return len(self.tasks)
+
+    @property
+    def queue_wait(self) -> float:
+        """Total seconds the tasks waited before they were started"""
+        return sum(task.queue_wait for task in self.tasks)
+
+    @property
+    def run_time(self) -> float:
+        """Total seconds spent running the function"""
+        return sum(task.run_time for task in self.tasks)
+
+    @property
+    def arg_bytes(self) -> Optional[int]:
+        """Total size of the pickled arguments, None for threads"""
+        return self._total("arg_bytes")
+
+    @property
+    def result_bytes(self) -> Optional[int]:
+        """Total size of the pickled outputs, None for threads"""
+        return self._total("result_bytes")
+
+    @property
+    def peak_rss(self) -> Optional[int]:
+        """Highest peak resident memory of the worker processes, None for threads"""
+        values = [task.peak_rss for task in self.tasks if task.peak_rss is not None]
+        return max(values) if values else None
+
+    def _total(self, attr: str) -> Optional[int]:
+        """Sum an attribute of the tasks, None if none of the tasks has it"""
+        values = [getattr(task, attr) for task in self.tasks]
+        values = [value for value in values if value is not None]
+        return sum(values) if values else None
+
+    def __repr__(self) -> str:
+        fields = (
+            "n_tasks",
+            "wall_time",
+            "type_check_time",
+            "spawn_time",
+            "memory_wait",
+            "cache_hits",
+            "queue_wait",
+            "run_time",
+            "arg_bytes",
+            "result_bytes",
+            "peak_rss",
+        )
+        return "CallStats({})".format(
+            ", ".join(f"{k}={getattr(self, k)!r}" for k in fields)
+        )
+
+
+class _Pickled:
+    """A value that is pickled before it is put on a queue, to measure its size
+
+    The queue pickles the bytes again, which copies them but does not serialize the
+    value a second time.
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, value: Any):
+        """Pickle a value
+
+        :param value: Value to send through a queue
+        """
+        self.data = bytes(ForkingPickler.dumps(value))
+
+    def load(self) -> Any:
+        """Unpickle the value"""
+        return ForkingPickler.loads(self.data)
+
+
+def _unpickled(value: Any) -> Any:
+    """Unpickle a value if it was pickled in advance, see `_Pickled`
+
+    :param value: Value received from a queue
+    """
+    return value.load() if isinstance(value, _Pickled) else value
+
+
+def _peak_rss() -> int:
+    """Peak resident memory of this process in bytes"""
+    if resource is None:
+        return psutil.Process().memory_info().peak_wset
+    # Linux reports kilobytes, macOS reports bytes
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
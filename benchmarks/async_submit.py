@@ -0,0 +1,41 @@
+"""
+Measures the time and memory it takes to queue a large number of calls of a non-blocking
+function and to collect their results. Only `n_workers` workers should exist, no
+matter how many calls are waiting.
+
+Run with `python -m benchmarks.async_submit` from the base dir.
+"""
+
+import autothread
+import psutil
+import threading
+import time
+
+
+def square(x: int) -> int:
+    return x * x
+
+
+def measure(decorator, n_calls: int):
+    function = decorator(n_workers=8)(square)
+    rss_start = psutil.Process().memory_info().rss
+
+    start = time.perf_counter()
+    results = [function(i) for i in range(n_calls)]
+    submitted = time.perf_counter() - start
+    n_threads = threading.active_count()
+    rss = psutil.Process().memory_info().rss - rss_start
+
+    total = sum(results)
+    duration = time.perf_counter() - start
+    return submitted, duration, n_threads, rss
+
+
+if __name__ == "__main__":
+    for decorator in (autothread.async_threaded, autothread.async_processed):
+        for n_calls in (1000, 50000):
+            submitted, duration, n_threads, rss = measure(decorator, n_calls)
+            print(
+                f"{decorator.__name__:<15} calls={n_calls:<6} submit={submitted:.3f}s "
+                f"total={duration:.3f}s threads={n_threads} rss=+{rss / 1024**2:.0f}MB"
+            )
@@ -0,0 +1,37 @@
+"""
+Measures how much CPU time the calling thread spends while waiting for long-running
+tasks. The calling thread should sleep until a result arrives, so its CPU time should
+stay close to zero no matter how long the tasks take.
+
+Run with `python -m benchmarks.coordinator_cpu` from the base dir.
+"""
+
+import autothread
+import time
+
+
+def sleeper(x: int, duration: float):
+    time.sleep(duration)
+    return x
+
+
+def measure(decorator, n_tasks: int, duration: float):
+    function = decorator(n_workers=n_tasks)(sleeper)
+    function(list(range(n_tasks)), 0)  # start the workers
+
+    wall_start, cpu_start = time.perf_counter(), time.thread_time()
+    function(list(range(n_tasks)), duration)
+    wall, cpu = time.perf_counter() - wall_start, time.thread_time() - cpu_start
+
+    function.shutdown()
+    return wall, cpu
+
+
+if __name__ == "__main__":
+    for decorator in (autothread.multithreaded, autothread.multiprocessed):
+        for n_tasks, duration in ((4, 1), (16, 2)):
+            wall, cpu = measure(decorator, n_tasks, duration)
+            print(
+                f"{decorator.__name__:<15} tasks={n_tasks:<3} duration={duration}s "
+                f"wall={wall:.3f}s coordinator_cpu={cpu * 1000:.2f}ms"
+            )
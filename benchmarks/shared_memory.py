@@ -0,0 +1,43 @@
+"""
+Measures the time it takes to pass a large numpy array to every task and to return a
+large array from every task, with and without `shared_memory`.
+
+Run with `python -m benchmarks.shared_memory` from the base dir.
+"""
+
+import autothread
+import numpy as np
+import time
+
+
+def row_sum(i: int, data: np.ndarray):
+    return data[i].sum()
+
+
+def scaled(i: int, data: np.ndarray):
+    return data * i
+
+
+def measure(function, shared_memory: bool, data: np.ndarray, n_tasks: int):
+    function = autothread.multiprocessed(n_workers=4, shared_memory=shared_memory)(
+        function
+    )
+    function(list(range(4)), data[:4])  # start the workers
+
+    start = time.perf_counter()
+    function(list(range(n_tasks)), data)
+    duration = time.perf_counter() - start
+
+    function.shutdown()
+    return duration
+
+
+if __name__ == "__main__":
+    data = np.random.rand(64, 2 * 10**5)  # ~100MB
+    for function in (row_sum, scaled):
+        for shared_memory in (False, True):
+            duration = measure(function, shared_memory, data, n_tasks=16)
+            print(
+                f"{function.__name__:<8} shared_memory={shared_memory!s:<5} "
+                f"array={data.nbytes / 1024**2:.0f}MB tasks=16 time={duration:.3f}s"
+            )
@@ -0,0 +1,249 @@
+"""
+Compares the autothread decorators with concurrent.futures and multiprocessing.Pool for
+different task durations, list sizes and argument sizes. For every case, the wall time,
+the overhead per task, the throughput and the peak memory usage (RSS of the process and
+all its children) are measured. The time to start the workers is included, since that
+is what a single call of a decorated function costs.
+
+Every case runs in a fresh interpreter, such that the cases do not influence each
+other. Cases that would take too long (e.g. a million tasks of one second) are skipped.
+
+Run with `python -m benchmarks.suite` from the base dir. Options:
+- `--full`: Run all the task durations (1us-1s), list sizes (10-1e6) and argument sizes
+  (0-1MB) instead of a quick subset.
+- `--output results.json`: Write the results as JSON.
+- `--compare baseline.json`: Compare the wall times with an earlier `--output` and exit
+  with code 1 if a case got more than `--tolerance` (default 0.25) slower.
+"""
+
+import argparse
+import autothread
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import psutil
+import subprocess
+import sys
+import threading
+import time
+
+N_WORKERS = 4
+MAX_SECONDS = 10  # skip cases that take longer than this without any overhead
+MAX_BYTES = 2**30  # skip cases that send more data than this to the workers
+MIN_SECONDS = 0.1  # wall times below this are too noisy to compare
+
+QUICK = {"duration": [1e-6, 1e-2], "n_tasks": [10, 1000], "arg_size": [0, 2**10]}
+FULL = {
+    "duration": [1e-6, 1e-3, 1e-1, 1],
+    "n_tasks": [10, 1000, 10**6],
+    "arg_size": [0, 2**10, 2**20],
+}
+
+
+def task(x: int, payload: bytes, duration: float) -> int:
+    if duration >= 1e-3:
+        time.sleep(duration)
+    else:
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            pass
+    return x
+
+
+def run_blocking(decorator, n_tasks: int, payload: bytes, duration: float):
+    function = decorator(n_workers=N_WORKERS)(task)
+    function(list(range(n_tasks)), payload, duration)
+
+
+def run_non_blocking(decorator, n_tasks: int, payload: bytes, duration: float):
+    function = decorator(n_workers=N_WORKERS)(task)
+    results = [function(i, payload, duration) for i in range(n_tasks)]
+    [int(result) for result in results]
+
+
+def run_executor(Executor, n_tasks: int, payload: bytes, duration: float):
+    with Executor(max_workers=N_WORKERS) as executor:
+        list(
+            executor.map(
+                task,
+                range(n_tasks),
+                itertools.repeat(payload),
+                itertools.repeat(duration),
+            )
+        )
+
+
+def run_pool(n_tasks: int, payload: bytes, duration: float):
+    with multiprocessing.Pool(N_WORKERS) as pool:
+        pool.starmap(task, ((i, payload, duration) for i in range(n_tasks)))
+
+
+BACKENDS = {
+    "multithreaded": lambda *args: run_blocking(autothread.multithreaded, *args),
+    "multiprocessed": lambda *args: run_blocking(autothread.multiprocessed, *args),
+    "async_threaded": lambda *args: run_non_blocking(autothread.async_threaded, *args),
+    "async_processed": lambda *args: run_non_blocking(
+        autothread.async_processed, *args
+    ),
+    "ThreadPoolExecutor": lambda *args: run_executor(
+        concurrent.futures.ThreadPoolExecutor, *args
+    ),
+    "ProcessPoolExecutor": lambda *args: run_executor(
+        concurrent.futures.ProcessPoolExecutor, *args
+    ),
+    "multiprocessing.Pool": run_pool,
+}
+
+
+class PeakRSS:
+    """Keeps track of the peak RSS of this process and all its children"""
+
+    def __init__(self, interval: float = 0.01):
+        self.peak = 0
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+    def _sample(self):
+        process = psutil.Process()
+        while True:
+            rss = 0
+            for p in [process, *process.children(recursive=True)]:
+                try:
+                    rss += p.memory_info().rss
+                except psutil.Error:
+                    pass  # the child exited in the meantime
+            self.peak = max(self.peak, rss)
+            if self._stop.wait(self._interval):
+                return
+
+
+def run_case(case: dict) -> dict:
+    """Run a single case in this interpreter and return its measurements"""
+    payload = b"x" * case["arg_size"]
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        BACKENDS[case["backend"]](case["n_tasks"], payload, case["duration"])
+        wall = time.perf_counter() - start
+    ideal = case["n_tasks"] * case["duration"] / N_WORKERS
+    return dict(
+        case,
+        wall=wall,
+        overhead_per_task=(wall - ideal) / case["n_tasks"],
+        throughput=case["n_tasks"] / wall,
+        peak_rss_mb=rss.peak / 1024**2,
+    )
+
+
+def cases(matrix: dict):
+    """Yield all the cases of a matrix that do not take too long"""
+    for duration, n_tasks, arg_size in itertools.product(*matrix.values()):
+        if n_tasks * duration / N_WORKERS > MAX_SECONDS:
+            continue
+        if n_tasks * arg_size > MAX_BYTES:
+            continue
+        for backend in BACKENDS:
+            yield dict(
+                backend=backend, duration=duration, n_tasks=n_tasks, arg_size=arg_size
+            )
+
+
+def run_isolated(case: dict, timeout: float) -> dict:
+    """Run a case in a fresh interpreter"""
+    try:
+        process = subprocess.run(
+            [sys.executable, "-m", "benchmarks.suite", "--case", json.dumps(case)],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True,
+            text=True,
+            timeout=timeout,
+        )
+    except subprocess.TimeoutExpired:
+        return dict(case, error="timeout")
+    if process.returncode:
+        return dict(case, error=process.stderr.strip().splitlines()[-1:])
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def key(result: dict) -> tuple:
+    return result["backend"], result["duration"], result["n_tasks"], result["arg_size"]
+
+
+def compare(results: list, baseline_path: str, tolerance: float) -> bool:
+    """Print the wall times relative to a baseline, return False on a regression"""
+    with open(baseline_path) as f:
+        baseline = {key(result): result for result in json.load(f)["results"]}
+    ok = True
+    for result in results:
+        before = baseline.get(key(result))
+        if before is None or "wall" not in before or "wall" not in result:
+            continue
+        ratio = result["wall"] / before["wall"]
+        regression = ratio > 1 + tolerance and result["wall"] > MIN_SECONDS
+        ok &= not regression
+        print(
+            f"{'REGRESSION ' if regression else ''}{result['backend']} "
+            f"duration={result['duration']} n_tasks={result['n_tasks']} "
+            f"arg_size={result['arg_size']}: {before['wall']:.3f}s -> "
+            f"{result['wall']:.3f}s ({ratio:.2f}x)"
+        )
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--full", action="store_true")
+    parser.add_argument("--output")
+    parser.add_argument("--compare")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return
+
+    results = []
+    for case in cases(FULL if args.full else QUICK):
+        result = run_isolated(case, args.timeout)
+        results.append(result)
+        if "error" in result:
+            print(f"{case}: {result['error']}")
+            continue
+        print(
+            f"{result['backend']:<21} duration={result['duration']:<6} "
+            f"n_tasks={result['n_tasks']:<7} arg_size={result['arg_size']:<7} "
+            f"wall={result['wall']:.3f}s "
+            f"overhead={result['overhead_per_task'] * 1e6:.0f}us/task "
+            f"throughput={result['throughput']:.0f}/s "
+            f"peak_rss={result['peak_rss_mb']:.0f}MB"
+        )
+
+    if args.output:
+        metadata = dict(
+            autothread=autothread.__version__,
+            python=platform.python_version(),
+            platform=platform.platform(),
+            cpu_count=os.cpu_count(),
+            n_workers=N_WORKERS,
+        )
+        with open(args.output, "w") as f:
+            json.dump(dict(metadata=metadata, results=results), f, indent=2)
+    if args.compare and not compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Measures the time it takes to determine the loop parameters of a call with a list of
+1e6 items, for each `type_check` setting. The first call fills the type cache, the
+second call shows the cost once the outcome is cached.
+
+Run with `python -m benchmarks.type_check` from the base dir.
+"""
+
+import autothread
+import time
+
+from autothread.blocking import _Autothread
+from typing import Optional
+
+
+def function(x: int, y: Optional[float] = None):
+    return x
+
+
+def measure(type_check: str, values: list, hint: str):
+    decorator = _Autothread(
+        function=function,
+        Process=autothread.multithreaded.Process,
+        Queue=autothread.multithreaded.Queue,
+        n_workers=1,
+        progress_bar=False,
+        ignore_errors=False,
+        type_check=type_check,
+    )
+    timings = []
+    for _ in range(2):
+        start = time.perf_counter()
+        if hint == "class":
+            decorator._setup((values,), {})
+        else:
+            decorator._setup((1, values), {})
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+if __name__ == "__main__":
+    values = list(range(10**6))
+    for type_check in ("full", "sampled", "first", "off"):
+        for hint in ("class", "union"):
+            first, second = measure(type_check, values, hint)
+            print(
+                f"type_check={type_check:<8} hint={hint:<6} items={len(values)} "
+                f"first_call={first * 1000:.1f}ms second_call={second * 1000:.1f}ms"
+            )
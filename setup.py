@@ -15,6 +15,7 @@ setup(
   url = 'https://github.com/Basdbruijne/autothread',
   keywords = ['multithreading', 'multiprocessing', 'decorator'],
   install_requires = ['psutil', 'tqdm', 'typeguard', 'typing', 'multiprocess'],
+  extras_require = {'numpy': ['numpy']},
   classifiers=[  # Optional
     # How mature is this project? Common values are
     #   3 - Alpha
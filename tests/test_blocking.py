@@ -4,7 +4,7 @@
 # held responsible for any problems caused by the use of this module.
 
 """
-This file contains all the unittests for autothread. 
+This file contains all the unittests for autothread.
 To run the unittests, run `tox -e threading,processing,coverage` from the base dir.
 
 When contributing:
@@ -14,15 +14,37 @@ When contributing:
 - All the tests must pass on both windows and linux
 """
 
+import asyncio
+import autothread
+import multiprocess as mp
 import os
+import subprocess
+import sys
+import tempfile
+import threading
 import time
+import typeguard
 import typing
 import unittest
 import uuid
 
-from autothread import multiprocessed, multithreaded
+from autothread import Cache, CallStats, TaskFailure, multiprocessed, multithreaded
+from autothread import shared_array
+from autothread.affinity import _Placement, _parse_cpulist
+from autothread.autoscale import _Autoscaler
+from autothread.blocking import _Autothread
+from autothread.memory import _MemoryGate
+from autothread.shared_memory import _attach, _share, _SharedArray
+from concurrent.futures import CancelledError
 from mock import patch, Mock
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+Array = object if np is None else np.ndarray
+
 if os.environ["AUTOTHREAD_UNITTEST_MODE"] == "threading":
     testfunc = multithreaded
     print("RUNNING TESTS USING MULTITHREADING")
@@ -286,6 +308,14 @@ class TestNestedList(unittest.TestCase):
         self.assertEqual(result, [([1, 2], 1, 2), ([3, 4], 5, 20)])
 
 
+def _slow_start(started):
+    with started.get_lock():
+        started.value += 1
+        first = started.value == 1
+    if not first:
+        time.sleep(1)
+
+
 class TestErrors(unittest.TestCase):
     @testfunc(n_workers=-1)
     def _error_mp(self, x: int, y: int):
@@ -310,6 +340,8 @@ class TestErrors(unittest.TestCase):
                 raise ValueError()
             for _ in range(20):
                 time.sleep(0.5)
+                if autothread.cancelled():
+                    raise KeyboardInterrupt  # threads are cancelled, not interrupted
             return x, y, x * y
         except KeyboardInterrupt:
             with open(os.path.join(self.dir, f"tmp-{x}"), "w") as f:
@@ -333,15 +365,34 @@ class TestErrors(unittest.TestCase):
         with self.assertRaises(ValueError):
             self._error_mt_catch(list(range(20)), 16)
 
+        # Stopped threads are not waited for, they notice it in their own time
+        deadline = time.time() + 2
         for i in range(20):
             if i == 2:
                 continue
             path = os.path.join(self.dir, f"tmp-{i}")
+            while not os.path.exists(path) and time.time() < deadline:
+                time.sleep(0.05)
             self.assertTrue(os.path.exists(path))
             os.remove(path)
 
         os.rmdir(self.dir)
 
+    def test_error_while_hanging(self):
+        @testfunc(n_workers=2, timeout=1)
+        def _hang(x: int):
+            if x == 0:
+                time.sleep(0.1)
+                raise ValueError()
+            time.sleep(6)
+            return x
+
+        start = time.time()
+        with self.assertRaises(ValueError):
+            _hang([0, 1])
+        # The hanging task does not hold up the error, not even until its timeout
+        self.assertLess(time.time() - start, 1)
+
     @testfunc(n_workers=2)
     def _error_mt_catch_2_workers(self, x: int, y: int):
         if x == 0:
@@ -380,6 +431,18 @@ class TestErrors(unittest.TestCase):
 
         os.rmdir(self.dir2)
 
+    def test_error_while_starting(self):
+        @testfunc(n_workers=2, initializer=_slow_start, initargs=(mp.Value("i", 0),))
+        def _fail(x: int):
+            if x == 0:
+                raise ValueError()
+            return x
+
+        # The second worker is still starting, it must not be interrupted
+        with self.assertRaises(ValueError):
+            _fail([0, 1])
+        self.assertEqual(_fail([2, 3]), [2, 3])
+
     @testfunc(n_workers=-1, ignore_errors=True)
     def _error_ignore(self, x: int, y: int):
         if x == 2:
@@ -489,3 +552,1057 @@ class TestProgressbar(unittest.TestCase):
     def test_progressbar(self):
         # Just check that it doesn't fail
         self._test([10, 12, 5], 2)
+
+
+@testfunc(n_workers=2)
+def worker_id(x: int):
+    time.sleep(0.1)
+    return os.getpid(), threading.get_ident()
+
+
+@testfunc(n_workers=2)
+def worker_exit(x: int):
+    if x == 1:
+        os._exit(1)
+    time.sleep(0.1)
+    return x
+
+
+class TestWorkerPool(unittest.TestCase):
+    def test_reuses_workers(self):
+        first = set(worker_id(list(range(6))))
+        second = set(worker_id(list(range(6))))
+
+        self.assertLessEqual(len(first), 2)
+        self.assertTrue(second.issubset(first))
+
+    def test_shutdown(self):
+        worker_id([1, 2])
+        worker_id.shutdown()
+        worker_id.shutdown()
+        self.assertEqual(len(worker_id([1, 2, 3])), 3)
+
+    def test_worker_exit(self):
+        if testfunc == multithreaded:
+            return  # a thread can not exit on its own
+
+        with self.assertRaises(RuntimeError):
+            worker_exit([0, 1, 2])
+        self.assertEqual(worker_exit([0, 2]), [0, 2])
+
+
+class TestChunksize(unittest.TestCase):
+    @testfunc(n_workers=2, chunksize=3)
+    def _chunked(self, x: int):
+        return x, os.getpid(), threading.get_ident()
+
+    @testfunc(n_workers=3, chunksize="auto")
+    def _auto(self, x: int, y: int):
+        return x * y
+
+    def test_chunksize(self):
+        result = self._chunked(list(range(6)))
+        self.assertEqual([r[0] for r in result], list(range(6)))
+        self.assertEqual(len(set(r[1:] for r in result[:3])), 1)
+        self.assertEqual(len(set(r[1:] for r in result[3:])), 1)
+
+    def test_auto(self):
+        self.assertEqual(self._auto(list(range(100)), 2), list(range(0, 200, 2)))
+
+    def test_auto_sizes(self):
+        decorator = _Autothread(
+            function=self._auto,
+            Process=testfunc.Process,
+            Queue=testfunc.Queue,
+            n_workers=4,
+            progress_bar=False,
+            ignore_errors=False,
+            chunksize="auto",
+        )
+        sizes = list(decorator._chunk_sizes(100))
+        self.assertEqual(sum(sizes), 100)
+        self.assertEqual(sizes, sorted(sizes, reverse=True))
+        self.assertEqual(sizes[0], 12)
+        self.assertEqual(sizes[-1], 1)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            testfunc(chunksize=0)
+
+
+class TestIterators(unittest.TestCase):
+    @testfunc(n_workers=2)
+    def _test(self, x: int, y: int):
+        time.sleep(0.3)
+        return x * y
+
+    def test_generator(self):
+        result = self._test((i for i in range(1, 5)), 5)
+        self.assertEqual(result, [5, 10, 15, 20])
+
+    def test_mixed(self):
+        result = self._test(iter([1, 2, 3]), y=[1, 2, 3])
+        self.assertEqual(result, [1, 4, 9])
+
+    def test_empty(self):
+        self.assertEqual(self._test(iter([]), 5), [])
+
+    def test_length_error(self):
+        with self.assertRaises(IndexError):
+            self._test(iter([1, 2, 3]), iter([1, 2]))
+
+    def test_lazy(self):
+        read_at = []
+
+        def generator():
+            for i in range(6):
+                read_at.append(time.time())
+                yield i
+
+        self.assertEqual(self._test(generator(), 1), list(range(6)))
+        self.assertLess(read_at[1] - read_at[0], 0.25)
+        self.assertGreater(read_at[4] - read_at[0], 0.55)
+
+    def test_constant_iterator(self):
+        with tempfile.NamedTemporaryFile("w+") as f:
+            f.write("first\nsecond\n")
+            f.flush()
+            with open(f.name) as handle:
+                with self.assertWarns(UserWarning):  # the handle has no type hint
+                    self.assertEqual(_read_line([1, 2], handle), ["TextIOWrapper"] * 2)
+
+    def test_mismatch(self):
+        with self.assertRaises(TypeError):
+            _iterator_type((i for i in range(3)), iter([]))
+
+    def test_matching_iterator(self):
+        lines = iter(["first", "second"])
+        self.assertEqual(_iterator_type(["a", "b"], lines), ["list_iterator"] * 2)
+        self.assertEqual(list(lines), ["first", "second"])
+
+
+@testfunc(n_workers=2)
+def _read_line(x: int, handle):
+    return type(handle).__name__
+
+
+@testfunc(n_workers=2)
+def _iterator_type(x: str, lines: typing.Iterator[str]):
+    return type(lines).__name__
+
+
+@testfunc(n_workers=-1)
+def countdown(x: int):
+    time.sleep((3 - x) * 0.3)
+    return x
+
+
+class TestImap(unittest.TestCase):
+    def test_imap(self):
+        results = countdown.imap([0, 1, 2, 3])
+        self.assertEqual(list(results), [0, 1, 2, 3])
+
+    def test_imap_unordered(self):
+        start = time.time()
+        results = countdown.imap_unordered([0, 1, 2, 3])
+        self.assertEqual(next(results), 3)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(list(results), [2, 1, 0])
+
+    def test_single(self):
+        self.assertEqual(list(countdown.imap(3)), [3])
+
+    def test_stop_early(self):
+        results = countdown.imap_unordered([0, 1, 2, 3])
+        self.assertEqual(next(results), 3)
+        results.close()
+        self.assertEqual(countdown([3, 3]), [3, 3])
+
+    def test_reorder_buffer(self):
+        @testfunc(n_workers=2)
+        def _test(x: int):
+            time.sleep(0.6 if x == 0 else 0.1)
+            return x
+
+        self.assertEqual(list(_test.imap(list(range(8)))), list(range(8)))
+
+
+class TestTypeCheck(unittest.TestCase):
+    @testfunc(n_workers=-1, type_check="first")
+    def _first(self, x: int):
+        return x
+
+    @testfunc(n_workers=-1)
+    def _full(self, x: int):
+        return x
+
+    @testfunc(n_workers=2, chunksize="auto")
+    def _cached(self, x: int, y: typing.Optional[int] = None):
+        return x
+
+    def test_first(self):
+        self.assertEqual(self._first([1, "a"]), [1, "a"])
+
+    @patch("autothread.warnings.warn")
+    def test_full(self, mock_warn):
+        self.assertEqual(self._full([1, "a"]), [1, "a"])
+        mock_warn.assert_called()
+
+    @patch("autothread.blocking.typeguard.check_type", wraps=typeguard.check_type)
+    def test_cached(self, mock_check):
+        values = list(range(1000))
+        self.assertEqual(self._cached(values), values)
+        first_call = mock_check.call_count
+        self.assertLess(first_call, 5)
+
+        # The items of 'x' are not checked again
+        self.assertEqual(self._cached(values), values)
+        self.assertEqual(mock_check.call_count, 2 * first_call - 1)
+
+        self.assertEqual(self._cached(values, [None, 1] * 500), values)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            testfunc(type_check="some")
+
+
+@testfunc(n_workers=2, shared_memory=True, chunksize=3)
+def _fail_large(x: int):
+    if x == 1:
+        raise ValueError()
+    time.sleep(0.1 * x)
+    return np.full(10**5, x)
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class TestSharedMemory(unittest.TestCase):
+    @testfunc(n_workers=2, shared_memory=True)
+    def _sum(self, i: int, data: Array):
+        return data[i].sum()
+
+    @testfunc(n_workers=2, shared_memory=True)
+    def _fill(self, row: Array, value: int):
+        row[:] = value
+
+    @testfunc(n_workers=2, shared_memory=True, chunksize=2)
+    def _double(self, data: Array):
+        return data * 2
+
+    def test_constant(self):
+        data = np.random.rand(4, 10**5)
+        self.assertTrue(np.allclose(self._sum([0, 1, 2, 3], data), data.sum(1)))
+
+    def test_output_array(self):
+        out = shared_array((4, 3), int)
+        self._fill(list(out), [1, 2, 3, 4])
+        self.assertEqual(out.tolist(), [[1] * 3, [2] * 3, [3] * 3, [4] * 3])
+
+    def test_results(self):
+        data = [np.arange(10**5), np.arange(10), np.arange(10**5) + 1]
+        results = self._double(data)
+        for result, expected in zip(results, data):
+            self.assertTrue(np.array_equal(result, expected * 2))
+
+    @unittest.skipUnless(os.path.isdir("/dev/shm"), "blocks are not files")
+    def test_no_leaks(self):
+        before = set(os.listdir("/dev/shm"))
+        with self.assertRaises(ValueError):
+            _fail_large(list(range(6)))
+        outputs = _fail_large.imap([0, 2, 3, 4, 5, 6])
+        self.assertEqual(next(outputs)[0], 0)
+        outputs.close()
+        self.assertEqual(set(os.listdir("/dev/shm")) - before, set())
+
+    def test_share(self):
+        inputs = []
+        small, large = np.arange(10), np.random.rand(10**5)
+        self.assertIs(_share(small, inputs), small)
+        self.assertIsInstance(_share(large, inputs), _SharedArray)
+        self.assertEqual(len(inputs), 1)
+
+        array = shared_array((10, 10))
+        descriptor = _share(array[2:4, ::2], inputs)
+        self.assertIsInstance(descriptor, _SharedArray)
+        self.assertEqual(len(inputs), 1)
+        _attach(descriptor)[:] = 1
+        self.assertEqual(array.sum(), 10)
+
+
+class TestCoroutines(unittest.TestCase):
+    @testfunc(n_workers=20)
+    async def _sleep(self, x: int, duration: float):
+        await asyncio.sleep(duration)
+        if x < 0:
+            raise ValueError()
+        return x, threading.get_ident()
+
+    def test_basic(self):
+        n_threads = threading.active_count()
+        start = time.time()
+        results = self._sleep(list(range(20)), 0.5)
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual([x for x, _ in results], list(range(20)))
+        if testfunc == multithreaded:
+            # all the coroutines run on a single event loop
+            self.assertEqual(len(set(ident for _, ident in results)), 1)
+            self.assertLessEqual(threading.active_count(), n_threads + 1)
+
+    def test_error(self):
+        with self.assertRaises(ValueError):
+            self._sleep([1, -1, 2], 0.1)
+        self.assertEqual([x for x, _ in self._sleep([1, 2], 0)], [1, 2])
+
+    def test_single(self):
+        result = asyncio.run(self._sleep(1, 0))
+        self.assertEqual(result[0], 1)
+
+
+class TestStats(unittest.TestCase):
+    def test_last_stats(self):
+        @testfunc(n_workers=2, stats=True)
+        def _sleep(x: int, duration: float):
+            time.sleep(duration)
+            return x
+
+        self.assertIsNone(_sleep.last_stats)
+        _sleep([3, 2, 1], 0.1)
+        stats = _sleep.last_stats
+        self.assertEqual(stats.n_tasks, 3)
+        self.assertEqual([task.index for task in stats.tasks], [0, 1, 2])
+        self.assertGreaterEqual(stats.run_time, 0.3)
+        self.assertGreater(stats.wall_time, 0.1)
+        if testfunc == multithreaded:
+            self.assertIsNone(stats.arg_bytes)
+            self.assertIsNone(stats.peak_rss)
+        else:
+            self.assertGreater(stats.arg_bytes, 0)
+            self.assertGreater(stats.result_bytes, 0)
+            self.assertGreater(stats.peak_rss, 0)
+
+    def test_callback(self):
+        received = []
+
+        @testfunc(stats=received.append)
+        def _square(x: int):
+            return x**2
+
+        _square([1, 2])
+        _square([3])
+        self.assertEqual([stats.n_tasks for stats in received], [2, 1])
+        self.assertIs(_square.last_stats, received[-1])
+        self.assertIsInstance(received[0], CallStats)
+
+    def test_disabled(self):
+        self.assertEqual(basic([1, 2], 2), [2, 4])
+        self.assertIsNone(basic.last_stats)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            testfunc(stats="yes")
+
+
+class TestAutoscale(unittest.TestCase):
+    @patch("psutil.getloadavg")
+    @patch("psutil.cpu_percent")
+    @patch("psutil.virtual_memory")
+    def test_target(self, mock_memory, mock_cpu, mock_load):
+        mock_memory.return_value = Mock(total=100 * 1024**3, available=50 * 1024**3)
+        mock_cpu.return_value = 0
+        mock_load.return_value = (0, 0, 0)
+        autoscaler = _Autoscaler(2, 1, 6, interval=0)
+        autoscaler._n_cores = 4
+        self.assertEqual(autoscaler.target(), 6)
+
+        # oversubscribed, one worker is removed at a time
+        mock_cpu.return_value = 100
+        mock_load.return_value = (8, 0, 0)
+        self.assertEqual(autoscaler.target(), 5)
+        for _ in range(10):
+            autoscaler.target()
+        self.assertEqual(autoscaler.target(), 1)
+
+        # idle cores, but every worker needs 20GB and only 50GB is available
+        mock_cpu.return_value = 0
+        mock_load.return_value = (0, 0, 0)
+        autoscaler = _Autoscaler(1, 1, 6, mb_mem=20 * 1024, interval=0)
+        autoscaler._n_cores = 4
+        self.assertEqual(autoscaler.target(), 3)
+
+        # out of memory
+        mock_memory.return_value = Mock(total=100 * 1024**3, available=1024**3)
+        self.assertEqual(autoscaler.target(), 2)
+
+    def test_concurrency(self):
+        @testfunc(autoscale=True, max_workers=3)
+        def _sleep(x: int):
+            time.sleep(0.2)
+            return x
+
+        with patch.object(_Autoscaler, "target", return_value=1):
+            start = time.time()
+            self.assertEqual(_sleep([1, 2, 3]), [1, 2, 3])
+            self.assertGreater(time.time() - start, 0.6)
+        with patch.object(_Autoscaler, "target", return_value=3):
+            start = time.time()
+            self.assertEqual(_sleep([1, 2, 3]), [1, 2, 3])
+            self.assertLess(time.time() - start, 0.55)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            testfunc(autoscale=True, min_workers=0)
+        with self.assertRaises(ValueError):
+            testfunc(autoscale=True, min_workers=4, max_workers=2)
+
+
+class TestMemoryGate(unittest.TestCase):
+    @patch("psutil.Process")
+    @patch("psutil.virtual_memory")
+    def test_admit(self, mock_memory, mock_process):
+        mock_memory.return_value = Mock(total=8 * 1024**3, available=2 * 1024**3)
+        mock_process.return_value.memory_info.return_value = Mock(rss=0)
+        gate = _MemoryGate(mb_mem=1024)
+        self.assertEqual(gate.need([1], {}), 1024)
+        self.assertTrue(gate.admit(1024, 0, [1]))
+        self.assertTrue(gate.admit(1024, 1024, [1]))
+        self.assertFalse(gate.admit(1024, 2048, [1]))
+        # the running tasks already allocated 1GB, which is not available anymore
+        mock_process.return_value.memory_info.return_value = Mock(rss=1024**3)
+        self.assertTrue(gate.admit(1024, 2048, [1]))
+        # a task that can never fit starts once nothing else is running
+        self.assertFalse(gate.admit(10 * 1024, 1024, [1]))
+        self.assertTrue(gate.admit(10 * 1024, 0, [1]))
+
+    @patch("psutil.virtual_memory")
+    def test_delay(self, mock_memory):
+        mock_memory.return_value = Mock(total=16 * 1024**3, available=1500 * 1024**2)
+
+        @testfunc(n_workers=3, mem_estimate=lambda x: 1000 if x else 0, stats=True)
+        def _sleep(x: int):
+            time.sleep(0.2)
+            return x
+
+        start = time.time()
+        self.assertEqual(_sleep([1, 2, 3]), [1, 2, 3])
+        self.assertGreater(time.time() - start, 0.6)
+        self.assertGreater(_sleep.last_stats.memory_wait, 0.3)
+
+        start = time.time()
+        self.assertEqual(_sleep([0, 0, 0]), [0, 0, 0])
+        self.assertLess(time.time() - start, 0.55)
+        self.assertEqual(_sleep.last_stats.memory_wait, 0)
+
+
+class TestCache(unittest.TestCase):
+    def test_hits(self):
+        calls = []
+
+        @testfunc(n_workers=4, cache=True, stats=True)
+        def _square(x: int, y: int = 2):
+            calls.append(x)
+            time.sleep(0.2)
+            return x**y
+
+        self.assertEqual(_square([1, 2, 3]), [1, 4, 9])
+        start = time.time()
+        self.assertEqual(_square([0, 1, 2, 3, 4, 2]), [0, 1, 4, 9, 16, 4])
+        self.assertLess(time.time() - start, 0.35)
+        self.assertEqual(_square.last_stats.cache_hits, 4)
+        self.assertEqual(_square.last_stats.n_tasks, 2)
+        self.assertEqual(list(_square.imap([4, 5, 1], 2)), [16, 25, 1])
+        # different constant arguments are different tasks
+        self.assertEqual(_square([2, 3], 3), [8, 27])
+        if testfunc == multithreaded:
+            self.assertEqual(sorted(calls), [0, 1, 2, 2, 3, 3, 4, 5])
+
+    def test_chunks(self):
+        @testfunc(n_workers=2, chunksize=3, cache=True)
+        def _double(x: int):
+            return x * 2
+
+        self.assertEqual(_double([1, 3, 5]), [2, 6, 10])
+        inputs = list(range(8))
+        self.assertEqual(_double(inputs), [x * 2 for x in inputs])
+        self.assertEqual(
+            sorted(_double.imap_unordered(inputs)), [0, 2, 4, 6, 8, 10, 12, 14]
+        )
+
+    def test_errors(self):
+        @testfunc(cache=True)
+        def _check(x: int):
+            if x < 0:
+                raise ValueError()
+            return x
+
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                _check([1, -1])
+        self.assertEqual(_check.cache.hits, 1)
+
+    def test_limits(self):
+        cache = Cache(maxsize=2)
+        for key in "abc":
+            cache._put(key, key)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache._get("b"), "b")
+        cache._put("d", "d")
+        self.assertEqual(cache._get("c"), cache._get("a"))  # both dropped
+
+        cache = Cache(maxsize=None, maxbytes=2000)
+        for key in "abc":
+            cache._put(key, b"x" * 900)
+        self.assertEqual(len(cache), 2)
+
+    def test_directory(self):
+        with tempfile.TemporaryDirectory() as directory:
+
+            @testfunc(cache=Cache(directory=directory))
+            def _negate(x: int):
+                return -x
+
+            self.assertEqual(_negate([1, 2]), [-1, -2])
+            self.assertEqual(len(os.listdir(directory)), 2)
+            # a new cache with the same directory, as after a restart
+            _negate.cache.__init__(directory=directory)
+            self.assertEqual(_negate([1, 2]), [-1, -2])
+            self.assertEqual(_negate.cache.hits, 2)
+            _negate.cache.clear()
+            self.assertEqual(os.listdir(directory), [])
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            testfunc(cache=10)
+
+
+class TestSchedule(unittest.TestCase):
+    def _started(self, **kwargs):
+        @testfunc(n_workers=1, **kwargs)
+        def _sleep(x: int, duration: float):
+            started = time.perf_counter()
+            time.sleep(duration * x)
+            return x, started
+
+        return _sleep
+
+    def _order(self, outputs):
+        return [x for x, _ in sorted(outputs, key=lambda output: output[1])]
+
+    def test_cost(self):
+        _sleep = self._started(schedule=lambda x, duration: x % 3)
+        outputs = _sleep([0, 1, 2, 3, 4, 5], 0)
+        self.assertEqual([x for x, _ in outputs], [0, 1, 2, 3, 4, 5])
+        self.assertEqual(self._order(outputs), [2, 5, 1, 4, 0, 3])
+        outputs = list(_sleep.imap([0, 1, 2, 3, 4, 5], 0))
+        self.assertEqual([x for x, _ in outputs], [0, 1, 2, 3, 4, 5])
+        outputs = list(_sleep.imap_unordered([0, 1, 2], 0))
+        self.assertEqual(sorted(x for x, _ in outputs), [0, 1, 2])
+
+    def test_history(self):
+        _sleep = self._started(schedule="history", chunksize=2)
+        self.assertEqual(self._order(_sleep([1, 5], 0.05)), [1, 5])
+        # 2 is unknown and gets the average cost of the known items
+        outputs = _sleep([1, 2, 5], 0.05)
+        self.assertEqual([x for x, _ in outputs], [1, 2, 5])
+        self.assertEqual(self._order(outputs), [5, 2, 1])
+        self.assertEqual([x for x, _ in _sleep.imap([1, 2, 5], 0.05)], [1, 2, 5])
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            testfunc(schedule="longest")
+
+
+class TestTimeout(unittest.TestCase):
+    def _sleep(self, **kwargs):
+        @testfunc(n_workers=3, **kwargs)
+        def _sleep(x: float):
+            time.sleep(x)
+            return x
+
+        return _sleep
+
+    def test_timeout(self):
+        _sleep = self._sleep(timeout=0.5)
+        start = time.perf_counter()
+        with self.assertRaises(TimeoutError):
+            _sleep([0.1, 5, 0.1])
+        self.assertLess(time.perf_counter() - start, 3)
+        self.assertEqual(_sleep([0.1, 0.2]), [0.1, 0.2])
+
+    def test_timeout_ignore_errors(self):
+        _sleep = self._sleep(timeout=0.5, ignore_errors=True, chunksize=2)
+        start = time.perf_counter()
+        self.assertEqual(_sleep([5, 0.1, 0.1, 0.1]), [None, 0.1, 0.1, 0.1])
+        self.assertLess(time.perf_counter() - start, 3)
+
+    def test_call_timeout(self):
+        _sleep = self._sleep(call_timeout=0.5)
+        start = time.perf_counter()
+        with self.assertRaises(TimeoutError):
+            _sleep([0.1, 5, 5])
+        self.assertLess(time.perf_counter() - start, 3)
+        self.assertEqual(_sleep([0.1, 0.2]), [0.1, 0.2])
+
+    def test_cancel(self):
+        _sleep = self._sleep()
+        threading.Timer(0.5, _sleep.cancel).start()
+        start = time.perf_counter()
+        with self.assertRaises(CancelledError):
+            _sleep([5, 5])
+        self.assertLess(time.perf_counter() - start, 3)
+        self.assertEqual(_sleep([0.1, 0.2]), [0.1, 0.2])
+
+    @unittest.skipIf(testfunc is multiprocessed, "processes are killed instead")
+    def test_cancelled(self):
+        stopped = threading.Event()
+
+        @testfunc(n_workers=1, timeout=0.2, ignore_errors=True)
+        def _wait(x: int):
+            while not autothread.cancelled():
+                time.sleep(0.01)
+            stopped.set()
+
+        self.assertEqual(_wait([1]), [None])
+        self.assertTrue(stopped.wait(1))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            testfunc(timeout=0)
+        with self.assertRaises(ValueError):
+            testfunc(call_timeout="1")
+
+
+class TestRetry(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def _flaky(self, **kwargs):
+        directory = self.directory.name
+
+        @testfunc(n_workers=2, **kwargs)
+        def _flaky(x: int, failures: int, error: type = OSError):
+            # Every attempt leaves a line in a file, so this works across processes
+            with open(os.path.join(directory, str(x)), "a+") as f:
+                f.write(".")
+                f.seek(0)
+                attempt = len(f.read())
+            if attempt <= failures:
+                raise error(f"attempt {attempt} of {x}")
+            return x
+
+        return _flaky
+
+    def test_retries(self):
+        _flaky = self._flaky(retries=2, backoff=0.1)
+        start = time.time()
+        self.assertEqual(_flaky([1, 2], 2), [1, 2])
+        self.assertGreater(time.time() - start, 0.3)
+        with self.assertRaises(OSError):
+            _flaky([3, 4], 3)
+
+    def test_retry_on(self):
+        _flaky = self._flaky(retries=2, retry_on=(OSError, KeyError))
+        self.assertEqual(_flaky([1], 1, KeyError), [1])
+        with self.assertRaises(ValueError):
+            _flaky([2], 1, ValueError)
+
+    def test_return_failures(self):
+        _flaky = self._flaky(retries=1, return_failures=True)
+        results, failures = _flaky([1, 2, 3], [0, 2, 1])
+        self.assertEqual(results, [1, None, 3])
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(failures[0].index, 1)
+        self.assertEqual(failures[0].item, {"x": 2, "failures": 2})
+        self.assertIsInstance(failures[0].error, OSError)
+        self.assertEqual(failures[0].attempts, 2)
+        outputs = list(_flaky.imap([4, 5], 2))
+        self.assertTrue(all(isinstance(output, TaskFailure) for output in outputs))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            testfunc(retries=-1)
+        with self.assertRaises(ValueError):
+            testfunc(retries=1, retry_on="OSError")
+        with self.assertRaises(ValueError):
+            testfunc(retries=1, backoff=-1)
+
+
+class TestCheckpoint(unittest.TestCase):
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as directory:
+            runs = os.path.join(directory, "runs")
+
+            @testfunc(n_workers=1, checkpoint=os.path.join(directory, "checkpoint.db"))
+            def _square(x: int):
+                with open(runs, "a") as f:
+                    f.write(".")
+                if x < 0:
+                    raise ValueError()
+                return x**2
+
+            def n_runs():
+                with open(runs) as f:
+                    return len(f.read())
+
+            with self.assertRaises(ValueError):
+                _square([1, 2, 3, -4])
+            self.assertEqual(n_runs(), 4)
+            with self.assertRaises(ValueError):
+                _square([1, 5, 3, -4])
+            # Only the task that failed and the tasks with other inputs run again
+            self.assertEqual(n_runs(), 6)
+            # The outputs of the first call are kept next to the ones of the second
+            self.assertEqual(_square([1, 2, 3, 4]), [1, 4, 9, 16])
+            self.assertEqual(n_runs(), 7)
+            # The call finished, its outputs are deleted
+            self.assertEqual(_square([1, 2, 3, 4]), [1, 4, 9, 16])
+            self.assertEqual(n_runs(), 11)
+
+    def test_overlapping_calls(self):
+        with tempfile.TemporaryDirectory() as directory:
+            runs = os.path.join(directory, "runs")
+
+            @testfunc(n_workers=2, checkpoint=os.path.join(directory, "checkpoint.db"))
+            def _square(x: int):
+                with open(runs, "a") as f:
+                    f.write(".")
+                if x < 0:
+                    time.sleep(0.5)
+                    raise ValueError()
+                return x**2
+
+            def n_runs():
+                with open(runs) as f:
+                    return len(f.read())
+
+            def fail():
+                with self.assertRaises(ValueError):
+                    _square([-1, 2, 3])
+
+            thread = threading.Thread(target=fail)
+            thread.start()
+            time.sleep(0.2)
+            # Finishes while the first call is still running
+            self.assertEqual(_square([10, 20, 30]), [100, 400, 900])
+            thread.join()
+            self.assertEqual(n_runs(), 6)
+            # The finished call did not delete the outputs of the failed call
+            self.assertEqual(_square([1, 2, 3]), [1, 4, 9])
+            self.assertEqual(n_runs(), 7)
+
+
+class TestConcurrentCalls(unittest.TestCase):
+    def _run(self, target, n_threads: int):
+        errors = []
+
+        def run(i):
+            try:
+                target(i)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_stress(self):
+        @testfunc(n_workers=4, chunksize="auto")
+        def _scale(x: int, factor: int):
+            time.sleep(0.001 * (x % 3))
+            if x < 0:
+                raise ValueError()
+            return x * factor
+
+        def call(factor):
+            for _ in range(5):
+                expected = [x * factor for x in range(50)]
+                self.assertEqual(_scale(list(range(50)), factor), expected)
+                self.assertEqual(list(_scale.imap(list(range(50)), factor)), expected)
+                with self.assertRaises(ValueError):
+                    _scale([1, -1, 2], factor)
+
+        self._run(call, 8)
+
+    @unittest.skipIf(testfunc is multiprocessed, "the counter lives in this process")
+    def test_shared_workers(self):
+        lock, running, peak = threading.Lock(), [0], [0]
+
+        @testfunc(n_workers=3)
+        def _count(x: int):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return x
+
+        self._run(
+            lambda i: self.assertEqual(_count(list(range(20))), list(range(20))), 6
+        )
+        self.assertEqual(peak[0], 3)
+
+    def test_worker_count(self):
+        lock, workers = threading.Lock(), set()
+
+        def call(i):
+            outputs = worker_id(list(range(4)))
+            with lock:
+                workers.update(outputs)
+
+        self._run(call, 8)
+        self.assertLessEqual(len(workers), 2)
+
+    def test_recursion(self):
+        self.assertEqual(_recurse([2, 2, 1]), [4, 4, 1])
+
+
+@testfunc(n_workers=2)
+def _recurse(x: int):
+    if x <= 0:
+        return 0
+    return x + sum(_recurse([x - 1, x - 1]))
+
+
+@multithreaded(n_workers=4)
+def _inner(x: int):
+    time.sleep(0.3)
+    return x
+
+
+@testfunc(n_workers=2)
+def _outer(x: int):
+    return sum(_inner([x, x]))
+
+
+class TestLimit(unittest.TestCase):
+    def test_nested(self):
+        start = time.time()
+        self.assertEqual(_outer([1, 2]), [2, 4])
+        self.assertLess(time.time() - start, 0.55)
+        # The outer tasks take both slots, the inner tasks run inline one by one
+        with autothread.limit(2):
+            start = time.time()
+            self.assertEqual(_outer([1, 2]), [2, 4])
+            self.assertGreater(time.time() - start, 0.55)
+        start = time.time()
+        self.assertEqual(_outer([1, 2]), [2, 4])
+        self.assertLess(time.time() - start, 0.55)
+
+    def test_borrow(self):
+        # One outer task leaves a slot for the inner tasks to run in parallel
+        with autothread.limit(3):
+            start = time.time()
+            self.assertEqual(_outer([1]), [2])
+            self.assertLess(time.time() - start, 0.55)
+
+    @unittest.skipIf(testfunc is multiprocessed, "the counter lives in this process")
+    def test_concurrent_calls(self):
+        lock, running, peak = threading.Lock(), [0], [0]
+
+        @testfunc(n_workers=4)
+        def _count(x: int):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return x
+
+        with autothread.limit(3):
+            threads = [
+                threading.Thread(target=_count, args=(list(range(10)),))
+                for _ in range(3)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(peak[0], 3)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            autothread.limit(0)
+
+
+class TestAffinity(unittest.TestCase):
+    @unittest.skipUnless(hasattr(os, "sched_getaffinity"), "Linux only")
+    def test_pinned(self):
+        @testfunc(n_workers=2, affinity="compact")
+        def cores(x: int):
+            return sorted(os.sched_getaffinity(0))
+
+        allowed = sorted(os.sched_getaffinity(0))
+        for result in cores([1, 2, 3, 4]):
+            if testfunc is multiprocessed:
+                self.assertEqual(len(result), 1)
+                self.assertIn(result[0], allowed)
+            else:
+                self.assertEqual(result, allowed)
+
+    @patch("autothread.affinity._numa_nodes")
+    def test_layout(self, mock_nodes):
+        mock_nodes.return_value = [[4, 5, 6], [0, 1]]
+        expected = {
+            "round_robin": [0, 1, 4, 5, 6, 0],
+            "compact": [4, 5, 6, 0, 1, 4],
+            "spread": [4, 0, 5, 1, 6, 4],
+        }
+        for strategy, cores in expected.items():
+            placement = _Placement(strategy)
+            self.assertEqual([placement.cpus(i)[0] for i in range(6)], cores)
+
+    def test_parse_cpulist(self):
+        self.assertEqual(_parse_cpulist("0-3,8,10-11\n"), [0, 1, 2, 3, 8, 10, 11])
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            testfunc(affinity="scatter")
+
+
+class TestThreadsPerProcess(unittest.TestCase):
+    def test_hybrid(self):
+        @testfunc(n_workers=2, threads_per_process=3)
+        def wait(x: int):
+            time.sleep(0.3)
+            return x, os.getpid()
+
+        start = time.time()
+        results = wait(list(range(6)))
+        self.assertEqual([x for x, _ in results], list(range(6)))
+        if testfunc is multiprocessed:
+            # Has no effect for threads
+            self.assertLess(time.time() - start, 0.55)
+            self.assertLessEqual(len({pid for _, pid in results}), 2)
+        wait.shutdown()
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            testfunc(threads_per_process=0)
+        with self.assertRaises(ValueError):
+            testfunc(threads_per_process=2, timeout=1)
+
+
+class TestInitializer(unittest.TestCase):
+    def test_context(self):
+        with tempfile.TemporaryDirectory() as directory:
+
+            def setup(prefix):
+                return prefix + uuid.uuid4().hex
+
+            def teardown(context):
+                open(os.path.join(directory, context), "w").close()
+
+            @testfunc(
+                n_workers=2, initializer=setup, initargs=("w",), teardown=teardown
+            )
+            def task(x: int):
+                time.sleep(0.01)
+                return autothread.context()
+
+            contexts = set(task(list(range(10)))) | set(task(list(range(10))))
+            self.assertLessEqual(len(contexts), 2)
+            self.assertTrue(all(context.startswith("w") for context in contexts))
+            task.shutdown()
+            self.assertEqual(set(os.listdir(directory)), contexts)
+        self.assertIsNone(autothread.context())
+
+    def test_teardown_at_exit(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "teardown")
+            script = (
+                "import asyncio, autothread\n"
+                f"@autothread.{testfunc.__name__}(n_workers=2, initializer=dict, "
+                f"teardown=lambda context: open({path!r}, 'w').close())\n"
+                "async def task(x: int):\n"
+                "    await asyncio.sleep(0.01)\n"
+                "    return x\n"
+                "task([1, 2, 3])\n"
+            )
+            root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            subprocess.run([sys.executable, "-c", script], cwd=root, check=True)
+            # The event loop of the coroutines was stopped at exit
+            self.assertTrue(os.path.exists(path))
+
+    def test_failure(self):
+        def setup():
+            raise ValueError("no model")
+
+        @testfunc(n_workers=2, initializer=setup)
+        def task(x: int):
+            return x
+
+        with self.assertRaises(ValueError):
+            task([1, 2, 3])
+
+        @testfunc(n_workers=2, initializer=setup, ignore_errors=True)
+        def task(x: int):
+            return x
+
+        self.assertEqual(task([1, 2, 3]), [None, None, None])
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            testfunc(initializer="model")
+        with self.assertRaises(ValueError):
+            testfunc(initializer=dict, initargs="model")
+
+
+class TestBatch(unittest.TestCase):
+    def test_batches(self):
+        @testfunc(n_workers=2, batch_size=3)
+        def sizes(x: int, y: int):
+            return [(a * y, len(x)) for a in x]
+
+        self.assertEqual(
+            sizes(list(range(10)), 2),
+            [(2 * i, 3 if i < 9 else 1) for i in range(10)],
+        )
+        self.assertEqual(
+            list(sizes.imap(iter(range(4)), 1)), [(0, 3), (1, 3), (2, 3), (3, 1)]
+        )
+        self.assertEqual(
+            sorted(sizes.imap_unordered(list(range(7)), 1)),
+            [(i, 3 if i < 6 else 1) for i in range(7)],
+        )
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def test_numpy(self):
+        @testfunc(n_workers=2, batch_size=4)
+        def root(x: float):
+            self.assertIsInstance(x, np.ndarray)
+            return np.sqrt(x)
+
+        results = root(np.arange(10.0) ** 2, _loop_params=["x"])
+        self.assertEqual(results, list(range(10)))
+
+    def test_failures(self):
+        @testfunc(n_workers=2, batch_size=2, return_failures=True)
+        def fail(x: int):
+            if 3 in x:
+                raise ValueError(x)
+            return x
+
+        results, failures = fail([1, 2, 3, 4, 5])
+        self.assertEqual(results, [1, 2, None, None, 5])
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(failures[0].item, {"x": [3, 4]})
+        # the index of the first item of the batch, not of the batch
+        self.assertEqual(failures[0].index, 2)
+
+    def test_wrong_length(self):
+        @testfunc(n_workers=2, batch_size=2)
+        def wrong(x: int):
+            return x[:1]
+
+        with self.assertRaises(ValueError):
+            wrong([1, 2, 3, 4])
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            testfunc(batch_size=0)
+        with self.assertRaises(ValueError):
+            testfunc(batch_size=10, schedule="history")
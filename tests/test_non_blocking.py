@@ -4,7 +4,7 @@
 # held responsible for any problems caused by the use of this module.
 
 """
-This file contains all the unittests for autothread. 
+This file contains all the unittests for autothread.
 To run the unittests, run `tox -e threading,processing,coverage` from the base dir.
 
 When contributing:
@@ -14,12 +14,19 @@ When contributing:
 - All the tests must pass on both windows and linux
 """
 
+import asyncio
+import autothread
 import datetime
 import os
+import psutil
+import tempfile
+import threading
 import time
 import unittest
 
 from autothread import async_threaded, async_processed
+from autothread.autoscale import _Autoscaler
+from concurrent.futures import CancelledError
 from mock import patch, Mock
 
 if os.environ["AUTOTHREAD_UNITTEST_MODE"] == "threading":
@@ -129,6 +136,19 @@ class A:
         self.value = value
 
 
+class Job:
+    def __init__(self, x):
+        self.x = x
+
+    def cancel(self):
+        return f"job {self.x} cancelled"
+
+
+@testfunc(n_workers=-1)
+def job(x: int) -> Job:
+    return Job(x)
+
+
 @testfunc(n_workers=-1)
 def basicA(x: int, y: int) -> A:
     """doctstring"""
@@ -247,3 +267,339 @@ class TestObject(unittest.TestCase):
         time.sleep(5)
         for result in results:
             self.assertTrue(result < datetime.datetime.now())
+
+
+class TestExecutor(unittest.TestCase):
+    @testfunc(n_workers=2)
+    def _worker_id(self, x: int) -> tuple:
+        time.sleep(0.01)
+        return os.getpid(), threading.get_ident()
+
+    def test_bounded(self):
+        n_threads = threading.active_count()
+        results = [self._worker_id(i) for i in range(200)]
+        # only the workers and the dispatcher are running
+        self.assertLessEqual(threading.active_count(), n_threads + 3)
+        self.assertEqual(len(set(tuple(result) for result in results)), 2)
+
+    def test_shutdown(self):
+        results = [self._worker_id(i) for i in range(4)]
+        self._worker_id.shutdown()
+        self.assertEqual(len(set(tuple(result) for result in results)), 2)
+        new_results = [self._worker_id(i) for i in range(4)]
+        self.assertEqual(len(set(tuple(result) for result in new_results)), 2)
+        self.assertFalse(set(results) & set(new_results))
+
+    def test_file_descriptors(self):
+        if os.name == "nt":
+            return  # file descriptors can only be counted on posix
+
+        tuple(self._worker_id(0))  # start the workers
+        n_fds = psutil.Process().num_fds()
+        results = [self._worker_id(i) for i in range(500)]
+        self.assertLess(psutil.Process().num_fds(), n_fds + 10)
+        self.assertEqual(len(results), 500)
+
+
+@testfunc(n_workers=2)
+def worker_exit(x: int) -> int:
+    if x == 1:
+        os._exit(1)
+    time.sleep(0.5)
+    return x
+
+
+class TestWorkerExit(unittest.TestCase):
+    def test_worker_exit(self):
+        if testfunc == async_threaded:
+            return  # a thread can not exit on its own
+
+        results = [worker_exit(x) for x in range(4)]
+        with self.assertRaises(RuntimeError):
+            results[1] + 1
+        self.assertEqual(worker_exit(2), 2)
+
+
+class TestAwait(unittest.TestCase):
+    @testfunc(n_workers=4)
+    def _slow(self, x: int) -> int:
+        time.sleep(0.5)
+        if x < 0:
+            raise ValueError()
+        return x * 2
+
+    @testfunc(n_workers=4)
+    async def _coroutine(self, x: int) -> int:
+        await asyncio.sleep(0.1)
+        return x * 3
+
+    def test_await(self):
+        async def main():
+            ticks = 0
+
+            async def ticker():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.05)
+                    ticks += 1
+
+            task = asyncio.create_task(ticker())
+            placeholders = [self._slow(i) for i in range(4)]
+            results = [await placeholder for placeholder in placeholders]
+            task.cancel()
+            return results, ticks
+
+        start = time.time()
+        results, ticks = asyncio.run(main())
+        self.assertEqual(results, [0, 2, 4, 6])
+        self.assertLess(time.time() - start, 2)
+        # the event loop kept running while waiting
+        self.assertGreater(ticks, 3)
+
+    def test_gather(self):
+        async def main():
+            ticks = 0
+
+            async def ticker():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.05)
+                    ticks += 1
+
+            task = asyncio.create_task(ticker())
+            placeholders = [self._slow(i) for i in range(4)]
+            futures = [placeholder.___future___() for placeholder in placeholders]
+            results = await asyncio.gather(*futures)
+            task.cancel()
+            return results, ticks
+
+        results, ticks = asyncio.run(main())
+        self.assertEqual(results, [0, 2, 4, 6])
+        self.assertGreater(ticks, 3)
+
+    def test_wait_for(self):
+        async def main():
+            result = await asyncio.wait_for(self._slow(1).___future___(), 2)
+            placeholder = self._slow(2)
+            start = time.time()
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(placeholder.___future___(), 0.1)
+            return result, time.time() - start
+
+        result, waited = asyncio.run(main())
+        self.assertEqual(result, 2)
+        self.assertLess(waited, 0.4)
+
+    def test_stable_type(self):
+        async def main():
+            placeholder = self._slow(1)
+            # The type and the hash are the ones of the result, also in the event loop
+            before = isinstance(placeholder, int), {placeholder}
+            await placeholder
+            return before, isinstance(placeholder, int), placeholder in before[1]
+
+        (before, _), after, found = asyncio.run(main())
+        self.assertTrue(before and after and found)
+
+    def test_error(self):
+        async def main():
+            return await self._slow(-1)
+
+        with self.assertRaises(ValueError):
+            asyncio.run(main())
+
+    def test_coroutine_function(self):
+        self.assertEqual(self._coroutine(2), 6)
+
+
+class TestStats(unittest.TestCase):
+    def test_stats(self):
+        received = []
+
+        @testfunc(n_workers=2, stats=received.append)
+        def _sleep(x: int, duration: float) -> int:
+            time.sleep(duration)
+            return x
+
+        placeholders = [_sleep(x, 0.2) for x in range(3)]
+        self.assertEqual(placeholders, [0, 1, 2])
+        stats = _sleep.stats_of(placeholders[2])
+        self.assertEqual(stats.n_tasks, 1)
+        self.assertGreaterEqual(stats.run_time, 0.2)
+        self.assertGreaterEqual(stats.wall_time, stats.run_time)
+        self.assertEqual(len(received), 3)
+        self.assertIn(_sleep.last_stats, received)
+        if testfunc == async_threaded:
+            self.assertIsNone(stats.arg_bytes)
+        else:
+            self.assertGreater(stats.arg_bytes, 0)
+        # Waits for the call, the result can be collected afterwards
+        placeholder = _sleep(5, 0.1)
+        self.assertEqual(_sleep.stats_of(placeholder).n_tasks, 1)
+        self.assertEqual(placeholder, 5)
+
+    def test_disabled(self):
+        result = basic(2, 3)
+        self.assertEqual(result, 6)
+        self.assertIsNone(basic.stats_of(result))
+        self.assertIsNone(basic.last_stats)
+
+
+class TestAutoscale(unittest.TestCase):
+    def test_concurrency(self):
+        @testfunc(autoscale=True, max_workers=3)
+        def _sleep(x: int) -> int:
+            time.sleep(0.2)
+            return x
+
+        with patch.object(_Autoscaler, "target", return_value=1):
+            start = time.time()
+            self.assertEqual([_sleep(x) for x in range(3)], [0, 1, 2])
+            self.assertGreater(time.time() - start, 0.6)
+        with patch.object(_Autoscaler, "target", return_value=3):
+            start = time.time()
+            self.assertEqual([_sleep(x) for x in range(3)], [0, 1, 2])
+            self.assertLess(time.time() - start, 0.55)
+
+
+class TestMemoryGate(unittest.TestCase):
+    @patch("psutil.virtual_memory")
+    def test_delay(self, mock_memory):
+        mock_memory.return_value = Mock(total=16 * 1024**3, available=1500 * 1024**2)
+
+        @testfunc(n_workers=3, mem_estimate=lambda x: 1000, stats=True)
+        def _sleep(x: int) -> int:
+            time.sleep(0.2)
+            return x
+
+        start = time.time()
+        placeholders = [_sleep(x) for x in range(3)]
+        self.assertEqual(placeholders, [0, 1, 2])
+        self.assertGreater(time.time() - start, 0.6)
+        self.assertEqual(_sleep.stats_of(placeholders[0]).memory_wait, 0)
+        self.assertGreater(_sleep.stats_of(placeholders[2]).memory_wait, 0.1)
+
+
+class TestCache(unittest.TestCase):
+    def test_hits(self):
+        @testfunc(cache=True, stats=True)
+        def _square(x: int) -> int:
+            time.sleep(0.2)
+            if x < 0:
+                raise ValueError()
+            return x**2
+
+        self.assertEqual([_square(x) for x in range(3)], [0, 1, 4])
+        start = time.time()
+        result = _square(2)
+        self.assertEqual(result, 4)
+        self.assertLess(time.time() - start, 0.1)
+        self.assertEqual(_square.stats_of(result).cache_hits, 1)
+        self.assertEqual(_square.cache.hits, 1)
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                int(_square(-1))
+        self.assertEqual(_square.cache.hits, 1)
+
+
+class TestTimeout(unittest.TestCase):
+    def test_timeout(self):
+        @testfunc(n_workers=2, timeout=0.5)
+        def _sleep(x: float) -> float:
+            time.sleep(x)
+            return x
+
+        start = time.time()
+        placeholders = [_sleep(x) for x in (5, 0.1, 0.1)]
+        with self.assertRaises(TimeoutError):
+            float(placeholders[0])
+        self.assertEqual(placeholders[1:], [0.1, 0.1])
+        self.assertLess(time.time() - start, 3)
+        self.assertEqual(_sleep(0.1), 0.1)
+
+    def test_cancel(self):
+        @testfunc(n_workers=1)
+        def _sleep(x: float) -> float:
+            time.sleep(x)
+            return x
+
+        start = time.time()
+        running, queued, done = _sleep(5), _sleep(0.5), _sleep(0.1)
+        time.sleep(0.2)
+        self.assertTrue(running.___cancel___())
+        self.assertTrue(queued.___cancel___())
+        self.assertFalse(queued.___cancel___())
+        with self.assertRaises(CancelledError):
+            float(running)
+        with self.assertRaises(CancelledError):
+            float(queued)
+        self.assertEqual(done, 0.1)
+        self.assertFalse(done.___cancel___())
+        self.assertLess(time.time() - start, 3)
+
+    def test_cancel_forwarded(self):
+        # Only thrunders act on the call, `cancel` belongs to the return value
+        self.assertEqual(job(1).cancel(), "job 1 cancelled")
+
+    def test_cancel_all(self):
+        @testfunc(n_workers=2)
+        def _sleep(x: float) -> float:
+            time.sleep(x)
+            return x
+
+        placeholders = [_sleep(5) for _ in range(4)]
+        time.sleep(0.2)
+        start = time.time()
+        _sleep.cancel()
+        for placeholder in placeholders:
+            with self.assertRaises(CancelledError):
+                float(placeholder)
+        self.assertLess(time.time() - start, 2)
+
+
+class TestRetry(unittest.TestCase):
+    def test_retries(self):
+        with tempfile.TemporaryDirectory() as directory:
+
+            @testfunc(retries=2, retry_on=OSError)
+            def _flaky(x: int, failures: int) -> int:
+                with open(os.path.join(directory, str(x)), "a+") as f:
+                    f.write(".")
+                    f.seek(0)
+                    attempt = len(f.read())
+                if attempt <= failures:
+                    raise OSError(f"attempt {attempt} of {x}")
+                return x
+
+            self.assertEqual([_flaky(1, 2), _flaky(2, 0)], [1, 2])
+            with self.assertRaises(OSError):
+                int(_flaky(3, 3))
+
+
+class TestAffinity(unittest.TestCase):
+    @unittest.skipUnless(hasattr(os, "sched_getaffinity"), "Linux only")
+    def test_pinned(self):
+        @testfunc(n_workers=2, affinity="spread")
+        def cores(x: int) -> list:
+            return sorted(os.sched_getaffinity(0))
+
+        allowed = sorted(os.sched_getaffinity(0))
+        results = [cores(i) for i in range(4)]
+        for result in results:
+            if testfunc is async_processed:
+                self.assertEqual(len(result), 1)
+                self.assertIn(result[0], allowed)
+            else:
+                self.assertEqual(result, allowed)
+
+
+class TestInitializer(unittest.TestCase):
+    def test_context(self):
+        def setup(value):
+            return {"value": value}
+
+        @testfunc(n_workers=2, initializer=setup, initargs=(3,))
+        def multiply(x: int) -> int:
+            return autothread.context()["value"] * x
+
+        self.assertEqual([multiply(i) for i in range(4)], [0, 3, 6, 9])